@@ -0,0 +1,78 @@
+import gc
+import sys
+import time
+import typing
+from coin.ledger import Ledger, update_ledger
+from coin.persistent import PersistentMap
+from coin.transaction import (
+    Transaction,
+    TransactionInput,
+    TransactionOutpoint,
+    TransactionOutput,
+)
+
+
+def make_transaction(i: int) -> Transaction:
+    return Transaction(
+        inputs=(
+            TransactionInput(
+                previous_transaction_outpoint=TransactionOutpoint(
+                    previous_transaction_hash=b"", index=0
+                ),
+                signature=b"",
+            ),
+        ),
+        outputs=(
+            TransactionOutput(
+                value=1, recipient_public_key=i.to_bytes(48, byteorder="big")
+            ),
+        ),
+    )
+
+
+def grow_ledger(ledger: Ledger, start: int, stop: int) -> Ledger:
+    transactions = [make_transaction(i) for i in range(start, stop)]
+    return Ledger(
+        unspent_outputs=ledger.unspent_outputs.update(
+            (
+                TransactionOutpoint(
+                    previous_transaction_hash=transaction.hash(), index=0
+                ),
+                transaction.outputs[0],
+            )
+            for transaction in transactions
+        ),
+    )
+
+
+def benchmark_ledger(
+    sizes: typing.Sequence[int], *, transactions_per_size: int = 10000
+) -> None:
+    ledger = Ledger(unspent_outputs=PersistentMap())
+    for size in sizes:
+        ledger = grow_ledger(ledger, len(ledger.unspent_outputs), size)
+        transactions = [
+            make_transaction(size + i) for i in range(transactions_per_size)
+        ]
+        for transaction in transactions:
+            transaction.hash()
+        # keep the cyclic collector from rescanning the prebuilt ledger, which
+        # would otherwise dominate the measurement at millions of entries
+        gc.collect()
+        gc.freeze()
+
+        current = ledger
+        start = time.perf_counter()
+        for transaction in transactions:
+            result = update_ledger(current, transaction)
+            assert result.valid
+            current = result.new_ledger
+        elapsed = time.perf_counter() - start
+        print(
+            f"ledger size {size:>9}: {elapsed / transactions_per_size * 1e6:8.2f} us/transaction",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    benchmark_ledger([int(arg) for arg in sys.argv[1:]] or [10**3, 10**4, 10**5, 10**6])
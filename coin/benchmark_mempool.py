@@ -0,0 +1,144 @@
+import gc
+import sys
+import time
+import typing
+from coin.block import OpenBlockHeader, SealedBlock, SealedBlockHeader
+from coin.genesis import GENESIS_BLOCK
+from coin.ledger import Ledger, replay_transactions
+from coin.mempool import MAX_BLOCK_BYTES, Mempool, connect_block, try_add_transaction
+from coin.merkle import build_merkle_tree
+from coin.node_context import NodeContext
+from coin.persistent import PersistentMap
+from coin.transaction import (
+    Transaction,
+    TransactionInput,
+    TransactionOutpoint,
+    TransactionOutput,
+    make_reward_transaction,
+)
+
+INPUT_VALUE = 10
+
+
+def make_transactions(ctx: NodeContext, count: int) -> typing.List[Transaction]:
+    """
+    Transactions spending made-up outputs of the node's key with fees from 1
+    to INPUT_VALUE - 1. Signatures only cover the outputs, so one per fee
+    serves every transaction paying it.
+    """
+    public_key = ctx.node_key.public_key.to_string()
+    signatures: typing.Dict[int, typing.Tuple[TransactionOutput, bytes]] = {}
+    for fee in range(1, INPUT_VALUE):
+        output = TransactionOutput(
+            value=INPUT_VALUE - fee, recipient_public_key=public_key
+        )
+        signatures[fee] = (
+            output,
+            ctx.node_key.private_key.sign(
+                Transaction(inputs=(), outputs=(output,)).hash_for_signature
+            ),
+        )
+    transactions = []
+    for i in range(count):
+        output, signature = signatures[1 + i % (INPUT_VALUE - 1)]
+        transactions.append(
+            Transaction(
+                inputs=(
+                    TransactionInput(
+                        previous_transaction_outpoint=TransactionOutpoint(
+                            previous_transaction_hash=i.to_bytes(32, byteorder="big"),
+                            index=0,
+                        ),
+                        signature=signature,
+                    ),
+                ),
+                outputs=(output,),
+            )
+        )
+    return transactions
+
+
+def make_block(
+    ctx: NodeContext, transactions: typing.Sequence[Transaction], fees: int
+) -> SealedBlock:
+    previous_block_hash = GENESIS_BLOCK.header.block_hash
+    transaction_tree = build_merkle_tree(
+        [make_reward_transaction(ctx, previous_block_hash, fees), *transactions]
+    )
+    assert transaction_tree is not None
+    open_header = OpenBlockHeader(
+        previous_block_hash=previous_block_hash,
+        transaction_tree_hash=transaction_tree.node_hash(),
+    )
+    return SealedBlock(
+        header=SealedBlockHeader(
+            previous_block_hash=previous_block_hash,
+            transaction_tree_hash=transaction_tree.node_hash(),
+            nonce=0,
+            block_hash=open_header.hash(nonce=0),
+        ),
+        transaction_tree=transaction_tree,
+    )
+
+
+def benchmark_mempool(
+    sizes: typing.Sequence[int],
+    *,
+    block_transactions: int = 100,
+    repeats: int = 100,
+) -> None:
+    """
+    Times connect_block for a block confirming block_transactions mempool
+    transactions, at growing mempool sizes. Connecting a block should cost
+    the same whatever else is waiting in the mempool.
+    """
+    ctx = NodeContext(node_id="node")
+    public_key = ctx.node_key.public_key.to_string()
+    transactions = make_transactions(ctx, max(sizes))
+    ledger = Ledger(
+        unspent_outputs=PersistentMap(
+            (
+                transaction.inputs[0].previous_transaction_outpoint,
+                TransactionOutput(value=INPUT_VALUE, recipient_public_key=public_key),
+            )
+            for transaction in transactions
+        )
+    )
+    mempool = Mempool(ledger=ledger)
+    for size in sizes:
+        admitted = len(mempool.entries)
+        for transaction in transactions[admitted:size]:
+            mempool = try_add_transaction(
+                ctx, mempool, transaction, max_bytes=sys.maxsize
+            )
+        assert len(mempool.entries) == size
+        # the block confirms the best paying transactions, as a template would
+        confirmed = [
+            mempool.entries[transaction_hash]
+            for _, _, transaction_hash in list(mempool.priority)[:block_transactions]
+        ]
+        block = make_block(
+            ctx,
+            [entry.transaction for entry in confirmed],
+            sum(entry.fee for entry in confirmed),
+        )
+        assert sum(entry.size for entry in confirmed) <= MAX_BLOCK_BYTES
+        replay = replay_transactions(ledger, block)
+        assert replay.valid
+        gc.collect()
+        gc.freeze()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            connected = connect_block(ctx, mempool, block, replay.new_ledger)
+        elapsed = time.perf_counter() - start
+        assert len(connected.entries) == size - block_transactions
+        print(
+            f"mempool size {size:>7}: {elapsed / repeats * 1e3:8.2f} ms/block",
+            flush=True,
+        )
+    ctx.signature_verifier.close()
+
+
+if __name__ == "__main__":
+    benchmark_mempool([int(arg) for arg in sys.argv[1:]] or [1000, 4000, 16000, 64000])
@@ -0,0 +1,77 @@
+import statistics
+import sys
+import time
+import typing
+import multiprocessing as mp
+import coin.messaging as messaging
+from coin.genesis import GENESIS_BLOCK
+from coin.multiprocessing import mp_ctx
+from coin.node_context import NodeContext
+from coin.node_state import State, StartupState
+from coin.process import Process
+from coin.run_node import run_node
+
+PEER = "bench"
+# lets the node start its miners before the first request
+WARMUP = 3.0
+
+
+def benchmark_propagation(requests: int) -> None:
+    """
+    Times one hop of block relay: a peer asks a mining node for a block and
+    waits for it to arrive. The node is mining the whole time, so this is the
+    latency its loop adds while it also has to watch its miners.
+    """
+    messages_in: mp.Queue[messaging.AddressedMessage] = mp_ctx.Queue()
+    messages_out: mp.Queue[messaging.AddressedMessage] = mp_ctx.Queue()
+    result_out: mp.Queue[State] = mp_ctx.Queue()
+    node = Process(
+        target=run_node,
+        kwargs={
+            "ctx": NodeContext(node_id="node"),
+            "messages_in": messages_in,
+            "messages_out": messages_out,
+            "result_out": result_out,
+            "init_peers": [],
+            "STOP_HEIGHT": sys.maxsize,
+            "INIT_STARTUP_STATE": StartupState.SYNCED,
+        },
+    )
+    node.start()
+    time.sleep(WARMUP)
+
+    request = messaging.AddressedMessage(
+        message=messaging.GetDataMessage(
+            payload=messaging.GetDataMessage.Payload(
+                objects_requested=(GENESIS_BLOCK.header.block_hash,)
+            )
+        ),
+        sender_address=PEER,
+        recipient_address="node",
+    )
+    latencies: typing.List[float] = []
+    while len(latencies) < requests:
+        started = time.perf_counter()
+        messages_in.put(request)
+        while True:
+            response = messages_out.get()
+            # blocks the node mines in the meantime are addressed to no one,
+            # but skip anything that isn't the answer all the same
+            if isinstance(response.message, messaging.BlockMessage):
+                break
+        latencies.append(time.perf_counter() - started)
+        # spread the requests out over the node's loop iterations
+        time.sleep(0.037)
+    node.terminate()
+
+    latencies.sort()
+    print(
+        f"{requests} requests: median {statistics.median(latencies) * 1e3:.1f} ms, "
+        f"p90 {latencies[int(0.9 * (len(latencies) - 1))] * 1e3:.1f} ms, "
+        f"max {latencies[-1] * 1e3:.1f} ms",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    benchmark_propagation(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,95 @@
+import gc
+import sys
+import time
+import typing
+from coin.block import OpenBlockHeader, SealedBlock, SealedBlockHeader
+from coin.genesis import GENESIS_BLOCK
+from coin.mempool import Mempool
+from coin.merkle import build_merkle_tree
+from coin.node_context import NodeContext
+from coin.node_state import State, StartupState, genesis_chains
+from coin.persistent import PersistentMap
+from coin.sync import MAX_HEADERS, add_block_body, add_headers
+from coin.transaction import make_reward_transaction
+
+PEER = "bench"
+
+
+def make_chain(ctx: NodeContext, length: int) -> typing.List[SealedBlock]:
+    """
+    Reward-only blocks on top of genesis. Difficulty isn't part of block
+    validation, so nonce 0 is as good as any.
+    """
+    blocks = []
+    previous_block_hash = GENESIS_BLOCK.header.block_hash
+    for _ in range(length):
+        transaction_tree = build_merkle_tree(
+            [make_reward_transaction(ctx, previous_block_hash)]
+        )
+        assert transaction_tree is not None
+        open_header = OpenBlockHeader(
+            previous_block_hash=previous_block_hash,
+            transaction_tree_hash=transaction_tree.node_hash(),
+        )
+        block_hash = open_header.hash(nonce=0)
+        blocks.append(
+            SealedBlock(
+                header=SealedBlockHeader(
+                    previous_block_hash=previous_block_hash,
+                    transaction_tree_hash=transaction_tree.node_hash(),
+                    nonce=0,
+                    block_hash=block_hash,
+                ),
+                transaction_tree=transaction_tree,
+            )
+        )
+        previous_block_hash = block_hash
+    return blocks
+
+
+def benchmark_sync(length: int, *, report_every: int = 10000) -> None:
+    """
+    Feeds a chain through headers-first sync the way a peer would answer it:
+    headers in full batches, then every body in order. Accepting a block
+    should cost the same at any height, so the time per block of each slice
+    should stay flat as the chain grows.
+    """
+    ctx = NodeContext(node_id="node")
+    blocks = make_chain(ctx, length)
+    genesis = genesis_chains()
+    state = State(
+        best_head=genesis,
+        block_lookup=PersistentMap({genesis.block.header.block_hash: genesis}),
+        startup_state=StartupState.INVENTORY,
+        mempool=Mempool(ledger=genesis.get_ledger()),
+        peers=frozenset([PEER]),
+    )
+    gc.collect()
+    gc.freeze()
+
+    headers = [block.header for block in blocks]
+    start = time.perf_counter()
+    for batch_start in range(0, length, MAX_HEADERS):
+        batch_end = batch_start + MAX_HEADERS
+        state, _ = add_headers(ctx, state, headers[batch_start:batch_end])
+    print(f"headers: {time.perf_counter() - start:.2f} s", flush=True)
+
+    total_start = slice_start = time.perf_counter()
+    for height, block in enumerate(blocks, start=1):
+        state, _ = add_block_body(ctx, state, block, PEER)
+        if height % report_every == 0:
+            now = time.perf_counter()
+            print(
+                f"blocks {height - report_every + 1:>7}-{height:>7}: {(now - slice_start) / report_every * 1e6:8.2f} us/block",
+                flush=True,
+            )
+            slice_start = now
+    elapsed = time.perf_counter() - total_start
+    assert state.best_head.height == length + 1
+    assert state.startup_state == StartupState.SYNCED
+    print(f"synced {length} blocks in {elapsed:.2f} s", flush=True)
+    ctx.signature_verifier.close()
+
+
+if __name__ == "__main__":
+    benchmark_sync(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
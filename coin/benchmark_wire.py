@@ -0,0 +1,103 @@
+import pickle
+import sys
+import time
+import typing
+import coin.messaging as messaging
+from coin.block import OpenBlockHeader, SealedBlock, SealedBlockHeader
+from coin.genesis import GENESIS_BLOCK
+from coin.merkle import build_merkle_tree
+from coin.transaction import (
+    Transaction,
+    TransactionInput,
+    TransactionOutpoint,
+    TransactionOutput,
+)
+from coin.util import hash_byte_sets
+from coin.wire import decode_message, encode_message
+
+# long enough that the timings aren't dominated by timer resolution
+REPEATS = 5
+
+
+def make_transaction(i: int) -> Transaction:
+    """
+    A one-input, two-output transfer with field sizes matching real ones.
+    """
+    return Transaction(
+        inputs=(
+            TransactionInput(
+                previous_transaction_outpoint=TransactionOutpoint(
+                    previous_transaction_hash=hash_byte_sets(i.to_bytes(8, "big")),
+                    index=i % 4,
+                ),
+                signature=hash_byte_sets(b"signature", i.to_bytes(8, "big")) * 2,
+            ),
+        ),
+        outputs=(
+            TransactionOutput(value=i, recipient_public_key=bytes(48)),
+            TransactionOutput(value=1, recipient_public_key=bytes(range(48))),
+        ),
+    )
+
+
+def make_block(transactions: int) -> SealedBlock:
+    transaction_tree = build_merkle_tree(
+        make_transaction(i) for i in range(transactions)
+    )
+    assert transaction_tree is not None
+    header = OpenBlockHeader(
+        transaction_tree_hash=transaction_tree.node_hash(),
+        previous_block_hash=GENESIS_BLOCK.header.block_hash,
+    )
+    return SealedBlock(
+        header=SealedBlockHeader(
+            transaction_tree_hash=header.transaction_tree_hash,
+            previous_block_hash=header.previous_block_hash,
+            nonce=0,
+            block_hash=header.hash(0),
+        ),
+        transaction_tree=transaction_tree,
+    )
+
+
+def time_per_call(function: typing.Callable[[], typing.Any]) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        function()
+    return (time.perf_counter() - start) / REPEATS
+
+
+def benchmark_wire(sizes: typing.Sequence[int]) -> None:
+    print(
+        f"{'transactions':>12} {'format':>6} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}",
+        flush=True,
+    )
+    for transactions in sizes:
+        message = messaging.BlockMessage(
+            payload=messaging.BlockMessage.Payload(block=make_block(transactions))
+        )
+
+        pickled = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        pickle_encode = time_per_call(
+            lambda: pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        )
+        pickle_decode = time_per_call(lambda: pickle.loads(pickled))
+
+        encoded = encode_message(message)
+        wire_encode = time_per_call(lambda: encode_message(message))
+        wire_decode = time_per_call(lambda: decode_message(memoryview(encoded)))
+
+        for name, size, encode, decode in (
+            ("pickle", len(pickled), pickle_encode, pickle_decode),
+            ("wire", len(encoded), wire_encode, wire_decode),
+        ):
+            print(
+                f"{transactions:>12} {name:>6} {size:>10} {encode * 1e3:>10.1f} {decode * 1e3:>10.1f}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    benchmark_wire(
+        [int(size) for size in sys.argv[1:]] if len(sys.argv) > 1 else [1000, 10000]
+    )
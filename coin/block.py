@@ -1,7 +1,7 @@
 import typing
 from dataclasses import dataclass
 from coin.transaction import Transaction
-from coin.merkle import MerkleNode
+from coin.merkle import MerkleNode, MerkleMultiProof
 import hashlib
 
 
@@ -39,6 +39,23 @@ class SealedBlockHeader(BlockHeader):
     nonce: int
     block_hash: bytes
 
+    def validate_hash(self) -> bool:
+        open_header = OpenBlockHeader(
+            transaction_tree_hash=self.transaction_tree_hash,
+            previous_block_hash=self.previous_block_hash,
+        )
+        return open_header.hash(nonce=self.nonce) == self.block_hash
+
+    def verify_inclusion(
+        self, transaction_hashes: typing.Iterable[bytes], proof: MerkleMultiProof
+    ) -> bool:
+        """
+        Checks that the transactions are in this block without its body.
+        """
+        return self.validate_hash() and proof.verify(
+            transaction_hashes, self.transaction_tree_hash
+        )
+
 
 @dataclass(frozen=True)
 class SealedBlock(Block):
@@ -47,14 +64,12 @@ class SealedBlock(Block):
     def validate_hashes(self) -> bool:
         if not self.transaction_tree.node_hash() == self.header.transaction_tree_hash:
             return False
-        open_header = OpenBlockHeader(
-            transaction_tree_hash=self.header.transaction_tree_hash,
-            previous_block_hash=self.header.previous_block_hash,
-        )
-        if open_header.hash(nonce=self.header.nonce) == self.header.block_hash:
-            return True
-        else:
-            return False
+        return self.header.validate_hash()
+
+    def inclusion_proof(
+        self, transaction_hashes: typing.Iterable[bytes]
+    ) -> typing.Optional[MerkleMultiProof]:
+        return self.transaction_tree.multi_proof(transaction_hashes)
 
     def __repr__(self) -> str:
         return f"SealedBlock(block_hash={self.header.block_hash.hex()}, ...)"
@@ -0,0 +1,350 @@
+from __future__ import annotations
+import mmap
+import os
+import pickle
+import struct
+import typing
+from coin.block import SealedBlock, SealedBlockHeader
+from coin.ledger import Ledger
+from coin.merkle import MerkleNode
+from coin.transaction import Transaction
+from coin.wire import (
+    decode_block_header,
+    decode_transaction_tree,
+    encode_block_header,
+    encode_transaction_tree,
+)
+
+# every record is the record version and two lengths followed by the encoded
+# header and body, so headers can be read without touching the bodies. The
+# version is the layout of what is on disk, apart from the message framing's
+# WIRE_VERSION: it only changes when the header or body encoding does.
+_RECORD_VERSION = 1
+_RECORD_PREFIX = struct.Struct(">BII")
+
+# the index is an open-addressing hash table kept in a memory-mapped file: a
+# header of magic, version, capacity and count, then capacity slots of block
+# hash, segment number + 1 (0 marks an empty slot) and record offset
+_INDEX_MAGIC = b"CBIX"
+_INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct(">4sIII")
+_INDEX_SLOT = struct.Struct(">32sIQ")
+_INITIAL_INDEX_CAPACITY = 1024
+
+_SEGMENT_PREFIX = "blocks-"
+_SEGMENT_SUFFIX = ".dat"
+
+
+class BlockLocation(typing.NamedTuple):
+    segment: int
+    offset: int
+
+
+class _BlockIndex:
+    """
+    Block hash -> record location, kept at most half full.
+    """
+
+    def __init__(self, path: str, *, read_only: bool = False) -> None:
+        self.path = path
+        self.read_only = read_only
+        if not os.path.exists(path) and not read_only:
+            self._create(path, _INITIAL_INDEX_CAPACITY)
+        self._open()
+
+    @staticmethod
+    def _create(path: str, capacity: int) -> None:
+        with open(path, "wb") as index_file:
+            index_file.write(
+                _INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, capacity, 0)
+            )
+            index_file.truncate(_INDEX_HEADER.size + capacity * _INDEX_SLOT.size)
+
+    def _open(self) -> None:
+        self._file = open(self.path, "rb" if self.read_only else "r+b")
+        self._map = mmap.mmap(
+            self._file.fileno(),
+            0,
+            access=mmap.ACCESS_READ if self.read_only else mmap.ACCESS_DEFAULT,
+        )
+        magic, version, capacity, count = _INDEX_HEADER.unpack_from(self._map, 0)
+        self.capacity: int = capacity
+        self.count: int = count
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise ValueError("Not a block index", self.path)
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+    def _slots(self, block_hash: bytes) -> typing.Iterator[int]:
+        mask = self.capacity - 1
+        slot = int.from_bytes(block_hash[:8], byteorder="big") & mask
+        while True:
+            yield _INDEX_HEADER.size + slot * _INDEX_SLOT.size
+            slot = (slot + 1) & mask
+
+    def get(self, block_hash: bytes) -> typing.Optional[BlockLocation]:
+        location = self._find(block_hash)
+        if location is None and self.read_only and self._replaced():
+            # the writer grew the index into a new file since this one mapped
+            # it, so newer blocks are only in that one
+            self.close()
+            self._open()
+            location = self._find(block_hash)
+        return location
+
+    def _replaced(self) -> bool:
+        return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+
+    def _find(self, block_hash: bytes) -> typing.Optional[BlockLocation]:
+        for offset in self._slots(block_hash):
+            slot_hash, segment, record_offset = _INDEX_SLOT.unpack_from(
+                self._map, offset
+            )
+            if segment == 0:
+                return None
+            if slot_hash == block_hash:
+                return BlockLocation(segment=segment - 1, offset=record_offset)
+        raise AssertionError("unreachable")
+
+    def add(self, block_hash: bytes, location: BlockLocation) -> None:
+        if 2 * (self.count + 1) > self.capacity:
+            self._grow()
+        for offset in self._slots(block_hash):
+            slot_hash, segment, _ = _INDEX_SLOT.unpack_from(self._map, offset)
+            if segment == 0:
+                break
+            if slot_hash == block_hash:
+                return
+        _INDEX_SLOT.pack_into(
+            self._map, offset, block_hash, location.segment + 1, location.offset
+        )
+        self.count += 1
+        _INDEX_HEADER.pack_into(
+            self._map, 0, _INDEX_MAGIC, _INDEX_VERSION, self.capacity, self.count
+        )
+
+    def _entries(self) -> typing.Iterator[typing.Tuple[bytes, BlockLocation]]:
+        for slot in range(self.capacity):
+            slot_hash, segment, record_offset = _INDEX_SLOT.unpack_from(
+                self._map, _INDEX_HEADER.size + slot * _INDEX_SLOT.size
+            )
+            if segment != 0:
+                yield slot_hash, BlockLocation(
+                    segment=segment - 1, offset=record_offset
+                )
+
+    def _grow(self) -> None:
+        entries = list(self._entries())
+        grown_path = f"{self.path}.grow"
+        self._create(grown_path, 2 * self.capacity)
+        self.close()
+        os.replace(grown_path, self.path)
+        self._open()
+        for block_hash, location in entries:
+            self.add(block_hash, location)
+
+
+class BlockStore:
+    """
+    Append-only block storage: records go to numbered segment files, and a
+    memory-mapped index finds a block's record by hash. Bodies are only read
+    when a block's transaction tree is used, so the node keeps headers in
+    memory and leaves bodies to the OS page cache. A read-only store reads
+    what another process's store writes, and can't append.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        segment_size: int = 64 * 1024 * 1024,
+        read_only: bool = False,
+    ) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._index = _BlockIndex(os.path.join(path, "index.dat"), read_only=read_only)
+        segments = sorted(
+            int(name.removeprefix(_SEGMENT_PREFIX).removesuffix(_SEGMENT_SUFFIX))
+            for name in os.listdir(path)
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX)
+        )
+        self._segment = segments[-1] if len(segments) > 0 else 0
+        self._writer: typing.Optional[typing.BinaryIO] = (
+            None if read_only else open(self._segment_path(self._segment), "ab")
+        )
+
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        # a copy in another process reopens the same directory, read-only so
+        # that it never writes behind the back of the store it was copied from
+        return (_open_read_only, (self.path, self.segment_size))
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(
+            self.path, f"{_SEGMENT_PREFIX}{segment:05d}{_SEGMENT_SUFFIX}"
+        )
+
+    def __len__(self) -> int:
+        return self._index.count
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        return self._index.get(block_hash) is not None
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._index.close()
+
+    def append(self, block: SealedBlock) -> None:
+        if self._writer is None:
+            raise ValueError("Block store is read-only", self.path)
+        if block.header.block_hash in self:
+            return
+        header_bytes = encode_block_header(block.header)
+        body_bytes = encode_transaction_tree(block.transaction_tree)
+        record_size = _RECORD_PREFIX.size + len(header_bytes) + len(body_bytes)
+        offset = self._writer.tell()
+        if offset > 0 and offset + record_size > self.segment_size:
+            self._writer.close()
+            self._segment += 1
+            self._writer = open(self._segment_path(self._segment), "ab")
+            offset = 0
+        self._writer.write(
+            _RECORD_PREFIX.pack(_RECORD_VERSION, len(header_bytes), len(body_bytes))
+        )
+        self._writer.write(header_bytes)
+        self._writer.write(body_bytes)
+        # the record has to be readable before the index points at it
+        self._writer.flush()
+        self._index.add(
+            block.header.block_hash,
+            BlockLocation(segment=self._segment, offset=offset),
+        )
+
+    def _read_record(
+        self, block_hash: bytes, *, with_body: bool
+    ) -> typing.Tuple[SealedBlockHeader, typing.Optional[MerkleNode[Transaction]]]:
+        location = self._index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash)
+        with open(self._segment_path(location.segment), "rb") as segment_file:
+            segment_file.seek(location.offset)
+            _, header_size, body_size = _RECORD_PREFIX.unpack(
+                segment_file.read(_RECORD_PREFIX.size)
+            )
+            header = decode_block_header(segment_file.read(header_size))
+            if not with_body:
+                return header, None
+            return header, decode_transaction_tree(segment_file.read(body_size))
+
+    def read_header(self, block_hash: bytes) -> SealedBlockHeader:
+        header, _ = self._read_record(block_hash, with_body=False)
+        return header
+
+    def read_block(self, block_hash: bytes) -> SealedBlock:
+        header, transaction_tree = self._read_record(block_hash, with_body=True)
+        assert transaction_tree is not None
+        return SealedBlock(header=header, transaction_tree=transaction_tree)
+
+    def headers(self) -> typing.Iterator[SealedBlockHeader]:
+        """
+        Yields every stored header in the order the blocks were appended,
+        seeking past the bodies. Records that a crash left out of the index
+        are indexed again, and a record cut short ends the scan and is
+        truncated away. A read-only store leaves both to the writer.
+        """
+        for segment in range(self._segment + 1):
+            with open(
+                self._segment_path(segment), "rb" if self.read_only else "r+b"
+            ) as segment_file:
+                segment_size = os.fstat(segment_file.fileno()).st_size
+                while True:
+                    offset = segment_file.tell()
+                    prefix = segment_file.read(_RECORD_PREFIX.size)
+                    if len(prefix) == 0:
+                        break
+                    complete = len(prefix) == _RECORD_PREFIX.size
+                    if complete:
+                        version, header_size, body_size = _RECORD_PREFIX.unpack(prefix)
+                        if version != _RECORD_VERSION:
+                            raise ValueError(
+                                "Unsupported block record version", version
+                            )
+                        header_bytes = segment_file.read(header_size)
+                        record_end = (
+                            offset + _RECORD_PREFIX.size + header_size + body_size
+                        )
+                        complete = (
+                            len(header_bytes) == header_size
+                            and record_end <= segment_size
+                        )
+                    if not complete:
+                        if self._writer is None:
+                            return
+                        segment_file.truncate(offset)
+                        # the writer's idea of the end of the file is stale now
+                        self._writer.close()
+                        self._writer = open(self._segment_path(self._segment), "ab")
+                        return
+                    header = decode_block_header(header_bytes)
+                    if not self.read_only:
+                        self._index.add(
+                            header.block_hash,
+                            BlockLocation(segment=segment, offset=offset),
+                        )
+                    yield header
+                    segment_file.seek(record_end)
+
+    def stored_block(self, header: SealedBlockHeader) -> StoredBlock:
+        return StoredBlock(store=self, header=header)
+
+    def save_ledger(self, block_hash: bytes, ledger: Ledger) -> None:
+        """
+        Snapshots the ledger at block_hash so a restart doesn't have to replay
+        the chain up to it.
+        """
+        snapshot_path = os.path.join(self.path, "ledger.dat")
+        with open(f"{snapshot_path}.tmp", "wb") as snapshot_file:
+            pickle.dump((block_hash, ledger), snapshot_file)
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
+
+    def load_ledger(self) -> typing.Optional[typing.Tuple[bytes, Ledger]]:
+        snapshot_path = os.path.join(self.path, "ledger.dat")
+        if not os.path.exists(snapshot_path):
+            return None
+        with open(snapshot_path, "rb") as snapshot_file:
+            block_hash, ledger = pickle.load(snapshot_file)
+        return block_hash, ledger
+
+
+def _open_read_only(path: str, segment_size: int) -> BlockStore:
+    return BlockStore(path, segment_size=segment_size, read_only=True)
+
+
+class StoredBlock(SealedBlock):
+    """
+    A SealedBlock whose transaction tree is read from the store on every use
+    instead of being held in memory.
+    """
+
+    store: BlockStore
+
+    def __init__(self, store: BlockStore, header: SealedBlockHeader) -> None:
+        object.__setattr__(self, "store", store)
+        object.__setattr__(self, "header", header)
+
+    @property
+    def transaction_tree(self) -> MerkleNode[Transaction]:
+        return self.store.read_block(self.header.block_hash).transaction_tree
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, SealedBlock):
+            return NotImplemented
+        return self.header == other.header
+
+    def __hash__(self) -> int:
+        return hash(self.header)
@@ -1,7 +1,73 @@
+import hashlib
+import itertools
 import typing
+from dataclasses import dataclass
 from coin.block import OpenBlockHeader, SealedBlockHeader
 from coin.node_context import NodeContext
 
+NONCE_BYTES = 32
+HASH_BYTES = 32
+
+
+def difficulty_bounds(difficulty: int) -> typing.Tuple[bytes, bytes]:
+    """
+    A hash meets the difficulty when it starts with difficulty ASCII zeros,
+    i.e. when it lies in [lower, upper) as a big-endian number. Hashes and
+    bounds are all HASH_BYTES long, so bytes comparison is that numeric
+    comparison without converting the digest to an int.
+    """
+    lower = (b"0" * difficulty).ljust(HASH_BYTES, b"\x00")
+    upper = (b"0" * (difficulty - 1) + b"1").ljust(HASH_BYTES, b"\x00")
+    return lower, upper
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    header: typing.Optional[SealedBlockHeader]
+    hashes_done: int
+
+
+def search_nonces(
+    open_block_header: OpenBlockHeader,
+    difficulty: int,
+    starting_nonce: int,
+    count: int,
+) -> SearchResult:
+    """
+    Hashes count nonces from starting_nonce, reusing one nonce buffer that is
+    incremented in place and the hasher state for the header prefix.
+    """
+    prefix_hasher = hashlib.sha256()
+    prefix_hasher.update(open_block_header.transaction_tree_hash)
+    prefix_hasher.update(open_block_header.previous_block_hash)
+    copy = prefix_hasher.copy
+    lower, upper = difficulty_bounds(difficulty)
+    nonce_buffer = bytearray(starting_nonce.to_bytes(NONCE_BYTES, byteorder="big"))
+    last_byte = NONCE_BYTES - 1
+
+    hashes_done = 0
+    for _ in itertools.repeat(None, count):
+        hasher = copy()
+        hasher.update(nonce_buffer)
+        digest = hasher.digest()
+        hashes_done += 1
+        if lower <= digest < upper:
+            return SearchResult(
+                header=SealedBlockHeader(
+                    transaction_tree_hash=open_block_header.transaction_tree_hash,
+                    previous_block_hash=open_block_header.previous_block_hash,
+                    nonce=int.from_bytes(nonce_buffer, byteorder="big"),
+                    block_hash=digest,
+                ),
+                hashes_done=hashes_done,
+            )
+        index = last_byte
+        while nonce_buffer[index] == 0xFF:
+            nonce_buffer[index] = 0
+            index -= 1
+        nonce_buffer[index] += 1
+    return SearchResult(header=None, hashes_done=hashes_done)
+
 
 def find_block(
     ctx: NodeContext,
@@ -11,23 +77,32 @@ def find_block(
     reporting_interval: int = int(1e6),
     starting_nonce: int = 0,
     max_tries: int = int(1e10),
+    progress_callback: typing.Optional[typing.Callable[[int], bool]] = None,
 ) -> typing.Optional[SealedBlockHeader]:
+    """
+    progress_callback is called every reporting_interval nonces with the
+    number of nonces tried so far; returning False abandons the search.
+    """
     if difficulty < 1:
         raise ValueError("Invalid difficulty", 0)
-    target = b"0" * difficulty
-    ctx.info(f"searching for block with difficulty {difficulty}")
-    for i, nonce in enumerate(range(starting_nonce, starting_nonce + max_tries)):
-        block_hash = open_block_header.hash(nonce)
-        if block_hash.startswith(target):
-            ctx.info(f"found block {block_hash.hex()}!")
-            return SealedBlockHeader(
-                transaction_tree_hash=open_block_header.transaction_tree_hash,
-                previous_block_hash=open_block_header.previous_block_hash,
-                nonce=nonce,
-                block_hash=block_hash,
-            )
-        if i % reporting_interval == 0:
+    ctx.debug(f"searching for block with difficulty {difficulty}")
+    tried = 0
+    while tried < max_tries:
+        result = search_nonces(
+            open_block_header,
+            difficulty,
+            starting_nonce + tried,
+            min(reporting_interval, max_tries - tried),
+        )
+        tried += result.hashes_done
+        if result.header is not None:
+            ctx.info(f"found block {result.header.block_hash.hex()}!")
+            return result.header
+        if tried < max_tries:
             ctx.info(f"tried {reporting_interval} nonces")
+            if progress_callback is not None and not progress_callback(tried):
+                ctx.debug(f"abandoned search from nonce {starting_nonce}")
+                return None
     ctx.debug(
         f"failed to find block with {difficulty} in {max_tries} tries from nonce {starting_nonce}"
     )
@@ -1,25 +1,56 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
-from coin.util import FrozenDict
-from coin.merkle import dfs, LeafMerkleNode
+from coin.persistent import PersistentMap
+from coin.merkle import leaves
 from coin.block import SealedBlock
-from coin.transaction import Transaction
-from ecdsa import VerifyingKey
+from coin.transaction import Transaction, TransactionOutpoint, TransactionOutput
+from coin.verification import SignatureCheck, SignatureVerifier, SERIAL_VERIFIER
 import typing
 
 
 @dataclass(frozen=True)
 class Ledger:
-    balances: FrozenDict[bytes, int] = field(default_factory=lambda: FrozenDict())
-    previous_transactions: FrozenDict[bytes, Transaction] = field(
-        default_factory=lambda: FrozenDict()
+    # the UTXO set: only outputs that have not been spent yet are kept
+    unspent_outputs: PersistentMap[TransactionOutpoint, TransactionOutput] = field(
+        default_factory=PersistentMap
     )
 
     def copy(self) -> Ledger:
-        return Ledger(
-            balances=FrozenDict(self.balances),
-            previous_transactions=FrozenDict(self.previous_transactions),
-        )
+        # the UTXO set is persistent, so a ledger can share it freely
+        return self
+
+    def balances(self) -> typing.Dict[bytes, int]:
+        balances: typing.Dict[bytes, int] = {}
+        for output in self.unspent_outputs.values():
+            balances[output.recipient_public_key] = (
+                balances.get(output.recipient_public_key, 0) + output.value
+            )
+        return balances
+
+
+@dataclass(frozen=True)
+class BlockUndo:
+    """
+    The outputs a block took out of and added to the UTXO set, enough to
+    take the block back out of a ledger, or put it back in, without running
+    its transactions again. Outputs created and spent within the block show
+    up in neither.
+    """
+
+    spent: typing.Tuple[typing.Tuple[TransactionOutpoint, TransactionOutput], ...]
+    created: typing.Tuple[typing.Tuple[TransactionOutpoint, TransactionOutput], ...]
+
+    def connect(self, ledger: Ledger) -> Ledger:
+        unspent_outputs = ledger.unspent_outputs
+        for outpoint, _ in self.spent:
+            unspent_outputs = unspent_outputs.delete(outpoint)
+        return Ledger(unspent_outputs=unspent_outputs.update(self.created))
+
+    def disconnect(self, ledger: Ledger) -> Ledger:
+        unspent_outputs = ledger.unspent_outputs
+        for outpoint, _ in self.created:
+            unspent_outputs = unspent_outputs.delete(outpoint)
+        return Ledger(unspent_outputs=unspent_outputs.update(self.spent))
 
 
 @dataclass(frozen=True)
@@ -39,36 +70,105 @@ ValidateResult = typing.Union[SuccessfulValidateResult, FailedValidateResult]
 BLOCK_REWARD = 25
 
 
-def update_ledger(
+OutputLookup = typing.Callable[
+    [TransactionOutpoint], typing.Optional[TransactionOutput]
+]
+
+
+def created_outputs(
+    transaction: Transaction,
+) -> typing.Iterator[typing.Tuple[TransactionOutpoint, TransactionOutput]]:
+    transaction_hash = transaction.hash()
+    for index, transaction_output in enumerate(transaction.outputs):
+        yield TransactionOutpoint(
+            previous_transaction_hash=transaction_hash, index=index
+        ), transaction_output
+
+
+def transaction_signature_checks(
+    transaction: Transaction, lookup: OutputLookup
+) -> typing.List[SignatureCheck]:
+    """
+    Inputs whose outpoint can't be resolved are skipped here and rejected
+    when the transaction is applied.
+    """
+    if transaction.is_coinbase:
+        return []
+    transaction_hash = transaction.hash()
+    checks = []
+    for index, transaction_input in enumerate(transaction.inputs):
+        spent_output = lookup(transaction_input.previous_transaction_outpoint)
+        if spent_output is not None:
+            checks.append(
+                SignatureCheck(
+                    public_key=spent_output.recipient_public_key,
+                    signature=transaction_input.signature,
+                    message=transaction.hash_for_signature,
+                    cache_key=(transaction_hash, index),
+                )
+            )
+    return checks
+
+
+def transaction_fee(transaction: Transaction, lookup: OutputLookup) -> int:
+    """
+    What a transaction spends minus what it pays out. Inputs whose outpoint
+    can't be resolved count as nothing; the transaction is rejected for them
+    when it is applied.
+    """
+    if transaction.is_coinbase:
+        return 0
+    total_spent = 0
+    for transaction_input in transaction.inputs:
+        spent_output = lookup(transaction_input.previous_transaction_outpoint)
+        if spent_output is not None:
+            total_spent += spent_output.value
+    return total_spent - sum(output.value for output in transaction.outputs)
+
+
+def block_fees(start_ledger: Ledger, transactions: typing.Sequence[Transaction]) -> int:
+    """
+    The fees of a block's transactions, which its reward transaction may
+    claim on top of BLOCK_REWARD.
+    """
+    block_outputs: typing.Dict[TransactionOutpoint, TransactionOutput] = {}
+
+    def lookup(outpoint: TransactionOutpoint) -> typing.Optional[TransactionOutput]:
+        block_output = block_outputs.get(outpoint)
+        if block_output is not None:
+            return block_output
+        return start_ledger.unspent_outputs.get(outpoint)
+
+    fees = 0
+    for transaction in transactions:
+        fees += transaction_fee(transaction, lookup)
+        block_outputs.update(created_outputs(transaction))
+    return fees
+
+
+def apply_transaction(
     starting_ledger: Ledger,
     transaction: Transaction,
+    reward: int = BLOCK_REWARD,
 ) -> ValidateResult:
+    """
+    Moves value through the UTXO set without checking signatures, which the
+    caller is expected to have verified already. A reward transaction may
+    create up to reward.
+    """
+    unspent_outputs = starting_ledger.unspent_outputs
 
     total_available = 0
-    keys_to_drain = []
     if transaction.is_coinbase:
-        total_available = BLOCK_REWARD
+        total_available = reward
     else:
         for transaction_input in transaction.inputs:
-            previous_hash = (
-                transaction_input.previous_transaction_outpoint.previous_transaction_hash
-            )
-            if previous_hash not in starting_ledger.previous_transactions:
-                return FailedValidateResult(message="Unknown previous hash")
-            previous_transaction = starting_ledger.previous_transactions[previous_hash]
-            previous_outpoint = previous_transaction.outputs[
-                transaction_input.previous_transaction_outpoint.index
-            ]
-            pubkey = previous_outpoint.recipient_public_key
-            total_available += starting_ledger.balances[pubkey]
-            if pubkey not in keys_to_drain:
-                keys_to_drain.append(pubkey)
-            verifying_key = VerifyingKey.from_string(pubkey)
-            signature_valid = verifying_key.verify(
-                transaction_input.signature, transaction.hash_for_signature
-            )
-            if not signature_valid:
-                return FailedValidateResult(message="Bad transaction signature")
+            outpoint = transaction_input.previous_transaction_outpoint
+            spent_output = unspent_outputs.get(outpoint)
+            if spent_output is None:
+                return FailedValidateResult(message="Unknown or spent outpoint")
+            total_available += spent_output.value
+            unspent_outputs = unspent_outputs.delete(outpoint)
 
     total_transferred = 0
     for transaction_output in transaction.outputs:
@@ -79,52 +179,94 @@ def update_ledger(
             message="Tried to transfer more than existing balance"
         )
 
-    new_balances = dict(starting_ledger.balances)
+    for outpoint, transaction_output in created_outputs(transaction):
+        if outpoint in unspent_outputs:
+            return FailedValidateResult(message="Duplicate transaction output")
+        unspent_outputs = unspent_outputs.set(outpoint, transaction_output)
 
-    transfer_needed = total_transferred
-    for key_to_drain in keys_to_drain:
-        drain = min(total_transferred, new_balances[key_to_drain])
-        new_balances[key_to_drain] -= drain
-        transfer_needed -= drain
-        assert transfer_needed >= 0
-        assert new_balances[key_to_drain] >= 0
-        if transfer_needed == 0:
-            break
-    assert transaction.is_coinbase or (transfer_needed == 0)
+    return SuccessfulValidateResult(new_ledger=Ledger(unspent_outputs=unspent_outputs))
 
-    for transaction_output in transaction.outputs:
-        new_balances[transaction_output.recipient_public_key] = (
-            new_balances.get(transaction_output.recipient_public_key, 0)
-            + transaction_output.value
-        )
 
-    return SuccessfulValidateResult(
-        new_ledger=Ledger(
-            balances=FrozenDict(new_balances),
-            previous_transactions=FrozenDict(
-                {
-                    **dict(starting_ledger.previous_transactions),
-                    transaction.hash(): transaction,
-                }
-            ),
-        )
+def update_ledger(
+    starting_ledger: Ledger,
+    transaction: Transaction,
+    verifier: SignatureVerifier = SERIAL_VERIFIER,
+) -> ValidateResult:
+    checks = transaction_signature_checks(
+        transaction, starting_ledger.unspent_outputs.get
     )
+    if not verifier.verify_all(checks):
+        return FailedValidateResult(message="Bad transaction signature")
+    return apply_transaction(starting_ledger, transaction)
 
 
 def validate_transactions(
     start_ledger: Ledger,
     block: SealedBlock,
+    verifier: SignatureVerifier = SERIAL_VERIFIER,
 ) -> ValidateResult:
+    transactions = [leaf.payload for leaf in leaves(block.transaction_tree)]
+
+    # outputs created earlier in the block can be spent later in it, so the
+    # signature stage needs to resolve them before any of them are applied
+    block_outputs: typing.Dict[TransactionOutpoint, TransactionOutput] = {}
+
+    def lookup(outpoint: TransactionOutpoint) -> typing.Optional[TransactionOutput]:
+        block_output = block_outputs.get(outpoint)
+        if block_output is not None:
+            return block_output
+        return start_ledger.unspent_outputs.get(outpoint)
+
+    checks: typing.List[SignatureCheck] = []
+    for i, transaction in enumerate(transactions):
+        if transaction.is_coinbase != (i == 0):
+            return FailedValidateResult(
+                message="Reward transaction must be first in the block"
+            )
+        checks.extend(transaction_signature_checks(transaction, lookup))
+        block_outputs.update(created_outputs(transaction))
+
+    if not verifier.verify_all(checks):
+        return FailedValidateResult(message="Bad transaction signature")
+
+    reward = BLOCK_REWARD + block_fees(start_ledger, transactions)
+    ledger = start_ledger
+    for transaction in transactions:
+        result = apply_transaction(ledger, transaction, reward)
+        if not result.valid:
+            return result
+        ledger = result.new_ledger
+    return SuccessfulValidateResult(new_ledger=ledger)
+
+
+def replay_transactions(start_ledger: Ledger, block: SealedBlock) -> ValidateResult:
+    """
+    Applies a block that was already validated, e.g. one read back from disk,
+    without checking its signatures again.
+    """
+    transactions = [leaf.payload for leaf in leaves(block.transaction_tree)]
+    reward = BLOCK_REWARD + block_fees(start_ledger, transactions)
     ledger = start_ledger
-    for i, node in enumerate(dfs(block.transaction_tree)):
-        if not isinstance(node, LeafMerkleNode):
-            continue
-        transaction = node.payload
-        valid = transaction.is_coinbase == (i == 0)
-        if not valid:
-            assert False
-        result = update_ledger(ledger, transaction)
+    for transaction in transactions:
+        result = apply_transaction(ledger, transaction, reward)
         if not result.valid:
             return result
         ledger = result.new_ledger
     return SuccessfulValidateResult(new_ledger=ledger)
+
+
+def block_undo(start_ledger: Ledger, block: SealedBlock) -> BlockUndo:
+    """
+    Records what a block that is valid on start_ledger changes in it.
+    """
+    spent = []
+    created: typing.Dict[TransactionOutpoint, TransactionOutput] = {}
+    for leaf in leaves(block.transaction_tree):
+        transaction = leaf.payload
+        if not transaction.is_coinbase:
+            for transaction_input in transaction.inputs:
+                outpoint = transaction_input.previous_transaction_outpoint
+                if created.pop(outpoint, None) is None:
+                    spent.append((outpoint, start_ledger.unspent_outputs[outpoint]))
+        created.update(created_outputs(transaction))
+    return BlockUndo(spent=tuple(spent), created=tuple(created.items()))
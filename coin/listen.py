@@ -1,3 +1,4 @@
+import time
 import typing
 from dataclasses import dataclass, replace
 from coin.node_context import NodeContext
@@ -6,8 +7,17 @@ from coin.node_state import (
     State,
     StartupState,
     Chains,
+    block_locator,
+    blocks_after,
     try_add_block,
-    try_add_transaction,
+)
+from coin.relay import receive_transaction, request_transactions, send_transactions
+from coin.sync import (
+    MAX_HEADERS,
+    add_block_body,
+    add_headers,
+    headers_after,
+    request_headers,
 )
 
 
@@ -18,30 +28,25 @@ class ListenResult:
     addressed: typing.Tuple[messaging.AddressedMessage, ...] = tuple()
 
 
-def find_inventory(head: Chains, header_hash: bytes) -> typing.Optional[Chains]:
-    if head.block.header.block_hash == header_hash:
-        return head
-    elif head.parent is not None:
-        return find_inventory(head.parent, header_hash)
-    else:
+def find_inventory(state: State, header_hash: bytes) -> typing.Optional[Chains]:
+    chains = state.block_lookup.get(header_hash)
+    if chains is None or not state.best_head.contains(chains):
         return None
+    return chains
 
 
 def accumulate_inventories(
-    init_head: Chains,
+    head: Chains,
+    shared_block: Chains,
     stopping_hash: typing.Optional[bytes],
     *,
     MAX_INVENTORIES: int = 500,
 ) -> typing.Tuple[bytes, ...]:
     inventories = []
-    current_head: typing.Optional[Chains] = init_head
-    for i in range(MAX_INVENTORIES):
-        if current_head is None:
-            break
-        if current_head.block.header.block_hash == stopping_hash:
+    for chains in blocks_after(head, shared_block, MAX_INVENTORIES):
+        inventories.append(chains.block.header.block_hash)
+        if chains.block.header.block_hash == stopping_hash:
             break
-        inventories.append(current_head.block.header.block_hash)
-        current_head = current_head.parent
     return tuple(inventories)
 
 
@@ -57,6 +62,7 @@ def listen(
     ctx: NodeContext,
     state: State,
     message: messaging.Message,
+    sender_address: messaging.Address,
 ) -> typing.Optional[ListenResult]:
     if isinstance(message, messaging.VersionAckMessage):
 
@@ -67,12 +73,7 @@ def listen(
         return ListenResult(
             new_state=replace(state, startup_state=StartupState.INVENTORY),
             responses=(
-                messaging.GetBlocksMessage(
-                    payload=messaging.GetBlocksMessage.Payload(
-                        header_hashes=(state.best_head.block.header.block_hash,),
-                        stopping_hash=None,
-                    )
-                ),
+                request_headers(block_locator(state.best_head)),
                 messaging.GetAddrMessage(),
             ),
         )
@@ -85,7 +86,7 @@ def listen(
 
         for header_hash in message.payload.header_hashes:
             shared_block = None
-            shared_block = find_inventory(state.best_head, header_hash)
+            shared_block = find_inventory(state, header_hash)
             if shared_block is not None:
                 break
 
@@ -94,7 +95,7 @@ def listen(
             return None
 
         inventories = accumulate_inventories(
-            shared_block, message.payload.stopping_hash
+            state.best_head, shared_block, message.payload.stopping_hash
         )
 
         return ListenResult(
@@ -109,6 +110,22 @@ def listen(
 
     elif isinstance(message, messaging.InventoryMessage):
 
+        if len(message.payload.transaction_hashes) > 0:
+            # the mempool follows the best head, so transactions wait until
+            # the chain has caught up
+            if state.startup_state != StartupState.SYNCED:
+                return None
+            new_state, request = request_transactions(
+                state,
+                sender_address,
+                message.payload.transaction_hashes,
+                time.monotonic(),
+            )
+            return ListenResult(
+                new_state=new_state,
+                responses=(request,) if request is not None else (),
+            )
+
         if state.startup_state != StartupState.INVENTORY:
             log_wrong_state(ctx, message.message_type, state.startup_state)
             return None
@@ -141,18 +158,51 @@ def listen(
             block = state.block_lookup.get(header_hash)
             if block is not None:
                 blocks_to_send.append(block.block)
+        block_messages = tuple(
+            messaging.BlockMessage(payload=messaging.BlockMessage.Payload(block=block))
+            for block in blocks_to_send
+        )
+
+        if len(message.payload.transactions_requested) == 0:
+            return ListenResult(responses=block_messages)
+        new_state, transaction_messages = send_transactions(
+            state, sender_address, message.payload.transactions_requested
+        )
+        return ListenResult(
+            new_state=new_state, responses=(*block_messages, *transaction_messages)
+        )
+
+    elif isinstance(message, messaging.GetHeadersMessage):
 
         return ListenResult(
             responses=(
-                tuple(
-                    messaging.BlockMessage(
-                        payload=messaging.BlockMessage.Payload(block=block)
+                messaging.HeadersMessage(
+                    payload=messaging.HeadersMessage.Payload(
+                        headers=headers_after(
+                            state,
+                            message.payload.header_hashes,
+                            message.payload.stopping_hash,
+                        )
                     )
-                    for block in blocks_to_send
-                )
+                ),
             )
         )
 
+    elif isinstance(message, messaging.HeadersMessage):
+
+        headers = message.payload.headers
+        new_state, requests = add_headers(ctx, state, headers)
+        return ListenResult(
+            new_state=new_state,
+            # a full batch means the peer has more
+            responses=(
+                (request_headers((headers[-1].block_hash,)),)
+                if len(headers) == MAX_HEADERS
+                else ()
+            ),
+            addressed=tuple(requests),
+        )
+
     elif isinstance(message, messaging.BlockMessage):
         if message.payload.block.header.block_hash in state.block_lookup:
             ctx.info(
@@ -160,13 +210,20 @@ def listen(
             )
             return None
 
+        if message.payload.block.header.block_hash in state.sync.headers:
+            new_state, requests = add_block_body(
+                ctx, state, message.payload.block, sender_address
+            )
+            return ListenResult(new_state=new_state, addressed=tuple(requests))
+
         return ListenResult(new_state=try_add_block(ctx, state, message.payload.block))
 
     elif isinstance(message, messaging.TransactionMessage):
-        new_mempool = try_add_transaction(
-            ctx, state.mempool, message.payload.transaction
+        return ListenResult(
+            new_state=receive_transaction(
+                ctx, state, sender_address, message.payload.transaction
+            )
         )
-        return ListenResult(new_state=replace(state, mempool=new_mempool))
     elif isinstance(message, messaging.GetAddrMessage):
         return ListenResult(
             responses=(
@@ -198,5 +255,36 @@ def listen(
                 for peer in new_peers
             ),
         )
+    elif isinstance(message, messaging.GetMerkleProofMessage):
+        chains = state.block_lookup.get(message.payload.block_hash)
+        if chains is None:
+            ctx.info(
+                f"Got proof request for unknown block {message.payload.block_hash!r}"
+            )
+            return None
+        proof = chains.block.inclusion_proof(message.payload.transaction_hashes)
+        if proof is None:
+            ctx.info("Got proof request for transactions not in the block")
+            return None
+
+        return ListenResult(
+            responses=(
+                messaging.MerkleProofMessage(
+                    payload=messaging.MerkleProofMessage.Payload(
+                        header=chains.block.header,
+                        transaction_hashes=message.payload.transaction_hashes,
+                        proof=proof,
+                    )
+                ),
+            )
+        )
+
+    elif isinstance(message, messaging.MerkleProofMessage):
+        # full nodes never ask for proofs, but check what arrives anyway
+        if not message.payload.header.verify_inclusion(
+            message.payload.transaction_hashes, message.payload.proof
+        ):
+            ctx.warning("invalid merkle proof received")
+        return ListenResult()
     else:
         raise ValueError("Unhandled message type", message)
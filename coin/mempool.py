@@ -0,0 +1,427 @@
+from __future__ import annotations
+import collections
+from dataclasses import dataclass, field, replace
+import time
+import typing
+from coin.block import SealedBlock
+from coin.ledger import (
+    BLOCK_REWARD,
+    FailedValidateResult,
+    Ledger,
+    apply_transaction,
+    created_outputs,
+    update_ledger,
+)
+from coin.merkle import leaves
+from coin.node_context import NodeContext
+from coin.persistent import PersistentMap, PersistentSortedSet
+from coin.transaction import Transaction, TransactionOutpoint, TransactionOutput
+from coin.wire import encode_transaction
+
+# how much of a block the template builder fills with mempool transactions,
+# besides the reward transaction
+MAX_BLOCK_BYTES = 1024 * 1024
+MAX_BLOCK_TRANSACTIONS = 4096
+
+# encoded transaction bytes the mempool holds before it evicts the lowest
+# priority transactions
+MAX_MEMPOOL_BYTES = 16 * 1024 * 1024
+# a replacement may push out at most this many transactions, descendants
+# included
+MAX_REPLACED = 100
+# seconds a transaction may wait in the mempool before it is dropped
+MEMPOOL_EXPIRY = 24 * 60 * 60.0
+# how often a node looks for expired transactions
+EXPIRY_CHECK_INTERVAL = 60.0
+
+# (negated fee rate, sequence, transaction hash): sorts the best paying
+# transactions first, and among equals the earliest
+PriorityKey = typing.Tuple[float, int, bytes]
+
+
+@dataclass(frozen=True)
+class MempoolEntry:
+    transaction: Transaction
+    # arrival order; a transaction always arrives after the ones it spends
+    sequence: int
+    # the outputs this transaction consumed, so it can be rolled back out of
+    # the mempool ledger without re-deriving anything
+    spent_outputs: typing.Tuple[
+        typing.Tuple[TransactionOutpoint, TransactionOutput], ...
+    ]
+    fee: int
+    # encoded size in bytes
+    size: int
+    # time.monotonic() when the transaction first entered the mempool
+    added_at: float
+
+    @property
+    def fee_rate(self) -> float:
+        return self.fee / self.size
+
+    @property
+    def priority_key(self) -> PriorityKey:
+        return (-self.fee_rate, self.sequence, self.transaction.hash())
+
+
+@dataclass(frozen=True)
+class Mempool:
+    # the best head's ledger with every mempool transaction applied
+    ledger: Ledger
+    entries: PersistentMap[bytes, MempoolEntry] = field(default_factory=PersistentMap)
+    next_sequence: int = 0
+    # every entry's priority_key, in order
+    priority: PersistentSortedSet[PriorityKey] = field(
+        default_factory=PersistentSortedSet
+    )
+    # outpoint -> hash of the mempool transaction spending it
+    spenders: PersistentMap[TransactionOutpoint, bytes] = field(
+        default_factory=PersistentMap
+    )
+    # total size of the entries
+    size: int = 0
+    # transactions dropped to stay within the byte budget, for waiting too
+    # long, and for a replacement that paid more, including the descendants
+    # that went with them
+    evicted: int = 0
+    expired: int = 0
+    replaced: int = 0
+
+    def sorted_entries(self) -> typing.List[MempoolEntry]:
+        return sorted(self.entries.values(), key=lambda entry: entry.sequence)
+
+    def transactions(self) -> typing.List[Transaction]:
+        return [entry.transaction for entry in self.sorted_entries()]
+
+
+def _admit(
+    ctx: NodeContext, mempool: Mempool, transaction: Transaction, added_at: float
+) -> typing.Union[Mempool, FailedValidateResult]:
+    if transaction.is_coinbase:
+        return FailedValidateResult(message="Reward transactions are not relayed")
+    transaction_hash = transaction.hash()
+    if transaction_hash in mempool.entries:
+        return FailedValidateResult(message="Already in mempool")
+    conflicts = {
+        mempool.spenders[transaction_input.previous_transaction_outpoint]
+        for transaction_input in transaction.inputs
+        if transaction_input.previous_transaction_outpoint in mempool.spenders
+    }
+    if len(conflicts) > 0:
+        return _replace(ctx, mempool, transaction, added_at, conflicts)
+    result = update_ledger(mempool.ledger, transaction, ctx.signature_verifier)
+    if not result.valid:
+        return result
+    spent_outputs = tuple(
+        (
+            transaction_input.previous_transaction_outpoint,
+            mempool.ledger.unspent_outputs[
+                transaction_input.previous_transaction_outpoint
+            ],
+        )
+        for transaction_input in transaction.inputs
+    )
+    entry = MempoolEntry(
+        transaction=transaction,
+        sequence=mempool.next_sequence,
+        spent_outputs=spent_outputs,
+        fee=sum(output.value for _, output in spent_outputs)
+        - sum(output.value for output in transaction.outputs),
+        size=len(encode_transaction(transaction)),
+        added_at=added_at,
+    )
+    return replace(
+        mempool,
+        ledger=result.new_ledger,
+        entries=mempool.entries.set(transaction_hash, entry),
+        next_sequence=mempool.next_sequence + 1,
+        priority=mempool.priority.add(entry.priority_key),
+        spenders=mempool.spenders.update(
+            (outpoint, transaction_hash) for outpoint, _ in spent_outputs
+        ),
+        size=mempool.size + entry.size,
+    )
+
+
+def _replace(
+    ctx: NodeContext,
+    mempool: Mempool,
+    transaction: Transaction,
+    added_at: float,
+    conflicts: typing.AbstractSet[bytes],
+) -> typing.Union[Mempool, FailedValidateResult]:
+    """
+    Admits a transaction that double-spends mempool transactions in their
+    place, if it pays more in total than they and their descendants do, and
+    a higher fee rate than each of them.
+    """
+    without_conflicts, replaced_hashes = _evict(mempool, conflicts)
+    if len(replaced_hashes) > MAX_REPLACED:
+        return FailedValidateResult(message="Replaces too many transactions")
+    result = _admit(ctx, without_conflicts, transaction, added_at)
+    if isinstance(result, FailedValidateResult):
+        return result
+    entry = result.entries[transaction.hash()]
+    replaced_fee = sum(
+        mempool.entries[replaced_hash].fee for replaced_hash in replaced_hashes
+    )
+    if entry.fee <= replaced_fee or any(
+        entry.fee_rate <= mempool.entries[conflict].fee_rate for conflict in conflicts
+    ):
+        return FailedValidateResult(
+            message="Double spend doesn't pay more than what it replaces"
+        )
+    ctx.info(f"replaced {len(replaced_hashes)} mempool transactions")
+    return replace(result, replaced=result.replaced + len(replaced_hashes))
+
+
+def try_add_transaction(
+    ctx: NodeContext,
+    mempool: Mempool,
+    transaction: Transaction,
+    *,
+    max_bytes: int = MAX_MEMPOOL_BYTES,
+) -> Mempool:
+    result = _admit(ctx, mempool, transaction, time.monotonic())
+    if isinstance(result, FailedValidateResult):
+        ctx.warning(f"failed to add transaction to mempool: {result.message}")
+        return mempool
+    return trim_mempool(ctx, result, max_bytes)
+
+
+def trim_mempool(ctx: NodeContext, mempool: Mempool, max_bytes: int) -> Mempool:
+    """
+    Evicts the lowest priority transactions, and whatever spends them, until
+    the mempool fits in max_bytes.
+    """
+    excess = mempool.size - max_bytes
+    if excess <= 0:
+        return mempool
+    lowest: typing.Set[bytes] = set()
+    for _, _, transaction_hash in reversed(mempool.priority):
+        if excess <= 0:
+            break
+        lowest.add(transaction_hash)
+        excess -= mempool.entries[transaction_hash].size
+    mempool, evicted = _evict(mempool, lowest)
+    ctx.info(f"mempool full, evicted {len(evicted)} transactions")
+    return replace(mempool, evicted=mempool.evicted + len(evicted))
+
+
+def expire_transactions(
+    ctx: NodeContext,
+    mempool: Mempool,
+    now: float,
+    *,
+    max_age: float = MEMPOOL_EXPIRY,
+) -> Mempool:
+    """
+    Drops transactions that have waited longer than max_age, along with
+    whatever spends them.
+    """
+    expired_hashes = {
+        transaction_hash
+        for transaction_hash, entry in mempool.entries.items()
+        if now - entry.added_at > max_age
+    }
+    if len(expired_hashes) == 0:
+        return mempool
+    mempool, expired = _evict(mempool, expired_hashes)
+    ctx.info(f"expired {len(expired)} mempool transactions")
+    return replace(mempool, expired=mempool.expired + len(expired))
+
+
+def _evict(
+    mempool: Mempool, evicted_hashes: typing.AbstractSet[bytes]
+) -> typing.Tuple[Mempool, typing.Set[bytes]]:
+    """
+    Removes the given transactions and everything in the mempool that spends
+    their outputs, undoing their effect on the mempool ledger.
+    """
+    doomed_hashes: typing.Set[bytes] = set()
+    # the spenders index leads from each transaction straight to its children
+    stack = [
+        transaction_hash
+        for transaction_hash in evicted_hashes
+        if transaction_hash in mempool.entries
+    ]
+    while len(stack) > 0:
+        transaction_hash = stack.pop()
+        if transaction_hash in doomed_hashes:
+            continue
+        doomed_hashes.add(transaction_hash)
+        for outpoint, _ in created_outputs(
+            mempool.entries[transaction_hash].transaction
+        ):
+            spender = mempool.spenders.get(outpoint)
+            if spender is not None:
+                stack.append(spender)
+    # parents always precede their children in arrival order, so undoing in
+    # reverse arrival order takes children out first
+    doomed = sorted(
+        (mempool.entries[transaction_hash] for transaction_hash in doomed_hashes),
+        key=lambda entry: entry.sequence,
+    )
+
+    unspent_outputs = mempool.ledger.unspent_outputs
+    entries = mempool.entries
+    spenders = mempool.spenders
+    priority = mempool.priority
+    size = mempool.size
+    for entry in reversed(doomed):
+        for outpoint, _ in created_outputs(entry.transaction):
+            unspent_outputs = unspent_outputs.delete(outpoint)
+        unspent_outputs = unspent_outputs.update(entry.spent_outputs)
+        for outpoint, _ in entry.spent_outputs:
+            spenders = spenders.delete(outpoint)
+        entries = entries.delete(entry.transaction.hash())
+        priority = priority.discard(entry.priority_key)
+        size -= entry.size
+    return (
+        replace(
+            mempool,
+            ledger=Ledger(unspent_outputs=unspent_outputs),
+            entries=entries,
+            priority=priority,
+            spenders=spenders,
+            size=size,
+        ),
+        doomed_hashes,
+    )
+
+
+def rebuild_mempool(
+    ctx: NodeContext,
+    mempool: Mempool,
+    ledger: Ledger,
+    disconnected_blocks: typing.Sequence[SealedBlock] = (),
+    *,
+    max_bytes: int = MAX_MEMPOOL_BYTES,
+) -> Mempool:
+    """
+    Re-admits the transactions of disconnected blocks, oldest first, and then
+    the old mempool's, against a new head's ledger. Anything the new chain
+    already confirmed or conflicts with drops out.
+    """
+    new_mempool = Mempool(
+        ledger=ledger,
+        next_sequence=mempool.next_sequence,
+        evicted=mempool.evicted,
+        expired=mempool.expired,
+        replaced=mempool.replaced,
+    )
+    now = time.monotonic()
+    candidates = [
+        (leaf.payload, now)
+        for block in disconnected_blocks
+        for leaf in leaves(block.transaction_tree)
+        if not leaf.payload.is_coinbase
+    ] + [(entry.transaction, entry.added_at) for entry in mempool.sorted_entries()]
+    for transaction, added_at in candidates:
+        result = _admit(ctx, new_mempool, transaction, added_at)
+        if not isinstance(result, FailedValidateResult):
+            new_mempool = result
+    return trim_mempool(ctx, new_mempool, max_bytes)
+
+
+def connect_block(
+    ctx: NodeContext, mempool: Mempool, block: SealedBlock, ledger: Ledger
+) -> Mempool:
+    """
+    Moves the mempool from the old best head onto block, its child whose
+    ledger is given. Confirmed transactions leave the mempool without touching
+    the mempool ledger, since their effects are already in it; transactions
+    from elsewhere evict whatever they conflict with and are then applied.
+    """
+    for leaf in leaves(block.transaction_tree):
+        transaction = leaf.payload
+        transaction_hash = transaction.hash()
+        entry = mempool.entries.get(transaction_hash)
+        if entry is not None:
+            spenders = mempool.spenders
+            for outpoint, _ in entry.spent_outputs:
+                spenders = spenders.delete(outpoint)
+            mempool = replace(
+                mempool,
+                entries=mempool.entries.delete(transaction_hash),
+                priority=mempool.priority.discard(entry.priority_key),
+                spenders=spenders,
+                size=mempool.size - entry.size,
+            )
+            continue
+
+        if not transaction.is_coinbase:
+            conflicts = {
+                mempool.spenders[transaction_input.previous_transaction_outpoint]
+                for transaction_input in transaction.inputs
+                if transaction_input.previous_transaction_outpoint in mempool.spenders
+            }
+            if len(conflicts) > 0:
+                mempool, evicted = _evict(mempool, conflicts)
+                ctx.info(f"evicted {len(evicted)} conflicting mempool transactions")
+
+        # the block was validated against the head's ledger already, fees
+        # included, and its reward transaction can't be priced against the
+        # mempool ledger, so it is taken at its word
+        reward = (
+            sum(output.value for output in transaction.outputs)
+            if transaction.is_coinbase
+            else BLOCK_REWARD
+        )
+        result = apply_transaction(mempool.ledger, transaction, reward)
+        if not result.valid:
+            ctx.warning(f"mempool out of step with block, rebuilding: {result.message}")
+            return rebuild_mempool(ctx, mempool, ledger)
+        mempool = replace(mempool, ledger=result.new_ledger)
+    return mempool
+
+
+def select_transactions(
+    mempool: Mempool,
+    *,
+    max_bytes: int = MAX_BLOCK_BYTES,
+    max_transactions: int = MAX_BLOCK_TRANSACTIONS,
+) -> typing.List[MempoolEntry]:
+    """
+    Picks transactions for the next block by fee rate until it is full. A
+    transaction that spends another mempool transaction's output waits until
+    that one is picked, so parents always come before their children; one
+    that doesn't fit is skipped along with its descendants, and smaller ones
+    after it may still get in.
+    """
+    selected: typing.List[MempoolEntry] = []
+    selected_hashes: typing.Set[bytes] = set()
+    # transaction hash -> mempool children waiting for it to be picked
+    waiting: typing.Dict[bytes, typing.List[MempoolEntry]] = collections.defaultdict(
+        list
+    )
+    total_size = 0
+
+    def missing_parent(entry: MempoolEntry) -> typing.Optional[bytes]:
+        for transaction_input in entry.transaction.inputs:
+            parent_hash = (
+                transaction_input.previous_transaction_outpoint.previous_transaction_hash
+            )
+            if parent_hash in mempool.entries and parent_hash not in selected_hashes:
+                return parent_hash
+        return None
+
+    for _, _, transaction_hash in mempool.priority:
+        if len(selected) >= max_transactions:
+            break
+        ready = [mempool.entries[transaction_hash]]
+        while len(ready) > 0 and len(selected) < max_transactions:
+            entry = ready.pop()
+            parent_hash = missing_parent(entry)
+            if parent_hash is not None:
+                waiting[parent_hash].append(entry)
+                continue
+            if total_size + entry.size > max_bytes:
+                continue
+            entry_hash = entry.transaction.hash()
+            selected.append(entry)
+            selected_hashes.add(entry_hash)
+            total_size += entry.size
+            # best paying first, as they were queued
+            ready.extend(reversed(waiting.pop(entry_hash, [])))
+    return selected
@@ -2,7 +2,7 @@ from __future__ import annotations
 from functools import cache
 import abc
 import typing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from coin.util import hash_byte_sets
 
 
@@ -24,6 +24,14 @@ class MerkleNode(abc.ABC, typing.Generic[P]):
     def node_hash(self) -> bytes:
         pass
 
+    def inclusion_proof(self, leaf_hash: bytes) -> typing.Optional[MerkleProof]:
+        return merkle_proof(self, leaf_hash)
+
+    def multi_proof(
+        self, leaf_hashes: typing.Iterable[bytes]
+    ) -> typing.Optional[MerkleMultiProof]:
+        return merkle_multi_proof(self, leaf_hashes)
+
     def __str__(self) -> str:
         return f"{self.height} {str(self.node_hash())}"
 
@@ -54,18 +62,30 @@ class LeafMerkleNode(MerkleNode[P], typing.Generic[P]):
 class ChildMerkleNode(MerkleNode[P], typing.Generic[P]):
     parent_a: MerkleNode[P]
     parent_b: MerkleNode[P]
+    height: int = field(init=False)
 
-    @cache
-    def node_hash(self) -> bytes:
-        return hash_byte_sets(self.parent_a.node_hash(), self.parent_b.node_hash())
-
-    @property
-    def height(self) -> typing.Optional[int]:  # type: ignore
-        return 1 + max(
-            self.parent_a.height if self.parent_a.height is not None else 0,
-            self.parent_b.height if self.parent_b.height is not None else 0,
+    def __post_init__(self) -> None:
+        object.__setattr__(
+            self, "height", 1 + max(self.parent_a.height, self.parent_b.height)
         )
 
+    def node_hash(self) -> bytes:
+        # memoized on the instance rather than through functools.cache, which
+        # would keep every node alive and hash the whole subtree per lookup
+        node_hash: typing.Optional[bytes] = self.__dict__.get("_node_hash")
+        if node_hash is None:
+            node_hash = hash_byte_sets(
+                self.parent_a.node_hash(), self.parent_b.node_hash()
+            )
+            object.__setattr__(self, "_node_hash", node_hash)
+        return node_hash
+
+    def __getstate__(self) -> typing.Dict[str, typing.Any]:
+        # whoever receives a tree recomputes its hashes rather than trusting ours
+        return {
+            name: value for name, value in self.__dict__.items() if name != "_node_hash"
+        }
+
     @staticmethod
     def visit(node: MerkleNode[P]) -> typing.Iterable[MerkleNode[P]]:
         if isinstance(node, ChildMerkleNode):
@@ -107,6 +127,22 @@ def dfs(
         nodes = new_nodes
 
 
+def leaves(
+    node: MerkleNode[P],
+) -> typing.Generator[LeafMerkleNode[P], None, None]:
+    """
+    Yields leaves left to right, i.e. in the order they were added.
+    """
+    nodes = [node]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        if isinstance(node, LeafMerkleNode):
+            yield node
+        elif isinstance(node, ChildMerkleNode):
+            nodes.append(node.parent_b)
+            nodes.append(node.parent_a)
+
+
 @dataclass(frozen=True)
 class MerkleForest(typing.Generic[P]):
     trees: typing.Tuple[MerkleNode[P], ...]
@@ -126,24 +162,334 @@ class MerkleForest(typing.Generic[P]):
     @cache
     def merge(self) -> MerkleNode[P]:
         acc_tree = None
-        for i in range(len(self.trees)):
+        for tree in reversed(self.trees):
             if acc_tree is not None:
-                acc_tree = ChildMerkleNode(parent_a=self.trees[-i], parent_b=acc_tree)
+                acc_tree = ChildMerkleNode(parent_a=tree, parent_b=acc_tree)
             else:
-                acc_tree = self.trees[-i]
+                acc_tree = tree
         return acc_tree if acc_tree is not None else NullMerkleNode()
 
 
+HASH_SIZE = 32
+
+
+class PackedMerkleTree(typing.Generic[P]):
+    """
+    A Merkle tree stored as one contiguous buffer of HASH_SIZE-byte hashes per
+    level. Level 0 holds the leaf hashes and level h + 1 the hashes of the
+    complete pairs in level h, so a level of odd length ends in the root of a
+    perfect subtree still waiting for its sibling. Those subtrees are the trees
+    of a MerkleForest over the same payloads and are folded into the root the
+    way MerkleForest.merge does, so both produce the same tree.
+    """
+
+    __slots__ = ("_payloads", "_levels")
+
+    def __init__(self, payloads: typing.Iterable[P] = ()) -> None:
+        self._payloads: typing.List[P] = []
+        self._levels: typing.List[bytearray] = []
+        self.extend(payloads)
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def __getitem__(self, index: int) -> P:
+        return self._payloads[index]
+
+    def __iter__(self) -> typing.Iterator[P]:
+        return iter(self._payloads)
+
+    def level_size(self, level: int) -> int:
+        return len(self._levels[level]) // HASH_SIZE if level < len(self._levels) else 0
+
+    def level_hash(self, level: int, index: int) -> bytes:
+        start = index * HASH_SIZE
+        end = start + HASH_SIZE
+        return bytes(self._levels[level][start:end])
+
+    def append(self, payload: P) -> None:
+        """
+        Adds a leaf and hashes at most one new node per level.
+        """
+        self._payloads.append(payload)
+        node_hash = payload.hash()
+        level = 0
+        while True:
+            if level == len(self._levels):
+                self._levels.append(bytearray())
+            buffer = self._levels[level]
+            buffer += node_hash
+            pair_start = len(buffer) - 2 * HASH_SIZE
+            if pair_start % (2 * HASH_SIZE) != 0:
+                return
+            node_hash = hash_byte_sets(bytes(buffer[pair_start:]))
+            level += 1
+
+    def extend(self, payloads: typing.Iterable[P]) -> None:
+        for payload in payloads:
+            self.append(payload)
+
+    def peaks(self) -> typing.Iterator[typing.Tuple[int, int]]:
+        """
+        Yields (level, index) of the perfect subtrees, smallest (rightmost)
+        first.
+        """
+        for level in range(len(self._levels)):
+            size = self.level_size(level)
+            if size % 2 == 1:
+                yield level, size - 1
+
+    def root_hash(self) -> bytes:
+        root_hash: typing.Optional[bytes] = None
+        for level, index in self.peaks():
+            peak_hash = self.level_hash(level, index)
+            root_hash = (
+                peak_hash if root_hash is None else hash_byte_sets(peak_hash, root_hash)
+            )
+        return root_hash if root_hash is not None else NullMerkleNode().node_hash()
+
+    def inclusion_proof(self, index: int) -> MerkleProof:
+        """
+        Proof for the leaf at index, read straight off the level buffers.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("leaf index out of range", index)
+        siblings: typing.List[bytes] = []
+        siblings_on_left: typing.List[bool] = []
+        level = 0
+        # climb the perfect subtree holding the leaf up to its root
+        while not (
+            self.level_size(level) % 2 == 1 and index == self.level_size(level) - 1
+        ):
+            siblings.append(self.level_hash(level, index ^ 1))
+            siblings_on_left.append(index % 2 == 1)
+            index //= 2
+            level += 1
+
+        # then fold in the other subtrees as MerkleForest.merge does: the
+        # smaller ones to the right as a single hash, the larger ones left
+        right_hash: typing.Optional[bytes] = None
+        for peak_level, peak_index in self.peaks():
+            peak_hash = self.level_hash(peak_level, peak_index)
+            if peak_level < level:
+                right_hash = (
+                    peak_hash
+                    if right_hash is None
+                    else hash_byte_sets(peak_hash, right_hash)
+                )
+            elif peak_level > level:
+                if right_hash is not None:
+                    siblings.append(right_hash)
+                    siblings_on_left.append(False)
+                    right_hash = None
+                siblings.append(peak_hash)
+                siblings_on_left.append(True)
+        if right_hash is not None:
+            siblings.append(right_hash)
+            siblings_on_left.append(False)
+        return MerkleProof(
+            siblings=tuple(siblings), siblings_on_left=tuple(siblings_on_left)
+        )
+
+    def to_merkle_node(self) -> MerkleNode[P]:
+        """
+        Builds the equivalent linked tree, handing every node the hash already
+        stored for it.
+        """
+        nodes: typing.List[MerkleNode[P]] = [
+            LeafMerkleNode(height=0, payload=payload) for payload in self._payloads
+        ]
+        peaks: typing.List[MerkleNode[P]] = []
+        level = 0
+        while len(nodes) > 0:
+            if len(nodes) % 2 == 1:
+                peaks.append(nodes.pop())
+            parents: typing.List[MerkleNode[P]] = []
+            for index in range(len(nodes) // 2):
+                node = ChildMerkleNode(
+                    parent_a=nodes[2 * index], parent_b=nodes[2 * index + 1]
+                )
+                object.__setattr__(
+                    node, "_node_hash", self.level_hash(level + 1, index)
+                )
+                parents.append(node)
+            nodes = parents
+            level += 1
+
+        root: typing.Optional[MerkleNode[P]] = None
+        for peak in peaks:
+            root = (
+                peak if root is None else ChildMerkleNode(parent_a=peak, parent_b=root)
+            )
+        return root if root is not None else NullMerkleNode()
+
+
+@dataclass(frozen=True)
+class MerkleProof:
+    """
+    The sibling hashes on the path from a leaf up to the root, with whether
+    each one sits to the left of the path.
+    """
+
+    siblings: typing.Tuple[bytes, ...]
+    siblings_on_left: typing.Tuple[bool, ...]
+
+    def root_hash(self, leaf_hash: bytes) -> bytes:
+        node_hash = leaf_hash
+        for sibling_hash, on_left in zip(self.siblings, self.siblings_on_left):
+            node_hash = (
+                hash_byte_sets(sibling_hash, node_hash)
+                if on_left
+                else hash_byte_sets(node_hash, sibling_hash)
+            )
+        return node_hash
+
+    def verify(self, leaf_hash: bytes, root_hash: bytes) -> bool:
+        return (
+            len(self.siblings) == len(self.siblings_on_left)
+            and self.root_hash(leaf_hash) == root_hash
+        )
+
+
+def merkle_proof(tree: MerkleNode[P], leaf_hash: bytes) -> typing.Optional[MerkleProof]:
+    """
+    Finds the first leaf with leaf_hash and returns its proof, or None if the
+    tree doesn't contain it.
+    """
+    # the branches above the current node, and whether it went right at each
+    path: typing.List[typing.Tuple[ChildMerkleNode[P], bool]] = []
+    # each node carries the depth of its parent, to trim the path back to
+    nodes: typing.List[
+        typing.Tuple[MerkleNode[P], int, typing.Optional[ChildMerkleNode[P]], bool]
+    ] = [(tree, 0, None, False)]
+    while len(nodes) > 0:
+        node, depth, parent, is_right = nodes.pop()
+        del path[depth:]
+        if parent is not None:
+            path.append((parent, is_right))
+        if isinstance(node, ChildMerkleNode):
+            nodes.append((node.parent_b, len(path), node, True))
+            nodes.append((node.parent_a, len(path), node, False))
+        elif isinstance(node, LeafMerkleNode) and node.node_hash() == leaf_hash:
+            return MerkleProof(
+                siblings=tuple(
+                    (parent.parent_a if is_right else parent.parent_b).node_hash()
+                    for parent, is_right in reversed(path)
+                ),
+                siblings_on_left=tuple(is_right for _, is_right in reversed(path)),
+            )
+    return None
+
+
+_BRANCH = 0
+_PRUNED = 1
+_LEAF = 2
+
+
+@dataclass(frozen=True)
+class MerkleMultiProof:
+    """
+    Proof for several leaves at once: the tree pruned down to the paths of the
+    proven leaves, so siblings shared between paths are only sent once. shape
+    has one entry per node of the pruned tree in pre-order, marking it as a
+    branch on some path, a pruned subtree or a proven leaf; hashes holds the
+    hashes of the latter two in the same order.
+    """
+
+    shape: bytes
+    hashes: typing.Tuple[bytes, ...]
+
+    def root_and_leaves(
+        self,
+    ) -> typing.Optional[typing.Tuple[bytes, typing.List[bytes]]]:
+        """
+        Rebuilds the root hash and lists the proven leaf hashes, or returns
+        None if the proof is malformed.
+        """
+        pending: typing.List[typing.List[bytes]] = []
+        leaf_hashes: typing.List[bytes] = []
+        hashes = iter(self.hashes)
+        root_hash: typing.Optional[bytes] = None
+        for kind in self.shape:
+            if root_hash is not None:
+                return None
+            if kind == _BRANCH:
+                pending.append([])
+                continue
+            node_hash = next(hashes, None)
+            if node_hash is None or kind not in (_PRUNED, _LEAF):
+                return None
+            if kind == _LEAF:
+                leaf_hashes.append(node_hash)
+            while len(pending) > 0:
+                pending[-1].append(node_hash)
+                if len(pending[-1]) < 2:
+                    break
+                node_hash = hash_byte_sets(*pending.pop())
+            else:
+                root_hash = node_hash
+        if root_hash is None or next(hashes, None) is not None:
+            return None
+        return root_hash, leaf_hashes
+
+    def verify(self, leaf_hashes: typing.Iterable[bytes], root_hash: bytes) -> bool:
+        result = self.root_and_leaves()
+        if result is None:
+            return False
+        proven_root_hash, proven_leaf_hashes = result
+        return proven_root_hash == root_hash and set(leaf_hashes) <= set(
+            proven_leaf_hashes
+        )
+
+
+def merkle_multi_proof(
+    tree: MerkleNode[P], leaf_hashes: typing.Iterable[bytes]
+) -> typing.Optional[MerkleMultiProof]:
+    """
+    Returns None unless every one of leaf_hashes is in the tree.
+    """
+    targets = set(leaf_hashes)
+    found: typing.Set[bytes] = set()
+    # ids of the nodes with a target beneath them, found bottom up
+    on_path: typing.Set[int] = set()
+    nodes: typing.List[typing.Tuple[MerkleNode[P], bool]] = [(tree, False)]
+    while len(nodes) > 0:
+        node, expanded = nodes.pop()
+        if isinstance(node, ChildMerkleNode):
+            if not expanded:
+                nodes.append((node, True))
+                nodes.append((node.parent_b, False))
+                nodes.append((node.parent_a, False))
+            elif id(node.parent_a) in on_path or id(node.parent_b) in on_path:
+                on_path.add(id(node))
+        elif isinstance(node, LeafMerkleNode) and node.node_hash() in targets:
+            found.add(node.node_hash())
+            on_path.add(id(node))
+    if found != targets:
+        return None
+
+    shape = bytearray()
+    hashes: typing.List[bytes] = []
+    nodes_left: typing.List[MerkleNode[P]] = [tree]
+    while len(nodes_left) > 0:
+        node = nodes_left.pop()
+        if id(node) not in on_path:
+            shape.append(_PRUNED)
+            hashes.append(node.node_hash())
+        elif isinstance(node, ChildMerkleNode):
+            shape.append(_BRANCH)
+            nodes_left.append(node.parent_b)
+            nodes_left.append(node.parent_a)
+        else:
+            shape.append(_LEAF)
+            hashes.append(node.node_hash())
+    return MerkleMultiProof(shape=bytes(shape), hashes=tuple(hashes))
+
+
 def build_merkle_tree(
     items: typing.Iterable[P],
 ) -> typing.Optional[MerkleNode[P]]:
-    items_iter = iter(items)
-    lhs_init = next(items_iter, None)
-    if lhs_init is None:
+    tree = PackedMerkleTree(items)
+    if len(tree) == 0:
         return None
-
-    forest = MerkleForest(trees=(LeafMerkleNode(height=0, payload=lhs_init),))
-    for item in items_iter:
-        forest = forest.add_node(item)
-
-    return forest.merge()
+    return tree.to_merkle_node()
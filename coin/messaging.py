@@ -2,7 +2,8 @@ from __future__ import annotations
 from dataclasses import dataclass
 from enum import Enum
 import typing
-from coin.block import SealedBlock
+from coin.block import SealedBlock, SealedBlockHeader
+from coin.merkle import MerkleMultiProof
 from coin.transaction import Transaction
 
 Address = str
@@ -14,6 +15,26 @@ class AddressedMessage:
     recipient_address: Address
     message: Message
 
+    def encoded(self) -> bytes:
+        """
+        The wire encoding, computed at most once per message. Messages decoded
+        from bytes keep those bytes, so passing one on doesn't encode it again.
+        """
+        encoded: typing.Optional[bytes] = self.__dict__.get("_encoded")
+        if encoded is None:
+            from coin.wire import encode_addressed_message
+
+            encoded = encode_addressed_message(self)
+            object.__setattr__(self, "_encoded", encoded)
+        return encoded
+
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        # queues pickle whatever they carry, so hand pickle the wire encoding
+        # rather than the nested dataclasses
+        from coin.wire import decode_addressed_message
+
+        return (decode_addressed_message, (self.encoded(),))
+
 
 class MessageType(str, Enum):
     VERSION = "VERSION"
@@ -25,6 +46,10 @@ class MessageType(str, Enum):
     TRANSACTION = "TRANSACTION"
     GET_ADDR = "GET_ADDR"
     ADDR = "ADDR"
+    GET_MERKLE_PROOF = "GET_MERKLE_PROOF"
+    MERKLE_PROOF = "MERKLE_PROOF"
+    GET_HEADERS = "GET_HEADERS"
+    HEADERS = "HEADERS"
 
 
 class Message:
@@ -50,7 +75,7 @@ class VersionAckMessage(Message):
 class GetBlocksMessage(Message):
     @dataclass
     class Payload:
-        header_hashes: typing.Tuple[bytes]
+        header_hashes: typing.Tuple[bytes, ...]
         stopping_hash: typing.Optional[bytes]
 
     payload: Payload
@@ -62,6 +87,8 @@ class InventoryMessage(Message):
     @dataclass
     class Payload:
         header_hashes: typing.Tuple[bytes, ...]
+        # transactions announced by hash, see coin.relay
+        transaction_hashes: typing.Tuple[bytes, ...] = ()
 
     payload: Payload
     message_type: typing.Literal[MessageType.INVENTORY] = MessageType.INVENTORY
@@ -72,6 +99,7 @@ class GetDataMessage(Message):
     @dataclass
     class Payload:
         objects_requested: typing.Tuple[bytes, ...]
+        transactions_requested: typing.Tuple[bytes, ...] = ()
 
     payload: Payload
     message_type: typing.Literal[MessageType.GET_DATA] = MessageType.GET_DATA
@@ -110,3 +138,49 @@ class AddrMessage(Message):
 
     payload: Payload
     message_type: typing.Literal[MessageType.ADDR] = MessageType.ADDR
+
+
+@dataclass
+class GetMerkleProofMessage(Message):
+    @dataclass
+    class Payload:
+        block_hash: bytes
+        transaction_hashes: typing.Tuple[bytes, ...]
+
+    payload: Payload
+    message_type: typing.Literal[MessageType.GET_MERKLE_PROOF] = (
+        MessageType.GET_MERKLE_PROOF
+    )
+
+
+@dataclass
+class MerkleProofMessage(Message):
+    @dataclass
+    class Payload:
+        header: SealedBlockHeader
+        transaction_hashes: typing.Tuple[bytes, ...]
+        proof: MerkleMultiProof
+
+    payload: Payload
+    message_type: typing.Literal[MessageType.MERKLE_PROOF] = MessageType.MERKLE_PROOF
+
+
+@dataclass
+class GetHeadersMessage(Message):
+    @dataclass
+    class Payload:
+        header_hashes: typing.Tuple[bytes, ...]
+        stopping_hash: typing.Optional[bytes]
+
+    payload: Payload
+    message_type: typing.Literal[MessageType.GET_HEADERS] = MessageType.GET_HEADERS
+
+
+@dataclass
+class HeadersMessage(Message):
+    @dataclass
+    class Payload:
+        headers: typing.Tuple[SealedBlockHeader, ...]
+
+    payload: Payload
+    message_type: typing.Literal[MessageType.HEADERS] = MessageType.HEADERS
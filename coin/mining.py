@@ -1,57 +1,209 @@
 from __future__ import annotations
+import os
+import queue
+import time
+import typing
 from dataclasses import dataclass, field, replace
-from multiprocessing import Queue
+from multiprocessing import Queue, parent_process
+from multiprocessing.process import BaseProcess
 from coin.multiprocessing import mp_ctx
 from coin.process import Process, send_queue_message
 from coin.node_context import NodeContext
-from coin.block import OpenBlock, SealedBlockHeader
-from coin.find_block import find_block
+from coin.block import OpenBlock, OpenBlockHeader, SealedBlock, SealedBlockHeader
+from coin.find_block import search_nonces
+
+# how often an idle worker checks that its node is still running
+PARENT_CHECK_INTERVAL = 1.0
 
 
 @dataclass(frozen=True)
 class MiningProcessConfig:
     ctx: NodeContext
     difficulty: int
-    next_block: OpenBlock
+    workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    # each worker searches nonce_range nonces at a time; worker i takes the
+    # i-th range of every round of workers * nonce_range nonces
+    nonce_range: int = int(1e10)
+    # workers look for a new template between batches, so this bounds how
+    # long they keep hashing a stale one
+    batch_size: int = int(1e4)
+
+
+@dataclass(frozen=True)
+class MiningJob:
+    job_id: int
+    header: OpenBlockHeader
+
+
+@dataclass(frozen=True)
+class MiningResult:
+    job_id: int
+    header: SealedBlockHeader
+
+
+def _next_job(
+    control: Queue[typing.Optional[MiningJob]],
+    node_process: typing.Optional[BaseProcess],
+) -> typing.Optional[MiningJob]:
+    """
+    Waits for the latest job, or None once the node says to stop or is gone.
+    """
+    while True:
+        try:
+            job = control.get(True, PARENT_CHECK_INTERVAL)
+            break
+        except queue.Empty:
+            if node_process is not None and not node_process.is_alive():
+                return None
+    while True:
+        try:
+            job = control.get(False)
+        except queue.Empty:
+            return job
 
 
 def run_mining(
-    config: MiningProcessConfig, result_queue: Queue[SealedBlockHeader]
+    config: MiningProcessConfig,
+    worker_index: int,
+    control: Queue[typing.Optional[MiningJob]],
+    result_queue: Queue[MiningResult],
+    current_job_id: typing.Any,
+    hash_counts: typing.MutableSequence[int],
 ) -> None:
-    config.ctx.info("Mining process starting...")
+    ctx = replace(config.ctx, node_id=f"{config.ctx.node_id}.m{worker_index}")
+    ctx.info("Mining process starting...")
+    # workers of a node that was killed would otherwise hash on forever
+    node_process = parent_process()
+    job: typing.Optional[MiningJob] = None
+    nonce = range_end = 0
     while True:
-        block = find_block(
-            ctx=replace(config.ctx, node_id=f"{config.ctx.node_id}.m"),
-            open_block_header=config.next_block.header,
-            difficulty=config.difficulty,
-        )
-        if block is not None:
-            send_queue_message(config.ctx, result_queue, block)
-            break
+        if node_process is not None and not node_process.is_alive():
+            return
+        if job is None or current_job_id.value != job.job_id:
+            job = _next_job(control, node_process)
+            if job is None:
+                ctx.info("Mining process stopping...")
+                return
+            nonce = worker_index * config.nonce_range
+            range_end = nonce + config.nonce_range
+
+        tries = min(config.batch_size, range_end - nonce)
+        result = search_nonces(job.header, config.difficulty, nonce, tries)
+        hash_counts[worker_index] += result.hashes_done
+        if result.header is not None:
+            ctx.info(f"found block {result.header.block_hash.hex()}!")
+            send_queue_message(
+                ctx,
+                result_queue,
+                MiningResult(job_id=job.job_id, header=result.header),
+            )
+            # idle until the node hands out the next template
+            job = None
+            continue
+        nonce += tries
+        if nonce == range_end:
+            nonce += (config.workers - 1) * config.nonce_range
+            range_end = nonce + config.nonce_range
 
 
 @dataclass
 class MiningProcessHandle:
+    """
+    Long-lived pool of mining processes. New templates are handed to the
+    running workers, which switch to them at their next batch boundary.
+    """
+
     config: MiningProcessConfig
-    process: Process = field(init=False)
-    result_queue: Queue[SealedBlockHeader] = field(init=False)
+    next_block: typing.Optional[OpenBlock] = field(default=None, init=False)
+    processes: typing.List[Process] = field(init=False)
+    controls: typing.List[Queue[typing.Optional[MiningJob]]] = field(init=False)
+    result_queue: Queue[MiningResult] = field(init=False)
+    current_job_id: typing.Any = field(init=False)
+    hash_counts: typing.MutableSequence[int] = field(init=False)
+    started_at: float = field(init=False)
     terminated: bool = False
 
     def __post_init__(self) -> None:
-        self.config.ctx.info("Spawning mining subprocess...")
-        self.result_queue = mp_ctx.Queue(2)
-        self.process = Process(
-            target=run_mining,
-            kwargs={"config": self.config, "result_queue": self.result_queue},
+        self.config.ctx.info(f"Spawning {self.config.workers} mining subprocesses...")
+        self.controls = [mp_ctx.Queue() for _ in range(self.config.workers)]
+        self.result_queue = mp_ctx.Queue()
+        self.current_job_id = mp_ctx.Value("Q", 0, lock=False)
+        self.hash_counts = mp_ctx.Array("Q", self.config.workers, lock=False)
+        self.started_at = time.monotonic()
+        self.processes = [
+            Process(
+                target=run_mining,
+                kwargs={
+                    "config": self.config,
+                    "worker_index": worker_index,
+                    "control": self.controls[worker_index],
+                    "result_queue": self.result_queue,
+                    "current_job_id": self.current_job_id,
+                    "hash_counts": self.hash_counts,
+                },
+            )
+            for worker_index in range(self.config.workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def _publish(self, job: typing.Optional[MiningJob]) -> None:
+        for control in self.controls:
+            control.put(job)
+        # bumped after the puts so a worker that sees the new id always finds
+        # the job on its control queue
+        self.current_job_id.value += 1
+
+    def update_template(self, next_block: OpenBlock) -> None:
+        self.next_block = next_block
+        self._publish(
+            MiningJob(job_id=self.current_job_id.value + 1, header=next_block.header)
         )
-        self.process.start()
 
-    def stop(self) -> None:
-        self.process.join()
-        self.terminated = True
-        if self.process.exception:
-            self.config.ctx.warning(str(self.process.exception))
+    def invalidate_template(self) -> None:
+        self.next_block = None
+
+    def wait_result(self, timeout: float) -> typing.Optional[MiningResult]:
+        try:
+            return self.result_queue.get(True, timeout)
+        except queue.Empty:
+            return None
+
+    def accept_result(
+        self, ctx: NodeContext, result: MiningResult
+    ) -> typing.Optional[SealedBlock]:
+        """
+        Turns a worker's result into a block, unless the template it was
+        mined for has been replaced since.
+        """
+        if self.next_block is None or result.job_id != self.current_job_id.value:
+            ctx.info(f"discarding block mined for stale job {result.job_id}")
+            return None
+        ctx.info(f"recv {result.header}")
+        block = SealedBlock(
+            header=result.header, transaction_tree=self.next_block.transaction_tree
+        )
+        self.next_block = None
+        return block
+
+    def hashes_done(self) -> int:
+        return sum(self.hash_counts)
+
+    def hashrate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return self.hashes_done() / elapsed if elapsed > 0 else 0.0
 
-    def terminate(self) -> None:
-        self.process.terminate()
+    def stop(self, timeout: float = 1.0) -> None:
+        """
+        Asks every worker to exit after its current batch and terminates any
+        that don't exit in time.
+        """
+        self._publish(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+            elif process.exception:
+                self.config.ctx.warning(str(process.exception))
         self.terminated = True
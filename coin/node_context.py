@@ -4,6 +4,7 @@ from dataclasses import dataclass, field
 from enum import Enum
 from ecdsa import SigningKey, VerifyingKey
 from datetime import datetime
+from coin.verification import SignatureVerifier
 
 
 class LogType(str, Enum):
@@ -38,6 +39,9 @@ class ECDSAKey:
 class NodeContext:
     node_id: str
     private_key_dump: typing.Optional[str] = None
+    signature_verifier: SignatureVerifier = field(default_factory=SignatureVerifier)
+    # blocks are kept on disk under data_dir when set, and in memory otherwise
+    data_dir: typing.Optional[str] = None
     node_key: ECDSAKey = field(init=False)
     startup_time: datetime = field(init=False)
 
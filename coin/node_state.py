@@ -1,14 +1,38 @@
 from __future__ import annotations
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, field, fields, replace
 from enum import Enum
 import typing
-from coin.block import SealedBlock
-from coin.ledger import Ledger, validate_transactions
+from coin.block import SealedBlock, SealedBlockHeader
+from coin.block_store import BlockStore
+from coin.genesis import GENESIS_BLOCK
+from coin.ledger import (
+    BlockUndo,
+    Ledger,
+    block_undo,
+    replay_transactions,
+    validate_transactions,
+)
 from coin.node_context import NodeContext
-from coin.merkle import MerkleForest, dfs, LeafMerkleNode
-from coin.transaction import Transaction, make_reward_transaction
-from coin.ledger import update_ledger
+from coin.mempool import Mempool, connect_block, rebuild_mempool
 from coin.messaging import Address
+from coin.orphans import OrphanPool
+from coin.persistent import PersistentMap, RollingSet
+
+
+def _skip_height(height: int) -> int:
+    """
+    The height a block's skip pointer jumps to. Clearing low bits spaces the
+    targets so that any ancestor is reachable in O(log n) jumps, the same
+    scheme Bitcoin Core uses; heights here start at 1 rather than 0.
+    """
+    index = height - 1
+    if index < 2:
+        return 1
+    if index & 1:
+        lowered = index - 1
+        lowered &= lowered - 1
+        return (lowered & (lowered - 1)) + 2
+    return (index & (index - 1)) + 1
 
 
 @dataclass
@@ -16,13 +40,195 @@ class Chains:
     parent: typing.Optional[Chains]
     height: int
     block: SealedBlock
-    ledger: Ledger
+    # only the best head keeps its ledger, plus blocks that can't be rolled
+    # back to from it (genesis, and the ledger snapshot of a restored chain);
+    # the others are rebuilt from undo records, see ledger_at
+    ledger: typing.Optional[Ledger]
+    # what this block changed in its parent's ledger; None until the block
+    # has been connected once, e.g. for blocks restored from disk
+    undo: typing.Optional[BlockUndo] = None
+    skip: typing.Optional[Chains] = field(init=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.skip = (
+            self.parent.ancestor(_skip_height(self.height))
+            if self.parent is not None
+            else None
+        )
+
+    def ancestor(self, height: int) -> typing.Optional[Chains]:
+        """
+        The block at height on this chain, found in O(log n) steps.
+        """
+        if height > self.height or height < 1:
+            return None
+        chains = self
+        while chains.height > height:
+            skip_height = _skip_height(chains.height)
+            previous_skip_height = _skip_height(chains.height - 1)
+            # take the skip pointer unless the parent's lands closer to
+            # height without overshooting it
+            if chains.skip is not None and (
+                skip_height == height
+                or (
+                    skip_height > height
+                    and not (
+                        previous_skip_height < skip_height - 2
+                        and previous_skip_height >= height
+                    )
+                )
+            ):
+                chains = chains.skip
+            else:
+                assert chains.parent is not None
+                chains = chains.parent
+        return chains
+
+    def contains(self, other: Chains) -> bool:
+        return self.ancestor(other.height) is other
+
+    def get_ledger(self) -> Ledger:
+        """
+        The ledger of a best head. One restored from disk without a ledger
+        replays the blocks since the closest ancestor with one, and keeps the
+        result.
+        """
+        if self.ledger is None:
+            self.ledger = _replay_ledger(self)
+        return self.ledger
+
+    def connect(self, parent_ledger: Ledger) -> Ledger:
+        """
+        Applies this block to its parent's ledger, replaying its transactions
+        only the first time, when its undo record is made.
+        """
+        if self.undo is None:
+            result = replay_transactions(parent_ledger, self.block)
+            assert result.valid, "stored blocks were validated before being stored"
+            self.undo = block_undo(parent_ledger, self.block)
+            return result.new_ledger
+        return self.undo.connect(parent_ledger)
+
+    def release_ledger(self) -> None:
+        """
+        Drops the ledger of a block that is no longer the best head, unless
+        there is no undo record to roll back to it with.
+        """
+        if self.undo is not None:
+            self.ledger = None
 
     def format_chain(self) -> str:
-        base = f"{self.block.header.block_hash.hex()}"
-        if self.parent is None:
-            return base
-        return f"{base}, {self.parent.format_chain()}"
+        hashes = []
+        chains: typing.Optional[Chains] = self
+        while chains is not None:
+            hashes.append(chains.block.header.block_hash.hex())
+            chains = chains.parent
+        return ", ".join(hashes)
+
+    def __repr__(self) -> str:
+        # the default repr would recurse through every ancestor
+        return f"Chains(height={self.height}, block={self.block!r})"
+
+
+def fork_point(first: Chains, second: Chains) -> Chains:
+    """
+    The last block two chains share, found in O(log n) steps: skip pointers
+    of blocks at the same height jump to the same height, so both chains can
+    take them whenever they land on different blocks.
+    """
+    height = min(first.height, second.height)
+    first_chain = first.ancestor(height)
+    second_chain = second.ancestor(height)
+    assert first_chain is not None and second_chain is not None
+    while first_chain is not second_chain:
+        if (
+            first_chain.skip is not None
+            and second_chain.skip is not None
+            and first_chain.skip is not second_chain.skip
+        ):
+            first_chain, second_chain = first_chain.skip, second_chain.skip
+        else:
+            assert first_chain.parent is not None and second_chain.parent is not None
+            first_chain, second_chain = first_chain.parent, second_chain.parent
+    return first_chain
+
+
+def _connect_to(base: Chains, ledger: Ledger, target: Chains) -> Ledger:
+    """
+    Connects the blocks after base up to target, which must be on its chain,
+    to base's ledger.
+    """
+    path = []
+    chains: typing.Optional[Chains] = target
+    while chains is not base:
+        assert chains is not None
+        path.append(chains)
+        chains = chains.parent
+    for chains in reversed(path):
+        ledger = chains.connect(ledger)
+    return ledger
+
+
+def _replay_ledger(target: Chains) -> Ledger:
+    ancestor: typing.Optional[Chains] = target
+    while ancestor is not None and ancestor.ledger is None:
+        ancestor = ancestor.parent
+    assert ancestor is not None and ancestor.ledger is not None
+    return _connect_to(ancestor, ancestor.ledger, target)
+
+
+def ledger_at(tip: Chains, target: Chains) -> Ledger:
+    """
+    The ledger after target without keeping one per block: the tip's blocks
+    are disconnected back to where target's chain forks off and target's are
+    connected from there. Restored blocks have no undo record yet, so a fork
+    below one is replayed from the closest ancestor with a ledger instead.
+    """
+    if target.ledger is not None:
+        return target.ledger
+    fork = fork_point(tip, target)
+    ledger = tip.get_ledger()
+    chains = tip
+    while chains is not fork:
+        if chains.undo is None:
+            return _replay_ledger(target)
+        ledger = chains.undo.disconnect(ledger)
+        assert chains.parent is not None
+        chains = chains.parent
+    return _connect_to(fork, ledger, target)
+
+
+def block_locator(head: Chains) -> typing.Tuple[bytes, ...]:
+    """
+    Hashes of the last ten blocks of the chain and then of blocks ever
+    further back, ending with genesis. A peer can find the last block it
+    shares with the chain from this alone, however far back the fork is.
+    """
+    hashes = []
+    step = 1
+    chains: typing.Optional[Chains] = head
+    while chains is not None:
+        hashes.append(chains.block.header.block_hash)
+        if chains.height == 1:
+            break
+        if len(hashes) >= 10:
+            step *= 2
+        chains = head.ancestor(max(1, chains.height - step))
+    return tuple(hashes)
+
+
+def blocks_after(head: Chains, shared: Chains, limit: int) -> typing.List[Chains]:
+    """
+    Up to limit blocks of head's chain after shared, which must be on it,
+    oldest first.
+    """
+    end = head.ancestor(min(head.height, shared.height + limit))
+    blocks = []
+    while end is not None and end is not shared:
+        blocks.append(end)
+        end = end.parent
+    blocks.reverse()
+    return blocks
 
 
 class StartupState(str, Enum):
@@ -33,112 +239,297 @@ class StartupState(str, Enum):
     SYNCED = "SYNCED"
 
 
-@dataclass
-class Mempool:
-    ledger: Ledger
-    transactions: MerkleForest[Transaction]
+@dataclass(frozen=True)
+class BlockRequest:
+    peer: Address
+    requested_at: float
+
+
+@dataclass(frozen=True)
+class TransactionRequest:
+    peer: Address
+    requested_at: float
+    # other peers that announced the transaction, to ask in turn if this
+    # request times out
+    announcers: typing.Tuple[Address, ...] = ()
+
+
+@dataclass(frozen=True)
+class SyncState:
+    """
+    Blocks being downloaded headers-first, see coin.sync.
+    """
+
+    # validated headers whose blocks aren't in the block tree yet
+    headers: PersistentMap[bytes, SealedBlockHeader] = field(
+        default_factory=PersistentMap
+    )
+    # hashes of those headers, each after its parent; blocks before
+    # next_request have been requested and blocks before next_connect are in
+    # the block tree
+    pending: typing.Tuple[bytes, ...] = ()
+    next_request: int = 0
+    next_connect: int = 0
+    in_flight: PersistentMap[bytes, BlockRequest] = field(default_factory=PersistentMap)
+    # timed out requests, to be sent again to anyone but the peer that failed
+    retries: typing.Tuple[typing.Tuple[bytes, BlockRequest], ...] = ()
+    # bodies that arrived before their parents were connected
+    bodies: PersistentMap[bytes, SealedBlock] = field(default_factory=PersistentMap)
+
+    @property
+    def downloading(self) -> bool:
+        return self.next_connect < len(self.pending)
+
+
+@dataclass(frozen=True)
+class RelayState:
+    """
+    Transactions being relayed by inventory, see coin.relay.
+    """
+
+    # transactions the mempool accepted
+    seen: RollingSet[bytes] = field(default_factory=RollingSet)
+    # transactions the mempool turned down while rejected_head was the best
+    # head; a new head may make them valid, so they only count until then
+    rejected: RollingSet[bytes] = field(default_factory=RollingSet)
+    rejected_head: typing.Optional[bytes] = None
+    # per peer, the transactions it is known to have
+    known: PersistentMap[Address, RollingSet[bytes]] = field(
+        default_factory=PersistentMap
+    )
+    # transactions asked for and not received yet, and when the oldest of
+    # those requests times out
+    requested: PersistentMap[bytes, TransactionRequest] = field(
+        default_factory=PersistentMap
+    )
+    requests_expire_at: typing.Optional[float] = None
+    # accepted transactions waiting to go out in the next batch, at announce_at
+    announcements: typing.Tuple[bytes, ...] = ()
+    announce_at: typing.Optional[float] = None
+    validated: int = 0
+    # transactions that arrived again after they were validated
+    duplicates: int = 0
 
 
 @dataclass(frozen=True)
 class State:
     best_head: Chains
-    block_lookup: typing.Dict[bytes, Chains]
+    # persistent so that adding a block doesn't copy the index of every
+    # block before it
+    block_lookup: PersistentMap[bytes, Chains]
     startup_state: StartupState
     mempool: Mempool
-    orphaned_blocks: typing.FrozenSet[SealedBlock] = frozenset()
+    orphans: OrphanPool = OrphanPool()
     peers: typing.FrozenSet[Address] = frozenset()
+    block_store: typing.Optional[BlockStore] = None
+    sync: SyncState = SyncState()
+    relay: RelayState = RelayState()
 
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        # pickling the block tree as linked Chains would recurse once per
+        # block, so it is sent as a flat list ordered parents first
+        chains_entries = [
+            (
+                chains.block,
+                (
+                    chains.parent.block.header.block_hash
+                    if chains.parent is not None
+                    else None
+                ),
+                chains.height,
+                chains.ledger,
+                chains.undo,
+            )
+            for chains in sorted(
+                self.block_lookup.values(), key=lambda chains: chains.height
+            )
+        ]
+        other_fields = {
+            state_field.name: getattr(self, state_field.name)
+            for state_field in fields(self)
+            if state_field.name not in ("best_head", "block_lookup")
+        }
+        return (
+            _restore_state,
+            (chains_entries, self.best_head.block.header.block_hash, other_fields),
+        )
+
+
+def _restore_state(
+    chains_entries: typing.List[
+        typing.Tuple[
+            SealedBlock,
+            typing.Optional[bytes],
+            int,
+            typing.Optional[Ledger],
+            typing.Optional[BlockUndo],
+        ]
+    ],
+    best_head_hash: bytes,
+    other_fields: typing.Dict[str, typing.Any],
+) -> State:
+    block_lookup: typing.Dict[bytes, Chains] = {}
+    for block, parent_hash, height, ledger, undo in chains_entries:
+        block_lookup[block.header.block_hash] = Chains(
+            parent=block_lookup[parent_hash] if parent_hash is not None else None,
+            height=height,
+            block=block,
+            ledger=ledger,
+            undo=undo,
+        )
+    return State(
+        best_head=block_lookup[best_head_hash],
+        block_lookup=PersistentMap(block_lookup),
+        **other_fields,
+    )
 
-def try_add_block(ctx: NodeContext, state: State, block: SealedBlock) -> State:
-    if block.header.previous_block_hash not in state.block_lookup:
-        return replace(state, orphaned_blocks={*state.orphaned_blocks, block})
 
+def genesis_chains() -> Chains:
+    return Chains(parent=None, height=1, block=GENESIS_BLOCK, ledger=Ledger())
+
+
+def load_chains(
+    ctx: NodeContext, block_store: BlockStore
+) -> PersistentMap[bytes, Chains]:
+    """
+    Rebuilds the block tree from the stored headers. Blocks keep their bodies
+    on disk, and only the chain with the ledger snapshot gets a ledger; the
+    others replay theirs when needed.
+    """
+    genesis = genesis_chains()
+    block_lookup = {genesis.block.header.block_hash: genesis}
+    for header in block_store.headers():
+        parent = block_lookup.get(header.previous_block_hash)
+        if parent is None or not header.validate_hash():
+            ctx.warning(f"skipping stored block {header.block_hash.hex()}")
+            continue
+        block_lookup[header.block_hash] = Chains(
+            parent=parent,
+            height=parent.height + 1,
+            block=block_store.stored_block(header),
+            ledger=None,
+        )
+
+    snapshot = block_store.load_ledger()
+    if snapshot is not None and snapshot[0] in block_lookup:
+        block_hash, ledger = snapshot
+        block_lookup[block_hash].ledger = ledger
+    ctx.info(f"loaded {len(block_lookup) - 1} blocks from {block_store.path}")
+    return PersistentMap(block_lookup)
+
+
+def try_add_block(ctx: NodeContext, state: State, block: SealedBlock) -> State:
+    """
+    Adds a block to the block tree, or to the orphan pool while its parent is
+    missing, and then connects every orphan that descends from it.
+    """
     hashes_valid = block.validate_hashes()
     if not hashes_valid:
         ctx.warning("invalid hashes in block received")
         return state
 
+    if block.header.previous_block_hash not in state.block_lookup:
+        return replace(state, orphans=state.orphans.add(block))
+
+    state = _connect_block(ctx, state, block)
+    waiting = [block.header.block_hash]
+    while len(waiting) > 0:
+        parent_hash = waiting.pop()
+        orphans, children = state.orphans.take_children(parent_hash)
+        if len(children) == 0:
+            continue
+        state = replace(state, orphans=orphans)
+        if parent_hash not in state.block_lookup:
+            # the parent was invalid, so its descendants are dropped too
+            ctx.info(f"dropping {len(children)} orphans of an invalid block")
+        else:
+            ctx.info(f"connecting {len(children)} orphans")
+            for child in children:
+                state = _connect_block(ctx, state, child)
+        waiting.extend(child.header.block_hash for child in children)
+    return state
+
+
+def _connect_block(ctx: NodeContext, state: State, block: SealedBlock) -> State:
     parent_chains = state.block_lookup[block.header.previous_block_hash]
-    validate_result = validate_transactions(parent_chains.ledger, block)
+    parent_ledger = ledger_at(state.best_head, parent_chains)
+    validate_result = validate_transactions(
+        parent_ledger, block, ctx.signature_verifier
+    )
     if not validate_result.valid:
         ctx.warning(
             f"invalid transactions in block received: {validate_result.message}"
         )
         return state
 
+    # the chains only keeps a handle on the stored body, but everything here
+    # reads the block that is already decoded in memory
+    stored_block = block
+    if state.block_store is not None:
+        state.block_store.append(block)
+        stored_block = state.block_store.stored_block(block.header)
+
+    becomes_best = parent_chains.height + 1 > state.best_head.height
     chains = Chains(
         parent=parent_chains,
-        block=block,
+        block=stored_block,
         height=parent_chains.height + 1,
-        ledger=validate_result.new_ledger,
+        ledger=validate_result.new_ledger if becomes_best else None,
+        undo=block_undo(parent_ledger, block),
     )
 
-    new_orphans = set()
-    newly_parented = None
-    for orphan_block in state.orphaned_blocks:
-        if orphan_block.header.previous_block_hash == block.header.block_hash:
-            newly_parented = orphan_block
-        else:
-            new_orphans.add(orphan_block)
-
-    if chains.height > state.best_head.height:
-        new_mempool = prune_transactions(
-            ctx, state.mempool, chains.ledger, make_reward_transaction(ctx)
+    if becomes_best:
+        new_mempool = update_mempool(
+            ctx, state.mempool, state.best_head, chains, new_block=block
         )
         new_best_head = chains
+        state.best_head.release_ledger()
     else:
         new_mempool = state.mempool
         new_best_head = state.best_head
 
-    new_state = replace(
+    return replace(
         state,
-        block_lookup={**state.block_lookup, block.header.block_hash: chains},
+        block_lookup=state.block_lookup.set(block.header.block_hash, chains),
         best_head=new_best_head,
-        orphaned_blocks=frozenset(new_orphans)
-        if newly_parented is not None
-        else state.orphaned_blocks,
         mempool=new_mempool,
     )
-    if newly_parented is not None:
-        return try_add_block(ctx, state, newly_parented)
-    else:
-        return new_state
 
 
-def try_add_transaction(
-    ctx: NodeContext, mempool: Mempool, transaction: Transaction
-) -> Mempool:
-    result = update_ledger(mempool.ledger, transaction)
-    if not result.valid:
-        ctx.warning("failed to add transaction to mempool")
-        return mempool
-    return Mempool(
-        ledger=result.new_ledger,
-        transactions=mempool.transactions.add_node(transaction),
-    )
-
-
-def prune_transactions(
+def update_mempool(
     ctx: NodeContext,
-    old_mempool: Mempool,
-    ledger: Ledger,
-    init_transaction: Transaction,
+    mempool: Mempool,
+    old_head: Chains,
+    new_head: Chains,
+    *,
+    new_block: typing.Optional[SealedBlock] = None,
 ) -> Mempool:
-    assert init_transaction.is_coinbase
-    new_mempool = Mempool(
-        transactions=MerkleForest(
-            trees=(LeafMerkleNode(payload=init_transaction, height=1),)
-        ),
-        ledger=ledger,
-    )
-    for transaction in (
-        node.payload
-        for node in dfs(old_mempool.transactions.merge())
-        if isinstance(node, LeafMerkleNode)
+    """
+    Carries the mempool over to a new best head: extending the old head only
+    touches the new block's transactions, while a reorg returns the
+    disconnected blocks' transactions to the pool. new_block is new_head's
+    block, if the caller has it in memory, to save reading it back.
+    """
+    if new_head.parent is old_head:
+        return connect_block(
+            ctx,
+            mempool,
+            new_block if new_block is not None else new_head.block,
+            new_head.get_ledger(),
+        )
+
+    disconnected_blocks = []
+    old_chain: typing.Optional[Chains] = old_head
+    new_chain: typing.Optional[Chains] = new_head
+    while (
+        old_chain is not None and new_chain is not None and old_chain is not new_chain
     ):
-        if (
-            transaction.hash() not in ledger.previous_transactions
-            and not transaction.is_coinbase
-        ):
-            new_mempool = try_add_transaction(ctx, new_mempool, transaction)
-    return new_mempool
+        if old_chain.height >= new_chain.height:
+            disconnected_blocks.append(old_chain.block)
+            old_chain = old_chain.parent
+        else:
+            new_chain = new_chain.parent
+    ctx.info(f"reorg disconnected {len(disconnected_blocks)} blocks")
+    return rebuild_mempool(
+        ctx, mempool, new_head.get_ledger(), list(reversed(disconnected_blocks))
+    )
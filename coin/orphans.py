@@ -0,0 +1,112 @@
+"""
+Blocks that arrived before their parent. They are kept by the hash of the
+parent they wait for, so a block that connects finds every orphan built on it
+without looking at the others. The pool is bounded in both count and bytes;
+when it is full the oldest orphans go first.
+"""
+
+from __future__ import annotations
+import typing
+from dataclasses import dataclass, field, replace
+from coin.block import SealedBlock
+from coin.persistent import PersistentMap
+from coin.wire import encode_block
+
+MAX_ORPHANS = 100
+MAX_ORPHAN_BYTES = 16 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Orphan:
+    block: SealedBlock
+    size: int
+    # orders orphans by arrival for eviction
+    sequence: int
+
+
+@dataclass(frozen=True)
+class OrphanPool:
+    orphans: PersistentMap[bytes, Orphan] = field(default_factory=PersistentMap)
+    # parent hash -> hashes of the orphans waiting for it
+    children: PersistentMap[bytes, typing.Tuple[bytes, ...]] = field(
+        default_factory=PersistentMap
+    )
+    size: int = 0
+    next_sequence: int = 0
+    # orphans taken in, handed back once their parent arrived, and evicted
+    # to make room
+    added: int = 0
+    adopted: int = 0
+    evicted: int = 0
+
+    def __len__(self) -> int:
+        return len(self.orphans)
+
+    def __contains__(self, block_hash: object) -> bool:
+        return block_hash in self.orphans
+
+    def add(
+        self,
+        block: SealedBlock,
+        *,
+        max_orphans: int = MAX_ORPHANS,
+        max_bytes: int = MAX_ORPHAN_BYTES,
+    ) -> OrphanPool:
+        block_hash = block.header.block_hash
+        if block_hash in self.orphans:
+            return self
+        parent_hash = block.header.previous_block_hash
+        orphan = Orphan(
+            block=block, size=len(encode_block(block)), sequence=self.next_sequence
+        )
+        pool = replace(
+            self,
+            orphans=self.orphans.set(block_hash, orphan),
+            children=self.children.set(
+                parent_hash, self.children.get(parent_hash, ()) + (block_hash,)
+            ),
+            size=self.size + orphan.size,
+            next_sequence=self.next_sequence + 1,
+            added=self.added + 1,
+        )
+        while len(pool.orphans) > max_orphans or pool.size > max_bytes:
+            oldest = min(pool.orphans.values(), key=lambda orphan: orphan.sequence)
+            pool = pool._remove(oldest)
+            pool = replace(pool, evicted=pool.evicted + 1)
+        return pool
+
+    def take_children(
+        self, parent_hash: bytes
+    ) -> typing.Tuple[OrphanPool, typing.List[SealedBlock]]:
+        """
+        Removes and returns the orphans waiting for parent_hash.
+        """
+        child_hashes = self.children.get(parent_hash, ())
+        if len(child_hashes) == 0:
+            return self, []
+        pool = self
+        blocks = []
+        for child_hash in child_hashes:
+            orphan = pool.orphans[child_hash]
+            pool = pool._remove(orphan)
+            blocks.append(orphan.block)
+        return replace(pool, adopted=pool.adopted + len(blocks)), blocks
+
+    def _remove(self, orphan: Orphan) -> OrphanPool:
+        block_hash = orphan.block.header.block_hash
+        parent_hash = orphan.block.header.previous_block_hash
+        siblings = tuple(
+            child_hash
+            for child_hash in self.children[parent_hash]
+            if child_hash != block_hash
+        )
+        return replace(
+            self,
+            orphans=self.orphans.delete(block_hash),
+            children=(
+                self.children.set(parent_hash, siblings)
+                if len(siblings) > 0
+                else self.children.delete(parent_hash)
+            ),
+            size=self.size - orphan.size,
+        )
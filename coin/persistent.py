@@ -0,0 +1,589 @@
+from __future__ import annotations
+import bisect
+import typing
+from coin.util import K, V
+
+# Hash array mapped trie: each level consumes _BITS bits of the key hash, so a
+# lookup or update touches O(log32 n) nodes and every update path-copies only
+# the nodes on the way to the changed entry, sharing the rest with the old map.
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+
+def _hash(key: typing.Hashable) -> int:
+    return hash(key) & _HASH_MASK
+
+
+class _BitmapNode:
+    __slots__ = ("bitmap", "slots")
+
+    def __init__(self, bitmap: int, slots: typing.Tuple[typing.Any, ...]) -> None:
+        self.bitmap = bitmap
+        # each slot is either a (key, value) tuple or a child node
+        self.slots = slots
+
+
+class _CollisionNode:
+    __slots__ = ("key_hash", "entries")
+
+    def __init__(
+        self,
+        key_hash: int,
+        entries: typing.Tuple[typing.Tuple[typing.Any, typing.Any], ...],
+    ) -> None:
+        self.key_hash = key_hash
+        self.entries = entries
+
+
+_Node = typing.Union[_BitmapNode, _CollisionNode]
+
+_EMPTY_NODE = _BitmapNode(0, ())
+_MISSING: typing.Any = object()
+
+
+def _slot_index(bitmap: int, bit: int) -> int:
+    return (bitmap & (bit - 1)).bit_count()
+
+
+def _replace_slot(node: _BitmapNode, index: int, slot: typing.Any) -> _BitmapNode:
+    slots = list(node.slots)
+    slots[index] = slot
+    return _BitmapNode(node.bitmap, tuple(slots))
+
+
+def _pair_node(
+    shift: int,
+    hash_a: int,
+    slot_a: typing.Any,
+    hash_b: int,
+    slot_b: typing.Any,
+) -> _Node:
+    if hash_a == hash_b:
+        assert not isinstance(slot_a, (_BitmapNode, _CollisionNode))
+        if isinstance(slot_b, _CollisionNode):
+            return _CollisionNode(hash_a, slot_b.entries + (slot_a,))
+        return _CollisionNode(hash_a, (slot_a, slot_b))
+    bit_a = 1 << ((hash_a >> shift) & _MASK)
+    bit_b = 1 << ((hash_b >> shift) & _MASK)
+    if bit_a == bit_b:
+        return _BitmapNode(
+            bit_a, (_pair_node(shift + _BITS, hash_a, slot_a, hash_b, slot_b),)
+        )
+    if bit_a < bit_b:
+        return _BitmapNode(bit_a | bit_b, (slot_a, slot_b))
+    return _BitmapNode(bit_a | bit_b, (slot_b, slot_a))
+
+
+def _lookup(node: _Node, key_hash: int, key: typing.Any) -> typing.Any:
+    shift = 0
+    while True:
+        if isinstance(node, _CollisionNode):
+            if node.key_hash == key_hash:
+                for entry_key, entry_value in node.entries:
+                    if entry_key is key or entry_key == key:
+                        return entry_value
+            return _MISSING
+        bit = 1 << ((key_hash >> shift) & _MASK)
+        if not node.bitmap & bit:
+            return _MISSING
+        slot = node.slots[_slot_index(node.bitmap, bit)]
+        if isinstance(slot, (_BitmapNode, _CollisionNode)):
+            node = slot
+            shift += _BITS
+            continue
+        if slot[0] is key or slot[0] == key:
+            return slot[1]
+        return _MISSING
+
+
+def _assoc(
+    node: _Node, shift: int, key_hash: int, key: typing.Any, value: typing.Any
+) -> typing.Tuple[_Node, bool]:
+    if isinstance(node, _CollisionNode):
+        if node.key_hash != key_hash:
+            return (
+                _pair_node(shift, key_hash, (key, value), node.key_hash, node),
+                True,
+            )
+        for i, (entry_key, entry_value) in enumerate(node.entries):
+            if entry_key is key or entry_key == key:
+                if entry_value is value:
+                    return node, False
+                entries = list(node.entries)
+                entries[i] = (key, value)
+                return _CollisionNode(key_hash, tuple(entries)), False
+        return _CollisionNode(key_hash, node.entries + ((key, value),)), True
+
+    bit = 1 << ((key_hash >> shift) & _MASK)
+    index = _slot_index(node.bitmap, bit)
+    if not node.bitmap & bit:
+        return (
+            _BitmapNode(
+                node.bitmap | bit,
+                node.slots[:index] + ((key, value),) + node.slots[index:],
+            ),
+            True,
+        )
+    slot = node.slots[index]
+    if isinstance(slot, (_BitmapNode, _CollisionNode)):
+        child, added = _assoc(slot, shift + _BITS, key_hash, key, value)
+        if child is slot:
+            return node, False
+        return _replace_slot(node, index, child), added
+    if slot[0] is key or slot[0] == key:
+        if slot[1] is value:
+            return node, False
+        return _replace_slot(node, index, (key, value)), False
+    child = _pair_node(shift + _BITS, _hash(slot[0]), slot, key_hash, (key, value))
+    return _replace_slot(node, index, child), True
+
+
+def _dissoc(node: _Node, shift: int, key_hash: int, key: typing.Any) -> typing.Any:
+    """
+    Returns the node with key removed, the bare (key, value) entry if only one
+    is left below a non-root level, or _MISSING if key was not present.
+    """
+    if isinstance(node, _CollisionNode):
+        if node.key_hash != key_hash:
+            return _MISSING
+        entries = tuple(
+            entry for entry in node.entries if not (entry[0] is key or entry[0] == key)
+        )
+        if len(entries) == len(node.entries):
+            return _MISSING
+        if len(entries) == 1:
+            return entries[0]
+        return _CollisionNode(key_hash, entries)
+
+    bit = 1 << ((key_hash >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return _MISSING
+    index = _slot_index(node.bitmap, bit)
+    slot = node.slots[index]
+    if isinstance(slot, (_BitmapNode, _CollisionNode)):
+        child = _dissoc(slot, shift + _BITS, key_hash, key)
+        if child is _MISSING:
+            return _MISSING
+        if (
+            shift > 0
+            and len(node.slots) == 1
+            and not isinstance(child, (_BitmapNode, _CollisionNode))
+        ):
+            return child
+        return _replace_slot(node, index, child)
+    if not (slot[0] is key or slot[0] == key):
+        return _MISSING
+    slots = node.slots[:index] + node.slots[index:][1:]
+    if (
+        shift > 0
+        and len(slots) == 1
+        and not isinstance(slots[0], (_BitmapNode, _CollisionNode))
+    ):
+        return slots[0]
+    return _BitmapNode(node.bitmap & ~bit, slots)
+
+
+def _iter_entries(
+    node: _Node,
+) -> typing.Iterator[typing.Tuple[typing.Any, typing.Any]]:
+    stack: typing.List[_Node] = [node]
+    while len(stack) > 0:
+        current = stack.pop()
+        if isinstance(current, _CollisionNode):
+            yield from current.entries
+            continue
+        for slot in current.slots:
+            if isinstance(slot, (_BitmapNode, _CollisionNode)):
+                stack.append(slot)
+            else:
+                yield slot
+
+
+class PersistentMap(typing.Mapping[K, V]):
+    """
+    Immutable mapping where set/delete return a new map sharing all untouched
+    structure with the old one, so keeping every historical version is cheap.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    _root: _BitmapNode
+    _size: int
+
+    def __init__(
+        self,
+        items: typing.Union[
+            typing.Mapping[K, V], typing.Iterable[typing.Tuple[K, V]], None
+        ] = None,
+    ) -> None:
+        self._root = _EMPTY_NODE
+        self._size = 0
+        if items is not None:
+            root, size = self._root, self._size
+            pairs = items.items() if isinstance(items, typing.Mapping) else items
+            for key, value in pairs:
+                root, size = PersistentMap._assoc_root(root, size, key, value)
+            self._root, self._size = root, size
+
+    @staticmethod
+    def _assoc_root(
+        root: _BitmapNode, size: int, key: K, value: V
+    ) -> typing.Tuple[_BitmapNode, int]:
+        new_root, added = _assoc(root, 0, _hash(key), key, value)
+        assert isinstance(new_root, _BitmapNode)
+        return new_root, size + 1 if added else size
+
+    @staticmethod
+    def _from_root(root: _BitmapNode, size: int) -> PersistentMap[K, V]:
+        new_map: PersistentMap[K, V] = PersistentMap()
+        new_map._root = root
+        new_map._size = size
+        return new_map
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, key: K) -> V:
+        value = _lookup(self._root, _hash(key), key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return typing.cast(V, value)
+
+    def __contains__(self, key: object) -> bool:
+        return _lookup(self._root, _hash(key), key) is not _MISSING
+
+    def __iter__(self) -> typing.Iterator[K]:
+        return (key for key, _ in _iter_entries(self._root))
+
+    def items(self) -> typing.ItemsView[K, V]:
+        return _PersistentItemsView(self)
+
+    def set(self, key: K, value: V) -> PersistentMap[K, V]:
+        root, size = PersistentMap._assoc_root(self._root, self._size, key, value)
+        if root is self._root:
+            return self
+        return PersistentMap._from_root(root, size)
+
+    def delete(self, key: K) -> PersistentMap[K, V]:
+        root = _dissoc(self._root, 0, _hash(key), key)
+        if root is _MISSING:
+            raise KeyError(key)
+        return PersistentMap._from_root(root, self._size - 1)
+
+    def discard(self, key: K) -> PersistentMap[K, V]:
+        return self.delete(key) if key in self else self
+
+    def update(
+        self,
+        items: typing.Union[typing.Mapping[K, V], typing.Iterable[typing.Tuple[K, V]]],
+    ) -> PersistentMap[K, V]:
+        root, size = self._root, self._size
+        pairs = items.items() if isinstance(items, typing.Mapping) else items
+        for key, value in pairs:
+            root, size = PersistentMap._assoc_root(root, size, key, value)
+        if root is self._root:
+            return self
+        return PersistentMap._from_root(root, size)
+
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, typing.Mapping) or len(self) != len(other):
+            return False
+        for key, value in _iter_entries(self._root):
+            other_value = other.get(key, _MISSING)
+            if other_value is _MISSING or not (
+                other_value is value or other_value == value
+            ):
+                return False
+        return True
+
+    def __repr__(self) -> str:
+        return f"PersistentMap({dict(_iter_entries(self._root))!r})"
+
+    def __reduce__(
+        self,
+    ) -> typing.Tuple[
+        typing.Type[PersistentMap[K, V]], typing.Tuple[typing.List[typing.Tuple[K, V]]]
+    ]:
+        return (PersistentMap, (list(_iter_entries(self._root)),))
+
+
+class _PersistentItemsView(typing.ItemsView[K, V]):
+    _mapping: PersistentMap[K, V]
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[K, V]]:
+        return _iter_entries(self._mapping._root)
+
+
+class RollingSet(typing.Generic[K]):
+    """
+    Set of the most recently added keys that stays within capacity: keys go
+    into the current generation, and when that holds half of capacity the
+    previous generation is dropped and the current one takes its place. It
+    always remembers at least the last capacity // 2 keys.
+    """
+
+    __slots__ = ("capacity", "_current", "_previous")
+
+    capacity: int
+    _current: PersistentMap[K, bool]
+    _previous: PersistentMap[K, bool]
+
+    def __init__(
+        self,
+        capacity: int = 50000,
+        current: typing.Optional[PersistentMap[K, bool]] = None,
+        previous: typing.Optional[PersistentMap[K, bool]] = None,
+    ) -> None:
+        self.capacity = capacity
+        self._current = current if current is not None else PersistentMap()
+        self._previous = previous if previous is not None else PersistentMap()
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._current or key in self._previous
+
+    def add(self, key: K) -> RollingSet[K]:
+        if key in self._current:
+            return self
+        current = self._current.set(key, True)
+        if len(current) >= max(1, self.capacity // 2):
+            return RollingSet(self.capacity, None, current)
+        return RollingSet(self.capacity, current, self._previous)
+
+    def __repr__(self) -> str:
+        return f"RollingSet(capacity={self.capacity}, size={len(self._current) + len(self._previous)})"
+
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        return (RollingSet, (self.capacity, self._current, self._previous))
+
+
+# Sorted sets are B+ trees: a leaf holds up to _SORTED_NODE_SIZE keys in
+# order, and a branch up to _SORTED_NODE_SIZE children along with the largest
+# key under each. Adding or removing a key path-copies the O(log n) small
+# nodes above it. Nodes that shrink aren't merged back together, which only
+# leaves the tree a little sparser than it needs to be.
+
+_SORTED_NODE_SIZE = 32
+
+
+class _SortedLeaf:
+    __slots__ = ("keys",)
+
+    def __init__(self, keys: typing.Tuple[typing.Any, ...]) -> None:
+        self.keys = keys
+
+
+class _SortedBranch:
+    __slots__ = ("children", "lasts")
+
+    def __init__(
+        self,
+        children: typing.Tuple[_SortedNode, ...],
+        lasts: typing.Tuple[typing.Any, ...],
+    ) -> None:
+        self.children = children
+        # the largest key under each child
+        self.lasts = lasts
+
+
+_SortedNode = typing.Union[_SortedLeaf, _SortedBranch]
+
+
+def _sorted_last(node: _SortedNode) -> typing.Any:
+    return node.keys[-1] if isinstance(node, _SortedLeaf) else node.lasts[-1]
+
+
+def _sorted_branch(children: typing.Tuple[_SortedNode, ...]) -> _SortedBranch:
+    return _SortedBranch(children, tuple(_sorted_last(child) for child in children))
+
+
+def _sorted_split(
+    node: _SortedNode,
+) -> typing.Tuple[_SortedNode, ...]:
+    if isinstance(node, _SortedLeaf):
+        if len(node.keys) <= _SORTED_NODE_SIZE:
+            return (node,)
+        half = len(node.keys) // 2
+        return (_SortedLeaf(node.keys[:half]), _SortedLeaf(node.keys[half:]))
+    if len(node.children) <= _SORTED_NODE_SIZE:
+        return (node,)
+    half = len(node.children) // 2
+    return (
+        _SortedBranch(node.children[:half], node.lasts[:half]),
+        _SortedBranch(node.children[half:], node.lasts[half:]),
+    )
+
+
+def _sorted_add(
+    node: _SortedNode, key: typing.Any
+) -> typing.Optional[typing.Tuple[_SortedNode, ...]]:
+    """
+    The node with key added, split in two if it overflowed, or None if key
+    was already there.
+    """
+    if isinstance(node, _SortedLeaf):
+        index = bisect.bisect_left(node.keys, key)
+        if index < len(node.keys) and node.keys[index] == key:
+            return None
+        return _sorted_split(
+            _SortedLeaf(node.keys[:index] + (key,) + node.keys[index:])
+        )
+    index = min(bisect.bisect_left(node.lasts, key), len(node.children) - 1)
+    added = _sorted_add(node.children[index], key)
+    if added is None:
+        return None
+    after = index + 1
+    return _sorted_split(
+        _SortedBranch(
+            node.children[:index] + added + node.children[after:],
+            node.lasts[:index]
+            + tuple(_sorted_last(child) for child in added)
+            + node.lasts[after:],
+        )
+    )
+
+
+def _sorted_remove(node: _SortedNode, key: typing.Any) -> typing.Optional[_SortedNode]:
+    """
+    The node without key, None if that leaves it empty, or node itself if
+    key wasn't there.
+    """
+    if isinstance(node, _SortedLeaf):
+        index = bisect.bisect_left(node.keys, key)
+        if index == len(node.keys) or node.keys[index] != key:
+            return node
+        after = index + 1
+        keys = node.keys[:index] + node.keys[after:]
+        return _SortedLeaf(keys) if len(keys) > 0 else None
+    index = bisect.bisect_left(node.lasts, key)
+    if index == len(node.children):
+        return node
+    child = _sorted_remove(node.children[index], key)
+    if child is node.children[index]:
+        return node
+    after = index + 1
+    if child is None:
+        if len(node.children) == 1:
+            return None
+        return _SortedBranch(
+            node.children[:index] + node.children[after:],
+            node.lasts[:index] + node.lasts[after:],
+        )
+    return _SortedBranch(
+        node.children[:index] + (child,) + node.children[after:],
+        node.lasts[:index] + (_sorted_last(child),) + node.lasts[after:],
+    )
+
+
+def _sorted_keys(node: _SortedNode, reverse: bool) -> typing.Iterator[typing.Any]:
+    if isinstance(node, _SortedLeaf):
+        yield from reversed(node.keys) if reverse else node.keys
+        return
+    for child in reversed(node.children) if reverse else node.children:
+        yield from _sorted_keys(child, reverse)
+
+
+class PersistentSortedSet(typing.Generic[K]):
+    """
+    Immutable set that iterates its keys in sorted order, in either
+    direction. add and discard return a new set sharing most of its nodes
+    with this one.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    _root: typing.Optional[_SortedNode]
+    _size: int
+
+    def __init__(self, keys: typing.Iterable[K] = ()) -> None:
+        # keys only need to be ordered, which K doesn't promise mypy
+        distinct_keys: typing.Set[typing.Any] = set(keys)
+        unique_keys = tuple(sorted(distinct_keys))
+        # build the tree bottom up from full nodes
+        nodes: typing.Tuple[_SortedNode, ...] = tuple(
+            _SortedLeaf(chunk) for chunk in _chunks(unique_keys)
+        )
+        while len(nodes) > 1:
+            nodes = tuple(_sorted_branch(chunk) for chunk in _chunks(nodes))
+        self._root = nodes[0] if len(nodes) == 1 else None
+        self._size = len(unique_keys)
+
+    @staticmethod
+    def _from_root(
+        root: typing.Optional[_SortedNode], size: int
+    ) -> PersistentSortedSet[K]:
+        sorted_set: PersistentSortedSet[K] = PersistentSortedSet()
+        sorted_set._root = root
+        sorted_set._size = size
+        return sorted_set
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> typing.Iterator[K]:
+        if self._root is None:
+            return iter(())
+        return _sorted_keys(self._root, reverse=False)
+
+    def __reversed__(self) -> typing.Iterator[K]:
+        if self._root is None:
+            return iter(())
+        return _sorted_keys(self._root, reverse=True)
+
+    def __contains__(self, key: object) -> bool:
+        node = self._root
+        while isinstance(node, _SortedBranch):
+            index = bisect.bisect_left(node.lasts, key)
+            if index == len(node.children):
+                return False
+            node = node.children[index]
+        if node is None:
+            return False
+        index = bisect.bisect_left(node.keys, key)
+        return index < len(node.keys) and node.keys[index] == key
+
+    def add(self, key: K) -> PersistentSortedSet[K]:
+        if self._root is None:
+            return self._from_root(_SortedLeaf((key,)), 1)
+        added = _sorted_add(self._root, key)
+        if added is None:
+            return self
+        root = added[0] if len(added) == 1 else _sorted_branch(added)
+        return self._from_root(root, self._size + 1)
+
+    def discard(self, key: K) -> PersistentSortedSet[K]:
+        if self._root is None:
+            return self
+        root = _sorted_remove(self._root, key)
+        if root is self._root:
+            return self
+        # a branch left with one child is replaced by it
+        while isinstance(root, _SortedBranch) and len(root.children) == 1:
+            root = root.children[0]
+        return self._from_root(root, self._size - 1)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, PersistentSortedSet):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            key == other_key for key, other_key in zip(self, other)
+        )
+
+    def __repr__(self) -> str:
+        return f"PersistentSortedSet({list(self)!r})"
+
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        return (PersistentSortedSet, (tuple(self),))
+
+
+_T = typing.TypeVar("_T")
+
+
+def _chunks(items: typing.Tuple[_T, ...]) -> typing.Iterator[typing.Tuple[_T, ...]]:
+    for start in range(0, len(items), _SORTED_NODE_SIZE):
+        end = start + _SORTED_NODE_SIZE
+        yield items[start:end]
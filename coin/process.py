@@ -5,19 +5,41 @@ import queue
 from coin.multiprocessing import mp_ctx
 from coin.node_context import NodeContext
 from multiprocessing import Queue
+from multiprocessing.connection import Connection, wait
 
 M = typing.TypeVar("M")
 
 
-def receive_queue_messages(
-    ctx: NodeContext, message_queue: Queue[M]
-) -> typing.Optional[M]:
-    try:
-        message = message_queue.get(True, 0.1)
+def drain_queue_messages(ctx: NodeContext, message_queue: Queue[M]) -> typing.List[M]:
+    messages: typing.List[M] = []
+    while True:
+        try:
+            message = message_queue.get(False)
+        except queue.Empty:
+            return messages
         ctx.info(f"recv {message}")
-        return message
-    except queue.Empty:
-        return None
+        messages.append(message)
+
+
+def queue_reader(message_queue: Queue[typing.Any]) -> Connection:
+    # a multiprocessing queue is a pipe underneath, and the read end of that
+    # pipe can be waited on alongside other connections and sockets
+    reader: Connection = typing.cast(typing.Any, message_queue)._reader
+    return reader
+
+
+def wait_queues(
+    message_queues: typing.Sequence[Queue[typing.Any]],
+    timeout: typing.Optional[float] = None,
+) -> typing.List[Queue[typing.Any]]:
+    """
+    Blocks until at least one of the queues has something to get, and returns
+    those that do.
+    """
+    readers: typing.Dict[typing.Any, Queue[typing.Any]] = {
+        queue_reader(message_queue): message_queue for message_queue in message_queues
+    }
+    return [readers[reader] for reader in wait(list(readers), timeout)]
 
 
 def send_queue_message(ctx: NodeContext, message_queue: Queue[M], message: M) -> None:
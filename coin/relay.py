@@ -0,0 +1,288 @@
+"""
+Transaction relay by inventory. A node announces the hashes of the
+transactions it accepts to every peer that isn't known to have them yet,
+batched every ANNOUNCE_INTERVAL, and asks for the ones it hasn't seen from
+the first peer that announces them, moving on to the next announcer if that
+one doesn't deliver in time. Each node validates a transaction once and
+sends it to each peer at most once, however many peers it has.
+"""
+
+from __future__ import annotations
+import collections
+import time
+import typing
+from dataclasses import replace
+import coin.messaging as messaging
+from coin.mempool import try_add_transaction
+from coin.node_context import NodeContext
+from coin.node_state import RelayState, State, TransactionRequest
+from coin.persistent import RollingSet
+from coin.transaction import Transaction
+
+ANNOUNCE_INTERVAL = 0.5
+# transaction hashes per InventoryMessage; any past this in an incoming one
+# are ignored
+MAX_ANNOUNCEMENT = 1000
+# transactions asked for at once; announcements past this are ignored until
+# some arrive or time out
+MAX_REQUESTED = 5000
+# other announcers remembered per requested transaction
+MAX_ANNOUNCERS = 8
+# how many of a peer's transactions are remembered so they aren't announced
+# back to it
+KNOWN_PER_PEER = 5000
+# how many rejected transactions are remembered until the best head changes
+MAX_REJECTED = 5000
+# a transaction that was asked for and didn't arrive in time is asked for
+# again from the next peer that announced it
+TRANSACTION_REQUEST_TIMEOUT = 5.0
+
+
+def mark_known(
+    relay: RelayState,
+    peer: messaging.Address,
+    transaction_hashes: typing.Iterable[bytes],
+) -> RelayState:
+    known = relay.known.get(peer)
+    if known is None:
+        known = RollingSet(capacity=KNOWN_PER_PEER)
+    for transaction_hash in transaction_hashes:
+        known = known.add(transaction_hash)
+    return replace(relay, known=relay.known.set(peer, known))
+
+
+def _rejected(state: State) -> RollingSet[bytes]:
+    """
+    The transactions rejected against the current best head.
+    """
+    if state.relay.rejected_head != state.best_head.block.header.block_hash:
+        return RollingSet(capacity=MAX_REJECTED)
+    return state.relay.rejected
+
+
+def _known_to_node(state: State, transaction_hash: bytes) -> bool:
+    return (
+        transaction_hash in state.relay.seen
+        or transaction_hash in state.mempool.entries
+        or transaction_hash in _rejected(state)
+    )
+
+
+def request_transactions(
+    state: State,
+    peer: messaging.Address,
+    transaction_hashes: typing.Sequence[bytes],
+    now: float,
+) -> typing.Tuple[State, typing.Optional[messaging.GetDataMessage]]:
+    """
+    Asks the announcing peer for the transactions this node hasn't seen and
+    isn't already waiting for. Those it is waiting for from someone else
+    remember the peer as a fallback.
+    """
+    transaction_hashes = transaction_hashes[:MAX_ANNOUNCEMENT]
+    relay = mark_known(state.relay, peer, transaction_hashes)
+    requested = relay.requested
+    wanted = []
+    for transaction_hash in transaction_hashes:
+        if _known_to_node(state, transaction_hash):
+            continue
+        request = requested.get(transaction_hash)
+        if request is not None:
+            if (
+                peer != request.peer
+                and peer not in request.announcers
+                and len(request.announcers) < MAX_ANNOUNCERS
+            ):
+                requested = requested.set(
+                    transaction_hash,
+                    replace(request, announcers=request.announcers + (peer,)),
+                )
+            continue
+        if len(requested) >= MAX_REQUESTED:
+            continue
+        requested = requested.set(
+            transaction_hash, TransactionRequest(peer=peer, requested_at=now)
+        )
+        wanted.append(transaction_hash)
+    state = replace(
+        state,
+        relay=replace(
+            relay,
+            requested=requested,
+            requests_expire_at=(
+                relay.requests_expire_at
+                if relay.requests_expire_at is not None or len(wanted) == 0
+                else now + TRANSACTION_REQUEST_TIMEOUT
+            ),
+        ),
+    )
+    if len(wanted) == 0:
+        return state, None
+    return state, _get_transactions(wanted)
+
+
+def _get_transactions(
+    transaction_hashes: typing.Sequence[bytes],
+) -> messaging.GetDataMessage:
+    return messaging.GetDataMessage(
+        payload=messaging.GetDataMessage.Payload(
+            objects_requested=(), transactions_requested=tuple(transaction_hashes)
+        )
+    )
+
+
+def send_transactions(
+    state: State,
+    peer: messaging.Address,
+    transaction_hashes: typing.Sequence[bytes],
+) -> typing.Tuple[State, typing.List[messaging.TransactionMessage]]:
+    transactions = []
+    for transaction_hash in transaction_hashes:
+        entry = state.mempool.entries.get(transaction_hash)
+        if entry is not None:
+            transactions.append(
+                messaging.TransactionMessage(
+                    payload=messaging.TransactionMessage.Payload(
+                        transaction=entry.transaction
+                    )
+                )
+            )
+    relay = mark_known(state.relay, peer, transaction_hashes)
+    return replace(state, relay=relay), transactions
+
+
+def receive_transaction(
+    ctx: NodeContext,
+    state: State,
+    peer: messaging.Address,
+    transaction: Transaction,
+) -> State:
+    """
+    Validates a transaction the first time it arrives, and queues it to be
+    announced if the mempool takes it. One it turns down is only remembered
+    until the best head changes, since it may just be early.
+    """
+    transaction_hash = transaction.hash()
+    relay = mark_known(state.relay, peer, [transaction_hash])
+    relay = replace(relay, requested=relay.requested.discard(transaction_hash))
+    if _known_to_node(state, transaction_hash):
+        return replace(state, relay=replace(relay, duplicates=relay.duplicates + 1))
+
+    relay = replace(relay, validated=relay.validated + 1)
+    mempool = try_add_transaction(ctx, state.mempool, transaction)
+    if transaction_hash in mempool.entries:
+        relay = replace(
+            relay,
+            seen=relay.seen.add(transaction_hash),
+            announcements=relay.announcements + (transaction_hash,),
+            announce_at=(
+                relay.announce_at
+                if relay.announce_at is not None
+                else time.monotonic() + ANNOUNCE_INTERVAL
+            ),
+        )
+    else:
+        relay = replace(
+            relay,
+            rejected=_rejected(state).add(transaction_hash),
+            rejected_head=state.best_head.block.header.block_hash,
+        )
+    return replace(state, mempool=mempool, relay=relay)
+
+
+def announce(
+    ctx: NodeContext, state: State, now: float
+) -> typing.Tuple[State, typing.List[messaging.AddressedMessage]]:
+    """
+    Once the batch is due, announces the queued transactions that are still
+    in the mempool to each peer that isn't known to have them.
+    """
+    relay = state.relay
+    if relay.announce_at is None or now < relay.announce_at:
+        return state, []
+
+    pending = [
+        transaction_hash
+        for transaction_hash in relay.announcements
+        if transaction_hash in state.mempool.entries
+    ]
+    messages = []
+    for peer in sorted(state.peers):
+        known = relay.known.get(peer)
+        new_hashes = [
+            transaction_hash
+            for transaction_hash in pending
+            if known is None or transaction_hash not in known
+        ]
+        relay = mark_known(relay, peer, new_hashes)
+        for start in range(0, len(new_hashes), MAX_ANNOUNCEMENT):
+            end = start + MAX_ANNOUNCEMENT
+            messages.append(
+                messaging.AddressedMessage(
+                    message=messaging.InventoryMessage(
+                        payload=messaging.InventoryMessage.Payload(
+                            header_hashes=(),
+                            transaction_hashes=tuple(new_hashes[start:end]),
+                        )
+                    ),
+                    sender_address=ctx.node_id,
+                    recipient_address=peer,
+                )
+            )
+
+    return (
+        replace(state, relay=replace(relay, announcements=(), announce_at=None)),
+        messages,
+    )
+
+
+def expire_requests(
+    ctx: NodeContext, state: State, now: float
+) -> typing.Tuple[State, typing.List[messaging.AddressedMessage]]:
+    """
+    Once the oldest request has timed out, asks the next announcer of each
+    timed out transaction for it, and forgets those nobody else announced.
+    """
+    relay = state.relay
+    if relay.requests_expire_at is None or now < relay.requests_expire_at:
+        return state, []
+
+    requested = relay.requested
+    retries: typing.Dict[messaging.Address, typing.List[bytes]] = (
+        collections.defaultdict(list)
+    )
+    for transaction_hash, request in relay.requested.items():
+        if now - request.requested_at < TRANSACTION_REQUEST_TIMEOUT:
+            continue
+        if len(request.announcers) == 0:
+            requested = requested.delete(transaction_hash)
+            continue
+        next_peer, *announcers = request.announcers
+        requested = requested.set(
+            transaction_hash,
+            TransactionRequest(
+                peer=next_peer, requested_at=now, announcers=tuple(announcers)
+            ),
+        )
+        retries[next_peer].append(transaction_hash)
+    state = replace(
+        state,
+        relay=replace(
+            relay,
+            requested=requested,
+            requests_expire_at=(
+                min(request.requested_at for request in requested.values())
+                + TRANSACTION_REQUEST_TIMEOUT
+                if len(requested) > 0
+                else None
+            ),
+        ),
+    )
+    return state, [
+        messaging.AddressedMessage(
+            message=_get_transactions(transaction_hashes),
+            sender_address=ctx.node_id,
+            recipient_address=peer,
+        )
+        for peer, transaction_hashes in retries.items()
+    ]
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import heapq
+import itertools
+import queue
+import time
+import typing
+from dataclasses import dataclass, field
+from multiprocessing import Queue
+import coin.messaging as messaging
+
+
+@dataclass(frozen=True)
+class Link:
+    """
+    One direction of the connection between two simulated nodes. latency is
+    in seconds and bandwidth in bytes per second, None meaning unlimited.
+    """
+
+    latency: float = 0.0
+    bandwidth: typing.Optional[float] = None
+
+
+@dataclass
+class Router:
+    """
+    Stands in for the network between nodes that only have queues: every node
+    puts what it sends on one shared queue, and the router hands each message
+    to its recipient's queue once the link between them would have carried
+    it. A link sends one message at a time, so a large block holds up the
+    messages queued behind it on the same link.
+    """
+
+    messages_in: typing.Mapping[messaging.Address, Queue[messaging.AddressedMessage]]
+    default_link: Link = Link()
+    links: typing.Mapping[typing.Tuple[messaging.Address, messaging.Address], Link] = (
+        field(default_factory=dict)
+    )
+    routed: int = 0
+    dropped: int = 0
+    _in_flight: typing.List[typing.Tuple[float, int, messaging.AddressedMessage]] = (
+        field(default_factory=list)
+    )
+    _busy_until: typing.Dict[
+        typing.Tuple[messaging.Address, messaging.Address], float
+    ] = field(default_factory=dict)
+    _sequence: typing.Iterator[int] = field(default_factory=itertools.count)
+
+    def receive(self, messages_out: Queue[messaging.AddressedMessage]) -> None:
+        """
+        Takes every message that is waiting on messages_out.
+        """
+        while True:
+            try:
+                addressed_message = messages_out.get(False)
+            except queue.Empty:
+                return
+            self.route(addressed_message)
+
+    def route(self, addressed_message: messaging.AddressedMessage) -> None:
+        if addressed_message.recipient_address not in self.messages_in:
+            self.dropped += 1
+            return
+        direction = (
+            addressed_message.sender_address,
+            addressed_message.recipient_address,
+        )
+        link = self.links.get(direction, self.default_link)
+        if link.latency == 0 and link.bandwidth is None:
+            self._deliver(addressed_message)
+            return
+        sent_at = time.monotonic()
+        if link.bandwidth is not None:
+            sent_at = max(sent_at, self._busy_until.get(direction, 0.0))
+            # the same bytes the recipient's queue carries, which the message
+            # usually still has from being decoded off the sender's queue
+            sent_at += len(addressed_message.encoded()) / link.bandwidth
+            self._busy_until[direction] = sent_at
+        heapq.heappush(
+            self._in_flight,
+            (sent_at + link.latency, next(self._sequence), addressed_message),
+        )
+
+    def _deliver(self, addressed_message: messaging.AddressedMessage) -> None:
+        self.messages_in[addressed_message.recipient_address].put(addressed_message)
+        self.routed += 1
+
+    def deliver_due(self) -> typing.Optional[float]:
+        """
+        Delivers every message whose time has come, and returns how long until
+        the next one is due, or None if nothing is in flight.
+        """
+        now = time.monotonic()
+        while len(self._in_flight) > 0 and self._in_flight[0][0] <= now:
+            _, _, addressed_message = heapq.heappop(self._in_flight)
+            self._deliver(addressed_message)
+        if len(self._in_flight) == 0:
+            return None
+        return self._in_flight[0][0] - now
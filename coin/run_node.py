@@ -1,47 +1,272 @@
 from __future__ import annotations
-from dataclasses import replace
+from dataclasses import dataclass, field, replace
 from multiprocessing import Queue
+import time
 import typing
 from coin.node_context import NodeContext
 import coin.messaging as messaging
 from coin.listen import listen
-from coin.node_state import State, Chains, StartupState, try_add_block, Mempool
-from coin.genesis import GENESIS_BLOCK
+from coin.node_state import (
+    State,
+    StartupState,
+    genesis_chains,
+    load_chains,
+    try_add_block,
+)
+from coin.mempool import (
+    EXPIRY_CHECK_INTERVAL,
+    MAX_BLOCK_BYTES,
+    MAX_BLOCK_TRANSACTIONS,
+    Mempool,
+    expire_transactions,
+    select_transactions,
+)
+from coin.persistent import PersistentMap
+from coin.block_store import BlockStore
 from coin.block import OpenBlock, OpenBlockHeader, SealedBlock
-from coin.ledger import Ledger
 import coin.transaction as transaction
-from coin.merkle import LeafMerkleNode, MerkleForest
+from coin.merkle import build_merkle_tree
 from coin.mining import MiningProcessHandle, MiningProcessConfig
-from coin.process import receive_queue_messages, send_queue_message
+from coin.relay import announce, expire_requests
+from coin.sync import next_timeout, schedule_downloads
+from coin.process import drain_queue_messages, send_queue_message, wait_queues
 
 
-def build_next_block(state: State) -> OpenBlock:
-    transaction_tree = state.mempool.transactions.merge()
+def build_next_block(
+    ctx: NodeContext,
+    state: State,
+    *,
+    max_bytes: int = MAX_BLOCK_BYTES,
+    max_transactions: int = MAX_BLOCK_TRANSACTIONS,
+) -> OpenBlock:
+    previous_block_hash = state.best_head.block.header.block_hash
+    entries = select_transactions(
+        state.mempool, max_bytes=max_bytes, max_transactions=max_transactions
+    )
+    transaction_tree = build_merkle_tree(
+        [
+            transaction.make_reward_transaction(
+                ctx, previous_block_hash, sum(entry.fee for entry in entries)
+            ),
+            *(entry.transaction for entry in entries),
+        ]
+    )
+    assert transaction_tree is not None
     return OpenBlock(
         header=OpenBlockHeader(
-            previous_block_hash=state.best_head.block.header.block_hash,
+            previous_block_hash=previous_block_hash,
             transaction_tree_hash=transaction_tree.node_hash(),
         ),
         transaction_tree=transaction_tree,
     )
 
 
-def broadcast_message(
+def address_message(
     ctx: NodeContext,
-    messages_out: Queue[messaging.AddressedMessage],
     peers: typing.Iterable[messaging.Address],
     message: messaging.Message,
-) -> None:
+) -> typing.List[messaging.AddressedMessage]:
+    addressed_messages = []
     for peer in peers:
         if peer == ctx.node_id:
             ctx.info("tried to send message to self")
             continue
-        addressed_message = messaging.AddressedMessage(
-            message=message,
-            recipient_address=peer,
-            sender_address=ctx.node_id,
+        addressed_messages.append(
+            messaging.AddressedMessage(
+                message=message,
+                recipient_address=peer,
+                sender_address=ctx.node_id,
+            )
         )
-        send_queue_message(ctx, messages_out, addressed_message)
+    return addressed_messages
+
+
+def start_state(
+    ctx: NodeContext,
+    init_peers: typing.Iterable[messaging.Address],
+    startup_state: StartupState,
+) -> State:
+    block_store = BlockStore(ctx.data_dir) if ctx.data_dir is not None else None
+    if block_store is not None:
+        block_lookup = load_chains(ctx, block_store)
+    else:
+        genesis = genesis_chains()
+        block_lookup = PersistentMap({genesis.block.header.block_hash: genesis})
+    best_head = max(block_lookup.values(), key=lambda chains: chains.height)
+    return State(
+        best_head=best_head,
+        block_lookup=block_lookup,
+        startup_state=startup_state,
+        mempool=Mempool(ledger=best_head.get_ledger()),
+        peers=frozenset(init_peers),
+        block_store=block_store,
+    )
+
+
+@dataclass
+class NodeRunner:
+    """
+    A node's behaviour apart from how its messages travel: each method takes
+    whatever arrived and returns the messages to send, so the queue-relayed
+    and socket transports drive the same node.
+    """
+
+    ctx: NodeContext
+    state: State
+    difficulty: int = 3
+    mining_process: typing.Optional[MiningProcessHandle] = None
+    max_block_bytes: int = MAX_BLOCK_BYTES
+    max_block_transactions: int = MAX_BLOCK_TRANSACTIONS
+    next_expiry_check: float = field(
+        default_factory=lambda: time.monotonic() + EXPIRY_CHECK_INTERVAL
+    )
+
+    def _set_state(self, new_state: State) -> None:
+        if self.mining_process is not None and (
+            new_state.mempool is not self.state.mempool
+            or new_state.best_head is not self.state.best_head
+        ):
+            self.mining_process.invalidate_template()
+        self.state = new_state
+
+    def handle_message(
+        self, message: messaging.AddressedMessage
+    ) -> typing.List[messaging.AddressedMessage]:
+        result = listen(self.ctx, self.state, message.message, message.sender_address)
+        if result is None:
+            return []
+        if result.new_state is not None:
+            self._set_state(result.new_state)
+        outgoing = list(result.addressed)
+        for response in result.responses:
+            outgoing.extend(
+                address_message(self.ctx, [message.sender_address], response)
+            )
+        return outgoing
+
+    def step(self) -> typing.List[messaging.AddressedMessage]:
+        """
+        Moves startup along and keeps the miners on a current template.
+        """
+        outgoing = []
+        if self.state.startup_state == StartupState.PEERING:
+            outgoing.extend(
+                address_message(
+                    self.ctx,
+                    self.state.peers,
+                    messaging.VersionMessage(
+                        payload=messaging.VersionMessage.Payload(version="0.0.0")
+                    ),
+                )
+            )
+            self.state = replace(self.state, startup_state=StartupState.CONNECTING)
+
+        now = time.monotonic()
+        if now >= self.next_expiry_check:
+            self._set_state(
+                replace(
+                    self.state,
+                    mempool=expire_transactions(self.ctx, self.state.mempool, now),
+                )
+            )
+            self.next_expiry_check = now + EXPIRY_CHECK_INTERVAL
+
+        self.state, announcements = announce(self.ctx, self.state, now)
+        outgoing.extend(announcements)
+        self.state, rerequests = expire_requests(self.ctx, self.state, now)
+        outgoing.extend(rerequests)
+
+        if self.state.sync.downloading:
+            self.state, requests = schedule_downloads(
+                self.ctx, self.state, time.monotonic()
+            )
+            outgoing.extend(requests)
+
+        if self.state.startup_state == StartupState.SYNCED:
+            if self.mining_process is None:
+                self.mining_process = MiningProcessHandle(
+                    config=MiningProcessConfig(ctx=self.ctx, difficulty=self.difficulty)
+                )
+            if self.mining_process.next_block is None:
+                self.mining_process.update_template(
+                    build_next_block(
+                        self.ctx,
+                        self.state,
+                        max_bytes=self.max_block_bytes,
+                        max_transactions=self.max_block_transactions,
+                    )
+                )
+        return outgoing
+
+    def wakeup_delay(self) -> typing.Optional[float]:
+        """
+        How long the node can sleep if nothing arrives, None meaning forever.
+        """
+        timeout = next_timeout(self.state.sync)
+        if len(self.state.mempool.entries) > 0:
+            timeout = min(
+                self.next_expiry_check,
+                timeout if timeout is not None else self.next_expiry_check,
+            )
+        relay = self.state.relay
+        for relay_timeout in (relay.announce_at, relay.requests_expire_at):
+            if relay_timeout is not None:
+                timeout = min(
+                    relay_timeout, timeout if timeout is not None else relay_timeout
+                )
+        if timeout is None:
+            return None
+        return max(0.0, timeout - time.monotonic())
+
+    def handle_mined_block(
+        self, new_block: SealedBlock
+    ) -> typing.List[messaging.AddressedMessage]:
+        assert self.mining_process is not None
+        self.ctx.info(
+            f"mined block at {self.mining_process.hashrate():.0f} hashes/s across {self.mining_process.config.workers} workers"
+        )
+        self._set_state(try_add_block(self.ctx, self.state, new_block))
+        assert new_block.header.block_hash in self.state.block_lookup
+        return address_message(
+            self.ctx,
+            self.state.peers,
+            messaging.BlockMessage(
+                payload=messaging.BlockMessage.Payload(block=new_block)
+            ),
+        )
+
+    def finish(self) -> State:
+        if self.mining_process is not None:
+            self.mining_process.stop()
+        signature_cache = self.ctx.signature_verifier.cache
+        self.ctx.info(
+            f"signature cache: {signature_cache.hits} hits, {signature_cache.misses} misses, {signature_cache.evictions} evictions"
+        )
+        key_cache = self.ctx.signature_verifier.keys
+        self.ctx.info(
+            f"verifying key cache: {key_cache.hits} hits, {key_cache.misses} misses, {key_cache.evictions} evictions, {key_cache.precomputed} precomputed, {key_cache.released} released"
+        )
+        mempool = self.state.mempool
+        self.ctx.info(
+            f"mempool: {len(mempool.entries)} transactions in {mempool.size} bytes, {mempool.evicted} evicted, {mempool.expired} expired, {mempool.replaced} replaced"
+        )
+        relay = self.state.relay
+        self.ctx.info(
+            f"relay: {relay.validated} transactions validated, {relay.duplicates} duplicates, {len(relay.requested)} requests outstanding"
+        )
+        orphans = self.state.orphans
+        self.ctx.info(
+            f"orphan pool: {len(orphans)} blocks in {orphans.size} bytes, {orphans.added} added, {orphans.adopted} adopted, {orphans.evicted} evicted"
+        )
+        self.ctx.signature_verifier.close()
+        block_store = self.state.block_store
+        if block_store is not None:
+            block_store.save_ledger(
+                self.state.best_head.block.header.block_hash,
+                self.state.best_head.get_ledger(),
+            )
+            block_store.close()
+        return self.state
 
 
 def run_node(
@@ -52,89 +277,43 @@ def run_node(
     init_peers: typing.Iterable[messaging.Address],
     *,
     MAX_TRIES: int = 10000,
+    STOP_HEIGHT: int = 5,
     INIT_STARTUP_STATE: StartupState = StartupState.PEERING,
 ) -> None:
     ctx.info("starting node...")
-    genesis_chains = Chains(parent=None, height=1, block=GENESIS_BLOCK, ledger=Ledger())
-    state = State(
-        best_head=genesis_chains,
-        block_lookup={GENESIS_BLOCK.header.block_hash: genesis_chains},
-        startup_state=INIT_STARTUP_STATE,
-        mempool=Mempool(
-            transactions=MerkleForest(
-                trees=(
-                    LeafMerkleNode(
-                        payload=transaction.make_reward_transaction(ctx), height=1
-                    ),
-                )
+    runner = NodeRunner(ctx=ctx, state=start_state(ctx, init_peers, INIT_STARTUP_STATE))
+
+    def send_all(addressed_messages: typing.List[messaging.AddressedMessage]) -> None:
+        for addressed_message in addressed_messages:
+            send_queue_message(ctx, messages_out, addressed_message)
+
+    while runner.state.best_head.height < STOP_HEIGHT:
+        send_all(runner.step())
+
+        # sleep until there is a message, a mining result or a block request
+        # to time out, whichever is first
+        mining_process = runner.mining_process
+        ready = wait_queues(
+            (
+                [messages_in]
+                if mining_process is None
+                else [messages_in, mining_process.result_queue]
             ),
-            ledger=Ledger(),
-        ),
-        peers=frozenset(init_peers),
-    )
-    difficulty = 3
-    mining_process = None
-    while state.best_head.height < 5:
-        message: typing.Optional[messaging.AddressedMessage]
-        message = receive_queue_messages(ctx, messages_in)
-        if message is not None:
-            result = listen(ctx, state, message.message)
-            if result is not None:
-                if result.new_state is not None:
-                    if (
-                        result.new_state.mempool != state.mempool
-                        and mining_process is not None
-                    ):
-                        mining_process.terminate()
-                        mining_process = None
-                    state = result.new_state
-                for response in result.responses:
-                    broadcast_message(
-                        ctx, messages_out, [message.sender_address], response
-                    )
-                for addressed_message in result.addressed:
-                    send_queue_message(ctx, messages_out, addressed_message)
-
-        if state.startup_state == StartupState.PEERING:
-            broadcast_message(
-                ctx,
-                messages_out,
-                state.peers,
-                messaging.VersionMessage(
-                    payload=messaging.VersionMessage.Payload(version="0.0.0")
-                ),
-            )
-            state = replace(state, startup_state=StartupState.CONNECTING)
+            runner.wakeup_delay(),
+        )
 
-        if state.startup_state == StartupState.SYNCED and mining_process is None:
+        if messages_in in ready:
+            for message in drain_queue_messages(ctx, messages_in):
+                send_all(runner.handle_message(message))
 
-            next_block = build_next_block(state)
-            mining_process = MiningProcessHandle(
-                config=MiningProcessConfig(
-                    ctx=ctx, difficulty=difficulty, next_block=next_block
-                )
+        if mining_process is not None and mining_process.result_queue in ready:
+            result = mining_process.wait_result(0)
+            new_block = (
+                mining_process.accept_result(ctx, result)
+                if result is not None
+                else None
             )
-
-        if mining_process is not None:
-            sealed_header = receive_queue_messages(ctx, mining_process.result_queue)
-            if sealed_header is not None:
-                new_block = SealedBlock(
-                    header=sealed_header,
-                    transaction_tree=mining_process.config.next_block.transaction_tree,
-                )
-                state = try_add_block(ctx, state, new_block)
-                assert sealed_header.block_hash in state.block_lookup
-                broadcast_message(
-                    ctx,
-                    messages_out,
-                    state.peers,
-                    messaging.BlockMessage(
-                        payload=messaging.BlockMessage.Payload(block=new_block)
-                    ),
-                )
-                mining_process.stop()
-                mining_process = None
-    if mining_process is not None:
-        mining_process.terminate()
-    send_queue_message(ctx, result_out, state)
+            if new_block is not None:
+                send_all(runner.handle_mined_block(new_block))
+    send_queue_message(ctx, result_out, runner.finish())
     ctx.info("done")
@@ -1,57 +1,67 @@
-import queue
+import sys
+import typing
+import multiprocessing as mp
 from coin.multiprocessing import mp_ctx
 from coin.node_context import NodeContext
+from coin.node_state import State
 from coin.run_node import run_node
-from coin.process import Process
-
-
-def simulate_many() -> None:
-    processes = {}
-    messages_in = {}
-    messages_out = {}
-    result_out = {}
-    PIDS = ["a", "b", "c", "d", "e"]
-    for i, pid in enumerate(PIDS):
-        messages_in[pid] = mp_ctx.Queue()
-        messages_out[pid] = mp_ctx.Queue()
-        result_out[pid] = mp_ctx.Queue()
-        processes[pid] = Process(
+from coin.messaging import AddressedMessage
+from coin.process import Process, wait_queues
+from coin.router import Link, Router
+
+
+def simulate_many(
+    nodes: int = 5,
+    *,
+    default_link: Link = Link(),
+    links: typing.Optional[typing.Mapping[typing.Tuple[str, str], Link]] = None,
+) -> None:
+    if links is None:
+        links = {}
+    messages_out: mp.Queue[AddressedMessage] = mp_ctx.Queue()
+    result_out: mp.Queue[State] = mp_ctx.Queue()
+    pids = [f"n{i}" for i in range(nodes)]
+    messages_in: typing.Dict[str, mp.Queue[AddressedMessage]] = {
+        pid: mp_ctx.Queue() for pid in pids
+    }
+    processes = {
+        pid: Process(
             target=run_node,
             kwargs={
                 "ctx": NodeContext(node_id=pid),
                 "messages_in": messages_in[pid],
-                "messages_out": messages_out[pid],
-                "result_out": result_out[pid],
-                "init_peers": {PIDS[(i + 1) % len(PIDS)]},
+                "messages_out": messages_out,
+                "result_out": result_out,
+                "init_peers": {pids[(i + 1) % len(pids)]},
             },
         )
+        for i, pid in enumerate(pids)
+    }
+    router = Router(messages_in=messages_in, default_link=default_link, links=links)
 
     for process in processes.values():
         process.start()
 
     result = None
     while result is None:
+        ready = wait_queues([messages_out, result_out], router.deliver_due())
+        if messages_out in ready:
+            router.receive(messages_out)
+        if result_out in ready:
+            result = result_out.get()
 
-        for pid, out_queue in messages_out.items():
-            try:
-                message = out_queue.get(True, 0.2)
-                assert message.sender_address == pid
-                messages_in[message.recipient_address].put(message)
-            except queue.Empty:
-                pass
-
-        for pid, result_queue in result_out.items():
-            try:
-                result = result_queue.get(False)
-                break
-            except queue.Empty:
-                pass
-
-    for process in processes:
+    for process in processes.values():
         process.terminate()
 
-    print(result.best_head.ledger.balances, flush=True)
+    print(f"routed {router.routed} messages, dropped {router.dropped}", flush=True)
+    print(result.best_head.get_ledger().balances(), flush=True)
 
 
 if __name__ == "__main__":
-    simulate_many()
+    simulate_many(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+        default_link=Link(
+            latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0,
+            bandwidth=float(sys.argv[3]) if len(sys.argv) > 3 else None,
+        ),
+    )
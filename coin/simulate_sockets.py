@@ -0,0 +1,64 @@
+import os
+import queue
+import sys
+import tempfile
+import typing
+import multiprocessing as mp
+from coin.multiprocessing import mp_ctx
+from coin.node_context import NodeContext
+from coin.node_state import State
+from coin.process import Process
+from coin.socket_node import run_socket_node
+
+
+def simulate_sockets(nodes: int, *, tcp_port: typing.Optional[int] = None) -> None:
+    """
+    Like simulate_many, but the nodes connect to each other directly instead
+    of through this process: over Unix sockets in a temporary directory, or
+    over TCP on localhost from tcp_port up when it is given.
+    """
+    socket_dir = tempfile.mkdtemp(prefix="coin-")
+    addresses = [
+        (
+            f"127.0.0.1:{tcp_port + i}"
+            if tcp_port is not None
+            else f"unix:{os.path.join(socket_dir, f'{i}.sock')}"
+        )
+        for i in range(nodes)
+    ]
+    result_out: mp.Queue[State] = mp_ctx.Queue()
+    processes = [
+        Process(
+            target=run_socket_node,
+            kwargs={
+                "ctx": NodeContext(node_id=address),
+                "result_out": result_out,
+                "init_peers": {addresses[(i + 1) % nodes]},
+            },
+        )
+        for i, address in enumerate(addresses)
+    ]
+
+    for process in processes:
+        process.start()
+
+    result = None
+    while result is None:
+        try:
+            result = result_out.get(True, 0.2)
+        except queue.Empty:
+            pass
+        for process in processes:
+            if process.exception:
+                print(process.exception, flush=True)
+                return
+    for process in processes:
+        process.terminate()
+    print(result.best_head.get_ledger().balances(), flush=True)
+
+
+if __name__ == "__main__":
+    simulate_sockets(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+        tcp_port=int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
@@ -44,7 +44,7 @@ def simulate_two() -> None:
                 return
     for process in processes:
         process.terminate()
-    print(result.best_head.ledger.balances, flush=True)
+    print(result.best_head.get_ledger().balances(), flush=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+from __future__ import annotations
+import asyncio
+import typing
+from multiprocessing import Queue
+import coin.messaging as messaging
+from coin.node_context import NodeContext
+from coin.node_state import State, StartupState
+from coin.process import queue_reader, send_queue_message
+from coin.run_node import NodeRunner, start_state
+from coin.transport import PeerTransport
+
+
+async def serve_node(
+    ctx: NodeContext,
+    init_peers: typing.Iterable[messaging.Address],
+    *,
+    STOP_HEIGHT: int = 5,
+    INIT_STARTUP_STATE: StartupState = StartupState.PEERING,
+) -> State:
+    """
+    Runs a node on its own event loop, listening on ctx.node_id. Messages are
+    handled as they come off the sockets, and the loop sleeps until either a
+    message arrives or a miner finds a block.
+    """
+    ctx.info("starting node...")
+    runner = NodeRunner(ctx=ctx, state=start_state(ctx, init_peers, INIT_STARTUP_STATE))
+    woken = asyncio.Event()
+
+    def send_all(
+        addressed_messages: typing.Iterable[messaging.AddressedMessage],
+    ) -> None:
+        for addressed_message in addressed_messages:
+            transport.send(addressed_message)
+
+    def on_message(addressed_message: messaging.AddressedMessage) -> None:
+        send_all(runner.handle_message(addressed_message))
+        woken.set()
+
+    transport = PeerTransport(ctx, on_message)
+    await transport.start()
+    loop = asyncio.get_running_loop()
+    watched_results: typing.Optional[int] = None
+    try:
+        while runner.state.best_head.height < STOP_HEIGHT:
+            send_all(runner.step())
+            mining_process = runner.mining_process
+            if mining_process is not None and watched_results is None:
+                watched_results = queue_reader(mining_process.result_queue).fileno()
+                loop.add_reader(watched_results, woken.set)
+            try:
+                await asyncio.wait_for(woken.wait(), runner.wakeup_delay())
+            except asyncio.TimeoutError:
+                pass
+            woken.clear()
+            if mining_process is not None:
+                result = mining_process.wait_result(0)
+                new_block = (
+                    mining_process.accept_result(ctx, result)
+                    if result is not None
+                    else None
+                )
+                if new_block is not None:
+                    send_all(runner.handle_mined_block(new_block))
+    finally:
+        if watched_results is not None:
+            loop.remove_reader(watched_results)
+        await transport.close()
+    state = runner.finish()
+    ctx.info("done")
+    return state
+
+
+def run_socket_node(
+    ctx: NodeContext,
+    result_out: Queue[State],
+    init_peers: typing.Iterable[messaging.Address],
+    **kwargs: typing.Any,
+) -> None:
+    send_queue_message(
+        ctx, result_out, asyncio.run(serve_node(ctx, init_peers, **kwargs))
+    )
@@ -0,0 +1,336 @@
+"""
+Headers-first block download. Headers are small and checked on their own, so
+a node first learns the chain it is missing from one peer's headers and then
+fetches the bodies from every peer at once, a few blocks per peer at a time.
+Bodies can arrive in any order; they are connected in header order as soon as
+everything before them is in.
+"""
+
+from __future__ import annotations
+import collections
+import time
+import typing
+from dataclasses import replace
+import coin.messaging as messaging
+from coin.block import SealedBlock, SealedBlockHeader
+from coin.node_context import NodeContext
+from coin.node_state import (
+    BlockRequest,
+    State,
+    StartupState,
+    SyncState,
+    blocks_after,
+    fork_point,
+    try_add_block,
+)
+
+# headers per HeadersMessage; a full one means the peer has more to send
+MAX_HEADERS = 2000
+MAX_IN_FLIGHT_PER_PEER = 16
+# bodies are only requested this many blocks past the first one not yet
+# connected, which bounds how many early bodies wait on a slow peer
+DOWNLOAD_WINDOW = 1024
+# a request that isn't answered in time is sent to another peer
+BLOCK_TIMEOUT = 5.0
+
+
+def next_timeout(sync: SyncState) -> typing.Optional[float]:
+    """
+    When the oldest outstanding block request times out, if there is one.
+    """
+    if len(sync.in_flight) == 0:
+        return None
+    return (
+        min(request.requested_at for request in sync.in_flight.values()) + BLOCK_TIMEOUT
+    )
+
+
+def request_headers(
+    header_hashes: typing.Tuple[bytes, ...],
+) -> messaging.GetHeadersMessage:
+    return messaging.GetHeadersMessage(
+        payload=messaging.GetHeadersMessage.Payload(
+            header_hashes=header_hashes, stopping_hash=None
+        )
+    )
+
+
+def headers_after(
+    state: State,
+    header_hashes: typing.Sequence[bytes],
+    stopping_hash: typing.Optional[bytes],
+) -> typing.Tuple[SealedBlockHeader, ...]:
+    """
+    The headers on the best chain after the last block it shares with the
+    first of header_hashes that we know, oldest first.
+    """
+    known = next(
+        (
+            state.block_lookup[header_hash]
+            for header_hash in header_hashes
+            if header_hash in state.block_lookup
+        ),
+        None,
+    )
+    # a locator always ends with genesis, so this only falls back to it for
+    # a peer that sent nothing useful
+    shared = (
+        fork_point(known, state.best_head)
+        if known is not None
+        else state.best_head.ancestor(1)
+    )
+    assert shared is not None
+    headers: typing.List[SealedBlockHeader] = []
+    for chains in blocks_after(state.best_head, shared, MAX_HEADERS):
+        headers.append(chains.block.header)
+        if chains.block.header.block_hash == stopping_hash:
+            break
+    return tuple(headers)
+
+
+def add_headers(
+    ctx: NodeContext, state: State, headers: typing.Sequence[SealedBlockHeader]
+) -> typing.Tuple[State, typing.List[messaging.AddressedMessage]]:
+    """
+    Queues the block of every new header that extends one we have and starts
+    downloading them.
+    """
+    sync = state.sync
+    new_headers = sync.headers
+    new_pending = []
+    for header in headers:
+        block_hash = header.block_hash
+        if block_hash in state.block_lookup or block_hash in new_headers:
+            continue
+        parent_hash = header.previous_block_hash
+        if parent_hash not in state.block_lookup and parent_hash not in new_headers:
+            ctx.warning("received headers that don't connect to our chain")
+            break
+        if not header.validate_hash():
+            ctx.warning("invalid header received")
+            break
+        new_headers = new_headers.set(block_hash, header)
+        new_pending.append(block_hash)
+    state = replace(
+        state,
+        sync=replace(
+            sync, headers=new_headers, pending=sync.pending + tuple(new_pending)
+        ),
+    )
+    state, requests = schedule_downloads(ctx, state, time.monotonic())
+    return finish_sync(state), requests
+
+
+def schedule_downloads(
+    ctx: NodeContext, state: State, now: float
+) -> typing.Tuple[State, typing.List[messaging.AddressedMessage]]:
+    """
+    Sends timed out requests to other peers, then hands out the next blocks
+    to whichever peers have the fewest requests outstanding.
+    """
+    sync = state.sync
+    if not sync.downloading or len(state.peers) == 0:
+        return state, []
+
+    in_flight = sync.in_flight
+    retries = list(sync.retries)
+    for block_hash, request in sync.in_flight.items():
+        if now - request.requested_at > BLOCK_TIMEOUT:
+            ctx.info(f"block request to {request.peer} timed out")
+            in_flight = in_flight.delete(block_hash)
+            retries.append((block_hash, request))
+
+    load = collections.Counter(request.peer for request in in_flight.values())
+    peers = sorted(state.peers)
+
+    def pick_peer(
+        failed_peer: typing.Optional[messaging.Address],
+    ) -> typing.Optional[messaging.Address]:
+        candidates = [
+            peer
+            for peer in peers
+            if load[peer] < MAX_IN_FLIGHT_PER_PEER
+            and (peer != failed_peer or len(peers) == 1)
+        ]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda peer: load[peer])
+
+    requested: typing.Dict[messaging.Address, typing.List[bytes]] = (
+        collections.defaultdict(list)
+    )
+
+    def assign(block_hash: bytes, peer: messaging.Address) -> None:
+        nonlocal in_flight
+        in_flight = in_flight.set(block_hash, BlockRequest(peer=peer, requested_at=now))
+        load[peer] += 1
+        requested[peer].append(block_hash)
+
+    still_retrying = []
+    for block_hash, failed in retries:
+        if block_hash in state.block_lookup or block_hash in sync.bodies:
+            continue
+        peer = pick_peer(failed.peer)
+        if peer is None:
+            still_retrying.append((block_hash, failed))
+        else:
+            assign(block_hash, peer)
+
+    next_request = sync.next_request
+    window_end = min(len(sync.pending), sync.next_connect + DOWNLOAD_WINDOW)
+    while next_request < window_end:
+        block_hash = sync.pending[next_request]
+        if block_hash not in state.block_lookup and block_hash not in sync.bodies:
+            peer = pick_peer(None)
+            if peer is None:
+                break
+            assign(block_hash, peer)
+        next_request += 1
+
+    state = replace(
+        state,
+        sync=replace(
+            sync,
+            in_flight=in_flight,
+            next_request=next_request,
+            retries=tuple(still_retrying),
+        ),
+        startup_state=(
+            StartupState.DATA
+            if state.startup_state == StartupState.INVENTORY
+            else state.startup_state
+        ),
+    )
+    return state, [
+        messaging.AddressedMessage(
+            message=messaging.GetDataMessage(
+                payload=messaging.GetDataMessage.Payload(
+                    objects_requested=tuple(block_hashes)
+                )
+            ),
+            sender_address=ctx.node_id,
+            recipient_address=peer,
+        )
+        for peer, block_hashes in requested.items()
+    ]
+
+
+def add_block_body(
+    ctx: NodeContext, state: State, block: SealedBlock, peer: messaging.Address
+) -> typing.Tuple[State, typing.List[messaging.AddressedMessage]]:
+    """
+    Takes a block whose header came through sync, connects every block that
+    is now ready, and requests more. A body that doesn't hash to its header
+    is asked for again from another peer; one that does but doesn't connect
+    is invalid, so its header and everything queued after it are dropped.
+    """
+    sync = state.sync
+    block_hash = block.header.block_hash
+    if sync.headers[block_hash] != block.header:
+        ctx.warning("block doesn't match its header")
+        return state, []
+    now = time.monotonic()
+    if not block.validate_hashes():
+        ctx.warning(
+            f"block from {peer} doesn't hash to its header, asking another peer"
+        )
+        state = replace(
+            state,
+            sync=replace(
+                sync,
+                in_flight=sync.in_flight.discard(block_hash),
+                retries=sync.retries
+                + ((block_hash, BlockRequest(peer=peer, requested_at=now)),),
+            ),
+        )
+        state, requests = schedule_downloads(ctx, state, now)
+        return state, requests
+    state = replace(
+        state,
+        sync=replace(
+            sync,
+            in_flight=sync.in_flight.discard(block_hash),
+            bodies=sync.bodies.set(block_hash, block),
+        ),
+    )
+
+    sync = state.sync
+    while sync.next_connect < len(sync.pending):
+        block_hash = sync.pending[sync.next_connect]
+        if block_hash not in state.block_lookup:
+            body = sync.bodies.get(block_hash)
+            if body is None:
+                break
+            state = try_add_block(ctx, state, body)
+            if block_hash not in state.block_lookup:
+                sync = _drop_invalid(ctx, sync, block_hash)
+                continue
+        sync = replace(
+            sync,
+            headers=sync.headers.discard(block_hash),
+            bodies=sync.bodies.discard(block_hash),
+            next_connect=sync.next_connect + 1,
+        )
+    state = replace(state, sync=sync)
+    state, requests = schedule_downloads(ctx, state, now)
+    return finish_sync(state), requests
+
+
+def _drop_invalid(ctx: NodeContext, sync: SyncState, invalid_hash: bytes) -> SyncState:
+    """
+    Forgets an invalid block and every queued block built on it. Pending
+    blocks come after their parents, so one pass over the rest of the queue
+    finds all of them.
+    """
+    invalid = {invalid_hash}
+    after_invalid = sync.next_connect + 1
+    for block_hash in sync.pending[after_invalid:]:
+        if sync.headers[block_hash].previous_block_hash in invalid:
+            invalid.add(block_hash)
+    ctx.warning(f"dropping {len(invalid)} queued blocks built on an invalid block")
+
+    headers = sync.headers
+    bodies = sync.bodies
+    in_flight = sync.in_flight
+    for block_hash in invalid:
+        headers = headers.delete(block_hash)
+        bodies = bodies.discard(block_hash)
+        in_flight = in_flight.discard(block_hash)
+    return replace(
+        sync,
+        headers=headers,
+        bodies=bodies,
+        in_flight=in_flight,
+        pending=tuple(
+            block_hash for block_hash in sync.pending if block_hash not in invalid
+        ),
+        next_request=sync.next_request
+        - sum(
+            1
+            for block_hash in sync.pending[: sync.next_request]
+            if block_hash in invalid
+        ),
+        retries=tuple(
+            (block_hash, request)
+            for block_hash, request in sync.retries
+            if block_hash not in invalid
+        ),
+    )
+
+
+def finish_sync(state: State) -> State:
+    """
+    Drops the download bookkeeping once every queued block is in, and marks a
+    starting node as synced.
+    """
+    if state.sync.downloading:
+        return state
+    return replace(
+        state,
+        sync=SyncState(),
+        startup_state=(
+            StartupState.SYNCED
+            if state.startup_state in (StartupState.INVENTORY, StartupState.DATA)
+            else state.startup_state
+        ),
+    )
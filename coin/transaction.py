@@ -43,8 +43,8 @@ class TransactionOutput:
 
 @dataclass(frozen=True)
 class Transaction:
-    inputs: typing.Tuple[TransactionInput]
-    outputs: typing.Tuple[TransactionOutput]
+    inputs: typing.Tuple[TransactionInput, ...]
+    outputs: typing.Tuple[TransactionOutput, ...]
 
     @property
     def is_coinbase(self) -> bool:
@@ -74,7 +74,11 @@ class Transaction:
         return hash_byte_sets(*(self._inputs_hash_parts + self._outputs_hash_parts))
 
 
-def make_reward_transaction(ctx: NodeContext) -> Transaction:
+def make_reward_transaction(
+    ctx: NodeContext, previous_block_hash: bytes, fees: int = 0
+) -> Transaction:
+    # the coinbase carries the parent block hash in place of a signature so
+    # that every reward transaction, and thus every reward outpoint, is unique
     return Transaction(
         inputs=(
             TransactionInput(
@@ -82,12 +86,12 @@ def make_reward_transaction(ctx: NodeContext) -> Transaction:
                     previous_transaction_hash=b"",
                     index=0,
                 ),
-                signature=b"",
+                signature=previous_block_hash,
             ),
         ),
         outputs=(
             TransactionOutput(
-                value=1,
+                value=1 + fees,
                 recipient_public_key=ctx.node_key.public_key.to_string(),
             ),
         ),
@@ -0,0 +1,209 @@
+"""
+Direct socket connections between nodes. A node's address is where it
+listens, either "host:port" for TCP or "unix:/path" for a Unix socket, so the
+addresses peers hand out in AddrMessages can be dialled as they are. Every
+message travels as a 4-byte length followed by its wire encoding.
+
+Each peer gets one outgoing connection with its own write buffer, so a slow
+or unreachable peer only holds up its own messages. Messages arrive on the
+connections other nodes open to this one and are handed to on_message on the
+event loop.
+"""
+
+from __future__ import annotations
+import asyncio
+import collections
+import struct
+import typing
+import coin.messaging as messaging
+from coin.node_context import NodeContext
+from coin.wire import DecodeError, decode_addressed_message, encode_addressed_message
+
+_LENGTH = struct.Struct(">I")
+# a block with a few hundred thousand transactions still fits
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+_UNIX_PREFIX = "unix:"
+
+
+async def open_connection(
+    address: messaging.Address,
+) -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if address.startswith(_UNIX_PREFIX):
+        return await asyncio.open_unix_connection(address.removeprefix(_UNIX_PREFIX))
+    host, port = address.rsplit(":", 1)
+    return await asyncio.open_connection(host, int(port))
+
+
+async def start_server(
+    address: messaging.Address,
+    on_connection: typing.Callable[
+        [asyncio.StreamReader, asyncio.StreamWriter], typing.Awaitable[None]
+    ],
+) -> asyncio.AbstractServer:
+    if address.startswith(_UNIX_PREFIX):
+        return await asyncio.start_unix_server(
+            on_connection, address.removeprefix(_UNIX_PREFIX)
+        )
+    host, port = address.rsplit(":", 1)
+    return await asyncio.start_server(on_connection, host, int(port))
+
+
+def frame(addressed_message: messaging.AddressedMessage) -> bytes:
+    encoded = encode_addressed_message(addressed_message)
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+async def read_frame(
+    reader: asyncio.StreamReader,
+) -> typing.Optional[messaging.AddressedMessage]:
+    """
+    Returns None once the other end closes the connection between frames.
+    """
+    try:
+        prefix = await reader.readexactly(_LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise
+    (size,) = _LENGTH.unpack(prefix)
+    if size > MAX_FRAME_SIZE:
+        raise DecodeError("Frame too large", size)
+    return decode_addressed_message(memoryview(await reader.readexactly(size)))
+
+
+class _Peer:
+    def __init__(self, address: messaging.Address) -> None:
+        self.address = address
+        self.outbox: typing.Deque[bytes] = collections.deque()
+        self.buffered = 0
+        self.pending = asyncio.Event()
+        self.task: typing.Optional[asyncio.Task[None]] = None
+
+
+class PeerTransport:
+    """
+    Sends are fire-and-forget: a message queued for a peer that can't be
+    reached is dropped once connecting has failed connect_attempts times in a
+    row, and messages that would take a peer's buffer past max_buffered bytes
+    are dropped straight away.
+    """
+
+    def __init__(
+        self,
+        ctx: NodeContext,
+        on_message: typing.Callable[[messaging.AddressedMessage], None],
+        *,
+        max_buffered: int = 16 * 1024 * 1024,
+        connect_attempts: int = 50,
+        retry_delay: float = 0.1,
+    ) -> None:
+        self.ctx = ctx
+        self.on_message = on_message
+        self.max_buffered = max_buffered
+        self.connect_attempts = connect_attempts
+        self.retry_delay = retry_delay
+        self._peers: typing.Dict[messaging.Address, _Peer] = {}
+        self._readers: typing.Dict[asyncio.Task[None], asyncio.StreamWriter] = {}
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await start_server(self.ctx.node_id, self._accept)
+        self.ctx.info(f"listening on {self.ctx.node_id}")
+
+    def _flushed(self) -> bool:
+        return all(
+            len(peer.outbox) == 0 or peer.task is None or peer.task.done()
+            for peer in self._peers.values()
+        )
+
+    async def close(self, linger: float = 1.0) -> None:
+        """
+        Gives queued messages up to linger seconds to go out before dropping
+        every connection.
+        """
+        if self._server is not None:
+            self._server.close()
+        deadline = asyncio.get_running_loop().time() + linger
+        while not self._flushed() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+        # incoming connections are closed rather than cancelled so that
+        # their readers see the end of the stream and finish normally
+        for writer in self._readers.values():
+            writer.close()
+        writers = [peer.task for peer in self._peers.values() if peer.task is not None]
+        for task in writers:
+            task.cancel()
+        await asyncio.gather(*self._readers, *writers, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def send(self, addressed_message: messaging.AddressedMessage) -> None:
+        address = addressed_message.recipient_address
+        peer = self._peers.get(address)
+        if peer is None:
+            peer = self._peers[address] = _Peer(address)
+        data = frame(addressed_message)
+        if peer.buffered + len(data) > self.max_buffered:
+            self.ctx.warning(f"write buffer for {address} is full, dropping message")
+            return
+        peer.outbox.append(data)
+        peer.buffered += len(data)
+        peer.pending.set()
+        if peer.task is None or peer.task.done():
+            peer.task = asyncio.create_task(self._write_to(peer))
+        self.ctx.info(f"sent {addressed_message}")
+
+    async def _connect(self, peer: _Peer) -> typing.Optional[asyncio.StreamWriter]:
+        for _ in range(self.connect_attempts):
+            try:
+                _, writer = await open_connection(peer.address)
+                return writer
+            except OSError:
+                await asyncio.sleep(self.retry_delay)
+        self.ctx.warning(
+            f"could not connect to {peer.address}, dropping {len(peer.outbox)} messages"
+        )
+        peer.outbox.clear()
+        peer.buffered = 0
+        return None
+
+    async def _write_to(self, peer: _Peer) -> None:
+        while True:
+            writer = await self._connect(peer)
+            if writer is None:
+                return
+            try:
+                while True:
+                    while len(peer.outbox) == 0:
+                        peer.pending.clear()
+                        await peer.pending.wait()
+                    while len(peer.outbox) > 0:
+                        data = peer.outbox.popleft()
+                        peer.buffered -= len(data)
+                        writer.write(data)
+                    await writer.drain()
+            except OSError as e:
+                # what is still in the outbox goes out on the next connection
+                self.ctx.warning(f"lost connection to {peer.address}: {e}")
+            finally:
+                writer.close()
+
+    async def _accept(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._readers[task] = writer
+        try:
+            while True:
+                addressed_message = await read_frame(reader)
+                if addressed_message is None:
+                    return
+                self.ctx.info(f"recv {addressed_message}")
+                self.on_message(addressed_message)
+        except (OSError, asyncio.IncompleteReadError, DecodeError) as e:
+            self.ctx.warning(f"dropping connection: {e}")
+        finally:
+            del self._readers[task]
+            writer.close()
@@ -0,0 +1,235 @@
+from __future__ import annotations
+import os
+import typing
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from multiprocessing.pool import AsyncResult, Pool
+from ecdsa import VerifyingKey, BadSignatureError, MalformedPointError, ellipticcurve
+from coin.multiprocessing import mp_ctx
+
+# (transaction hash, input index) pins down the signature, the signed message
+# and, through the content-addressed outpoint, the public key it is checked
+# against, so a successful check can be remembered under it
+SignatureCacheKey = typing.Tuple[bytes, int]
+
+
+@dataclass(frozen=True)
+class SignatureCheck:
+    public_key: bytes
+    signature: bytes
+    message: bytes
+    cache_key: typing.Optional[SignatureCacheKey] = None
+
+
+def precompute_verifying_key(verifying_key: VerifyingKey) -> VerifyingKey:
+    # from_string leaves the point without its order, which the ecdsa
+    # precomputation needs, so rebuild it from the affine coordinates first
+    point = verifying_key.pubkey.point
+    precomputed_key = VerifyingKey.from_public_point(
+        ellipticcurve.Point(
+            verifying_key.curve.curve,
+            point.x(),
+            point.y(),
+            verifying_key.curve.order,
+        ),
+        curve=verifying_key.curve,
+        hashfunc=verifying_key.default_hashfunc,
+        validate_point=False,
+    )
+    precomputed_key.precompute()
+    return precomputed_key
+
+
+@dataclass
+class _CachedVerifyingKey:
+    parsed_key: VerifyingKey
+    # parsed_key, or its precomputed copy once it has one
+    verifying_key: VerifyingKey
+    uses: int = 0
+
+
+@dataclass
+class VerifyingKeyCache:
+    """
+    Bounded LRU of parsed verifying keys. Keys used at least precompute_after
+    times get the ecdsa multiplication tables, which cost a few milliseconds
+    once and then roughly halve the cost of every verification. The tables
+    are far bigger than a parsed key, so only the max_precomputed most
+    recently used keys keep them; the others go back to their parsed key
+    and count their uses again.
+    """
+
+    max_entries: int = 10000
+    max_precomputed: int = 256
+    precompute_after: int = 8
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    precomputed: int = 0
+    released: int = 0
+    _entries: typing.OrderedDict[bytes, _CachedVerifyingKey] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    # the keys holding tables, least recently used first
+    _precomputed: typing.OrderedDict[bytes, None] = field(
+        default_factory=OrderedDict, repr=False
+    )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, public_key: bytes) -> VerifyingKey:
+        entry = self._entries.get(public_key)
+        if entry is None:
+            self.misses += 1
+            parsed_key = VerifyingKey.from_string(public_key)
+            entry = _CachedVerifyingKey(parsed_key=parsed_key, verifying_key=parsed_key)
+            self._entries[public_key] = entry
+            while len(self._entries) > self.max_entries:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._precomputed.pop(evicted_key, None)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(public_key)
+            if public_key in self._precomputed:
+                self._precomputed.move_to_end(public_key)
+        entry.uses += 1
+        if entry.uses == self.precompute_after:
+            entry.verifying_key = precompute_verifying_key(entry.parsed_key)
+            self._precomputed[public_key] = None
+            self.precomputed += 1
+            while len(self._precomputed) > self.max_precomputed:
+                released_key, _ = self._precomputed.popitem(last=False)
+                released = self._entries[released_key]
+                released.verifying_key = released.parsed_key
+                released.uses = 0
+                self.released += 1
+        return entry.verifying_key
+
+
+def verify_signature(
+    check: SignatureCheck, keys: typing.Optional[VerifyingKeyCache] = None
+) -> bool:
+    try:
+        verifying_key = (
+            keys.get(check.public_key)
+            if keys is not None
+            else VerifyingKey.from_string(check.public_key)
+        )
+        return bool(verifying_key.verify(check.signature, check.message))
+    except (BadSignatureError, MalformedPointError):
+        return False
+
+
+# each pool worker process keeps its own key cache across batches
+_worker_keys = VerifyingKeyCache()
+
+
+def _verify_chunk_in_worker(checks: typing.Sequence[SignatureCheck]) -> bool:
+    return all(verify_signature(check, _worker_keys) for check in checks)
+
+
+@dataclass
+class SignatureCache:
+    """
+    Bounded LRU set of signature checks that are known to have passed.
+    """
+
+    max_entries: int = 100000
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    _entries: typing.OrderedDict[SignatureCacheKey, None] = field(
+        default_factory=OrderedDict, repr=False
+    )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: SignatureCacheKey) -> bool:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key: SignatureCacheKey) -> None:
+        self._entries[key] = None
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+@dataclass
+class SignatureVerifier:
+    """
+    Checks batches of signatures, fanning them out to a process pool when a
+    batch is large enough to amortize the cost of shipping it to the workers.
+    Every node has its own verifier next to the mining workers, so the pool
+    is kept small. Only a few chunks per worker are in flight at a time, so
+    a failed check stops the rest of the batch from being sent.
+    """
+
+    workers: int = field(default_factory=lambda: min(2, os.cpu_count() or 1))
+    min_parallel_checks: int = 64
+    chunk_size: int = 16
+    chunks_per_worker: int = 2
+    cache: SignatureCache = field(default_factory=SignatureCache)
+    keys: VerifyingKeyCache = field(default_factory=VerifyingKeyCache)
+    _pool: typing.Optional[Pool] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def verify_all(self, checks: typing.Sequence[SignatureCheck]) -> bool:
+        uncached = [
+            check
+            for check in checks
+            if check.cache_key is None or not self.cache.lookup(check.cache_key)
+        ]
+        if not self._verify_uncached(uncached):
+            return False
+        for check in uncached:
+            if check.cache_key is not None:
+                self.cache.add(check.cache_key)
+        return True
+
+    def _verify_uncached(self, checks: typing.Sequence[SignatureCheck]) -> bool:
+        if self.workers <= 1 or len(checks) < self.min_parallel_checks:
+            return all(verify_signature(check, self.keys) for check in checks)
+        if self._pool is None:
+            self._pool = mp_ctx.Pool(self.workers)
+        in_flight: typing.Deque[AsyncResult[bool]] = deque()
+        for start in range(0, len(checks), self.chunk_size):
+            end = start + self.chunk_size
+            in_flight.append(
+                self._pool.apply_async(_verify_chunk_in_worker, (checks[start:end],))
+            )
+            if len(in_flight) >= self.workers * self.chunks_per_worker:
+                if not in_flight.popleft().get():
+                    return False
+        return all(result.get() for result in in_flight)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __getstate__(self) -> typing.Dict[str, typing.Any]:
+        # pools can't cross process boundaries and cached results are only
+        # useful to the process that verified them, so copies start empty
+        return {
+            **self.__dict__,
+            "_pool": None,
+            "cache": SignatureCache(max_entries=self.cache.max_entries),
+            "keys": VerifyingKeyCache(
+                max_entries=self.keys.max_entries,
+                max_precomputed=self.keys.max_precomputed,
+                precompute_after=self.keys.precompute_after,
+            ),
+        }
+
+
+SERIAL_VERIFIER = SignatureVerifier(workers=1)
@@ -0,0 +1,529 @@
+"""
+Binary encoding for everything nodes send each other. A message frame is the
+wire version, the message type's code and the payload length, followed by the
+payload. Integers in payloads are unsigned LEB128 varints and byte strings are
+prefixed with their varint length. Decoding reads straight out of a
+memoryview over the frame, so no part of it is copied except into the fields
+of the decoded objects.
+"""
+
+from __future__ import annotations
+import struct
+import typing
+import coin.messaging as messaging
+from coin.block import SealedBlock, SealedBlockHeader
+from coin.merkle import (
+    ChildMerkleNode,
+    LeafMerkleNode,
+    MerkleMultiProof,
+    MerkleNode,
+    NullMerkleNode,
+)
+from coin.transaction import (
+    Transaction,
+    TransactionInput,
+    TransactionOutpoint,
+    TransactionOutput,
+)
+
+WIRE_VERSION = 2
+_FRAME = struct.Struct(">BBI")
+
+_NULL_NODE = 0
+_LEAF_NODE = 1
+_CHILD_NODE = 2
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class _Writer:
+    __slots__ = ("buffer",)
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def uint(self, value: int) -> None:
+        if value < 0:
+            raise ValueError("Can't encode negative integer", value)
+        while value >= 0x80:
+            self.buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def blob(self, value: bytes) -> None:
+        self.uint(len(value))
+        self.buffer += value
+
+    def text(self, value: str) -> None:
+        self.blob(value.encode())
+
+    def blobs(self, values: typing.Sequence[bytes]) -> None:
+        self.uint(len(values))
+        for value in values:
+            self.blob(value)
+
+
+class _Reader:
+    __slots__ = ("view", "offset")
+
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def uint(self) -> int:
+        byte = self.view[self.offset]
+        self.offset += 1
+        if byte < 0x80:
+            return byte
+        value = byte & 0x7F
+        shift = 7
+        while True:
+            byte = self.view[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def blob(self) -> bytes:
+        # nearly every length fits in one byte, so skip the general varint path
+        size = self.view[self.offset]
+        if size < 0x80:
+            self.offset += 1
+        else:
+            size = self.uint()
+        start = self.offset
+        end = start + size
+        if end > len(self.view):
+            raise DecodeError("Truncated byte string")
+        self.offset = end
+        return self.view[start:end].tobytes()
+
+    def text(self) -> str:
+        return self.blob().decode()
+
+    def blobs(self) -> typing.Tuple[bytes, ...]:
+        return tuple(self.blob() for _ in range(self.uint()))
+
+    def finish(self) -> None:
+        if self.offset != len(self.view):
+            raise DecodeError("Trailing bytes", len(self.view) - self.offset)
+
+
+def _write_transaction(writer: _Writer, transaction: Transaction) -> None:
+    writer.uint(len(transaction.inputs))
+    for transaction_input in transaction.inputs:
+        outpoint = transaction_input.previous_transaction_outpoint
+        writer.blob(outpoint.previous_transaction_hash)
+        writer.uint(outpoint.index)
+        writer.blob(transaction_input.signature)
+    writer.uint(len(transaction.outputs))
+    for transaction_output in transaction.outputs:
+        writer.uint(transaction_output.value)
+        writer.blob(transaction_output.recipient_public_key)
+
+
+def _read_transaction(reader: _Reader) -> Transaction:
+    inputs = tuple(
+        TransactionInput(
+            previous_transaction_outpoint=TransactionOutpoint(
+                previous_transaction_hash=reader.blob(), index=reader.uint()
+            ),
+            signature=reader.blob(),
+        )
+        for _ in range(reader.uint())
+    )
+    outputs = tuple(
+        TransactionOutput(value=reader.uint(), recipient_public_key=reader.blob())
+        for _ in range(reader.uint())
+    )
+    return Transaction(inputs=inputs, outputs=outputs)
+
+
+def _write_header(writer: _Writer, header: SealedBlockHeader) -> None:
+    writer.blob(header.transaction_tree_hash)
+    writer.blob(header.previous_block_hash)
+    writer.uint(header.nonce)
+    writer.blob(header.block_hash)
+
+
+def _read_header(reader: _Reader) -> SealedBlockHeader:
+    return SealedBlockHeader(
+        transaction_tree_hash=reader.blob(),
+        previous_block_hash=reader.blob(),
+        nonce=reader.uint(),
+        block_hash=reader.blob(),
+    )
+
+
+def _write_transaction_tree(
+    writer: _Writer, transaction_tree: MerkleNode[Transaction]
+) -> None:
+    # the shape isn't fixed by consensus, so the tree goes out node by node
+    # in pre-order
+    nodes = [transaction_tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        if isinstance(node, ChildMerkleNode):
+            writer.buffer.append(_CHILD_NODE)
+            nodes.append(node.parent_b)
+            nodes.append(node.parent_a)
+        elif isinstance(node, LeafMerkleNode):
+            writer.buffer.append(_LEAF_NODE)
+            writer.uint(node.height)
+            _write_transaction(writer, node.payload)
+        elif isinstance(node, NullMerkleNode):
+            writer.buffer.append(_NULL_NODE)
+        else:
+            raise ValueError("Can't encode merkle node", node)
+
+
+def _read_transaction_tree(reader: _Reader) -> MerkleNode[Transaction]:
+    pending: typing.List[typing.List[MerkleNode[Transaction]]] = []
+    while True:
+        tag = reader.view[reader.offset]
+        reader.offset += 1
+        node: MerkleNode[Transaction]
+        if tag == _CHILD_NODE:
+            pending.append([])
+            continue
+        elif tag == _LEAF_NODE:
+            node = LeafMerkleNode(
+                height=reader.uint(), payload=_read_transaction(reader)
+            )
+        elif tag == _NULL_NODE:
+            node = NullMerkleNode()
+        else:
+            raise DecodeError("Unknown merkle node tag", tag)
+        while len(pending) > 0:
+            pending[-1].append(node)
+            if len(pending[-1]) < 2:
+                break
+            parent_a, parent_b = pending.pop()
+            node = ChildMerkleNode(parent_a=parent_a, parent_b=parent_b)
+        else:
+            return node
+
+
+def _write_block(writer: _Writer, block: SealedBlock) -> None:
+    _write_header(writer, block.header)
+    _write_transaction_tree(writer, block.transaction_tree)
+
+
+def _read_block(reader: _Reader) -> SealedBlock:
+    header = _read_header(reader)
+    return SealedBlock(header=header, transaction_tree=_read_transaction_tree(reader))
+
+
+_Encoder = typing.Callable[[_Writer, typing.Any], None]
+_Decoder = typing.Callable[[_Reader], messaging.Message]
+
+
+def _write_nothing(writer: _Writer, message: messaging.Message) -> None:
+    pass
+
+
+def _write_locator(
+    writer: _Writer,
+    message: typing.Union[messaging.GetBlocksMessage, messaging.GetHeadersMessage],
+) -> None:
+    writer.blobs(message.payload.header_hashes)
+    if message.payload.stopping_hash is None:
+        writer.uint(0)
+    else:
+        writer.uint(1)
+        writer.blob(message.payload.stopping_hash)
+
+
+def _read_locator(
+    reader: _Reader,
+) -> typing.Tuple[typing.Tuple[bytes, ...], typing.Optional[bytes]]:
+    header_hashes = reader.blobs()
+    return header_hashes, reader.blob() if reader.uint() == 1 else None
+
+
+def _write_inventory(writer: _Writer, message: messaging.InventoryMessage) -> None:
+    writer.blobs(message.payload.header_hashes)
+    writer.blobs(message.payload.transaction_hashes)
+
+
+def _read_inventory(reader: _Reader) -> messaging.Message:
+    header_hashes = reader.blobs()
+    return messaging.InventoryMessage(
+        payload=messaging.InventoryMessage.Payload(
+            header_hashes=header_hashes, transaction_hashes=reader.blobs()
+        )
+    )
+
+
+def _write_get_data(writer: _Writer, message: messaging.GetDataMessage) -> None:
+    writer.blobs(message.payload.objects_requested)
+    writer.blobs(message.payload.transactions_requested)
+
+
+def _read_get_data(reader: _Reader) -> messaging.Message:
+    objects_requested = reader.blobs()
+    return messaging.GetDataMessage(
+        payload=messaging.GetDataMessage.Payload(
+            objects_requested=objects_requested, transactions_requested=reader.blobs()
+        )
+    )
+
+
+def _read_get_blocks(reader: _Reader) -> messaging.Message:
+    header_hashes, stopping_hash = _read_locator(reader)
+    return messaging.GetBlocksMessage(
+        payload=messaging.GetBlocksMessage.Payload(
+            header_hashes=header_hashes, stopping_hash=stopping_hash
+        )
+    )
+
+
+def _read_get_headers(reader: _Reader) -> messaging.Message:
+    header_hashes, stopping_hash = _read_locator(reader)
+    return messaging.GetHeadersMessage(
+        payload=messaging.GetHeadersMessage.Payload(
+            header_hashes=header_hashes, stopping_hash=stopping_hash
+        )
+    )
+
+
+def _write_headers(writer: _Writer, message: messaging.HeadersMessage) -> None:
+    writer.uint(len(message.payload.headers))
+    for header in message.payload.headers:
+        _write_header(writer, header)
+
+
+def _read_headers(reader: _Reader) -> messaging.Message:
+    return messaging.HeadersMessage(
+        payload=messaging.HeadersMessage.Payload(
+            headers=tuple(_read_header(reader) for _ in range(reader.uint()))
+        )
+    )
+
+
+def _write_merkle_proof(writer: _Writer, message: messaging.MerkleProofMessage) -> None:
+    _write_header(writer, message.payload.header)
+    writer.blobs(message.payload.transaction_hashes)
+    writer.blob(message.payload.proof.shape)
+    writer.blobs(message.payload.proof.hashes)
+
+
+def _read_merkle_proof(reader: _Reader) -> messaging.Message:
+    header = _read_header(reader)
+    transaction_hashes = reader.blobs()
+    shape = reader.blob()
+    return messaging.MerkleProofMessage(
+        payload=messaging.MerkleProofMessage.Payload(
+            header=header,
+            transaction_hashes=transaction_hashes,
+            proof=MerkleMultiProof(shape=shape, hashes=reader.blobs()),
+        )
+    )
+
+
+def _read_get_merkle_proof(reader: _Reader) -> messaging.Message:
+    block_hash = reader.blob()
+    return messaging.GetMerkleProofMessage(
+        payload=messaging.GetMerkleProofMessage.Payload(
+            block_hash=block_hash, transaction_hashes=reader.blobs()
+        )
+    )
+
+
+def _write_get_merkle_proof(
+    writer: _Writer, message: messaging.GetMerkleProofMessage
+) -> None:
+    writer.blob(message.payload.block_hash)
+    writer.blobs(message.payload.transaction_hashes)
+
+
+# codes are part of the wire format: never reuse or renumber them
+_MESSAGE_CODECS: typing.Dict[
+    messaging.MessageType, typing.Tuple[int, _Encoder, _Decoder]
+] = {
+    messaging.MessageType.VERSION: (
+        1,
+        lambda writer, message: writer.text(message.payload.version),
+        lambda reader: messaging.VersionMessage(
+            payload=messaging.VersionMessage.Payload(version=reader.text())
+        ),
+    ),
+    messaging.MessageType.VERSION_ACK: (
+        2,
+        _write_nothing,
+        lambda reader: messaging.VersionAckMessage(),
+    ),
+    messaging.MessageType.GET_BLOCKS: (3, _write_locator, _read_get_blocks),
+    messaging.MessageType.INVENTORY: (4, _write_inventory, _read_inventory),
+    messaging.MessageType.GET_DATA: (5, _write_get_data, _read_get_data),
+    messaging.MessageType.BLOCK: (
+        6,
+        lambda writer, message: _write_block(writer, message.payload.block),
+        lambda reader: messaging.BlockMessage(
+            payload=messaging.BlockMessage.Payload(block=_read_block(reader))
+        ),
+    ),
+    messaging.MessageType.TRANSACTION: (
+        7,
+        lambda writer, message: _write_transaction(writer, message.payload.transaction),
+        lambda reader: messaging.TransactionMessage(
+            payload=messaging.TransactionMessage.Payload(
+                transaction=_read_transaction(reader)
+            )
+        ),
+    ),
+    messaging.MessageType.GET_ADDR: (
+        8,
+        _write_nothing,
+        lambda reader: messaging.GetAddrMessage(),
+    ),
+    messaging.MessageType.ADDR: (
+        9,
+        lambda writer, message: writer.blobs(
+            [address.encode() for address in message.payload.addresses]
+        ),
+        lambda reader: messaging.AddrMessage(
+            payload=messaging.AddrMessage.Payload(
+                addresses=tuple(address.decode() for address in reader.blobs())
+            )
+        ),
+    ),
+    messaging.MessageType.GET_MERKLE_PROOF: (
+        10,
+        _write_get_merkle_proof,
+        _read_get_merkle_proof,
+    ),
+    messaging.MessageType.MERKLE_PROOF: (11, _write_merkle_proof, _read_merkle_proof),
+    messaging.MessageType.GET_HEADERS: (12, _write_locator, _read_get_headers),
+    messaging.MessageType.HEADERS: (13, _write_headers, _read_headers),
+}
+_MESSAGE_DECODERS = {code: decoder for code, _, decoder in _MESSAGE_CODECS.values()}
+
+
+def _decoding(
+    decode: typing.Callable[[_Reader], typing.Any],
+    data: typing.Union[bytes, bytearray, memoryview],
+) -> typing.Any:
+    reader = _Reader(data)
+    try:
+        value = decode(reader)
+        reader.finish()
+    except (IndexError, UnicodeDecodeError) as e:
+        raise DecodeError("Truncated or malformed data") from e
+    return value
+
+
+def _encoding(encode: typing.Callable[[_Writer], None]) -> bytes:
+    writer = _Writer()
+    encode(writer)
+    return bytes(writer.buffer)
+
+
+def encode_transaction(transaction: Transaction) -> bytes:
+    return _encoding(lambda writer: _write_transaction(writer, transaction))
+
+
+def decode_transaction(data: typing.Union[bytes, bytearray, memoryview]) -> Transaction:
+    return typing.cast(Transaction, _decoding(_read_transaction, data))
+
+
+def encode_block_header(header: SealedBlockHeader) -> bytes:
+    return _encoding(lambda writer: _write_header(writer, header))
+
+
+def decode_block_header(
+    data: typing.Union[bytes, bytearray, memoryview],
+) -> SealedBlockHeader:
+    return typing.cast(SealedBlockHeader, _decoding(_read_header, data))
+
+
+def encode_transaction_tree(transaction_tree: MerkleNode[Transaction]) -> bytes:
+    return _encoding(lambda writer: _write_transaction_tree(writer, transaction_tree))
+
+
+def decode_transaction_tree(
+    data: typing.Union[bytes, bytearray, memoryview],
+) -> MerkleNode[Transaction]:
+    return typing.cast(MerkleNode[Transaction], _decoding(_read_transaction_tree, data))
+
+
+def encode_block(block: SealedBlock) -> bytes:
+    return _encoding(lambda writer: _write_block(writer, block))
+
+
+def decode_block(data: typing.Union[bytes, bytearray, memoryview]) -> SealedBlock:
+    return typing.cast(SealedBlock, _decoding(_read_block, data))
+
+
+def _write_message(writer: _Writer, message: messaging.Message) -> None:
+    code, encode, _ = _MESSAGE_CODECS[message.message_type]
+    frame_start = len(writer.buffer)
+    writer.buffer += bytes(_FRAME.size)
+    encode(writer, message)
+    _FRAME.pack_into(
+        writer.buffer,
+        frame_start,
+        WIRE_VERSION,
+        code,
+        len(writer.buffer) - frame_start - _FRAME.size,
+    )
+
+
+def _read_message(reader: _Reader) -> messaging.Message:
+    if len(reader.view) - reader.offset < _FRAME.size:
+        raise DecodeError("Truncated frame")
+    version, code, size = _FRAME.unpack_from(reader.view, reader.offset)
+    if version != WIRE_VERSION:
+        raise DecodeError("Unsupported wire version", version)
+    decoder = _MESSAGE_DECODERS.get(code)
+    if decoder is None:
+        raise DecodeError("Unknown message code", code)
+    payload_start = reader.offset + _FRAME.size
+    payload_end = payload_start + size
+    if payload_end > len(reader.view):
+        raise DecodeError("Truncated frame")
+    payload_reader = _Reader(reader.view[payload_start:payload_end])
+    message = decoder(payload_reader)
+    payload_reader.finish()
+    reader.offset = payload_end
+    return message
+
+
+def encode_message(message: messaging.Message) -> bytes:
+    return _encoding(lambda writer: _write_message(writer, message))
+
+
+def decode_message(
+    data: typing.Union[bytes, bytearray, memoryview],
+) -> messaging.Message:
+    return typing.cast(messaging.Message, _decoding(_read_message, data))
+
+
+def encode_addressed_message(addressed_message: messaging.AddressedMessage) -> bytes:
+    def encode(writer: _Writer) -> None:
+        writer.text(addressed_message.sender_address)
+        writer.text(addressed_message.recipient_address)
+        _write_message(writer, addressed_message.message)
+
+    return _encoding(encode)
+
+
+def decode_addressed_message(
+    data: typing.Union[bytes, bytearray, memoryview],
+) -> messaging.AddressedMessage:
+    def decode(reader: _Reader) -> messaging.AddressedMessage:
+        sender_address = reader.text()
+        recipient_address = reader.text()
+        return messaging.AddressedMessage(
+            sender_address=sender_address,
+            recipient_address=recipient_address,
+            message=_read_message(reader),
+        )
+
+    addressed_message = typing.cast(messaging.AddressedMessage, _decoding(decode, data))
+    if isinstance(data, bytes):
+        object.__setattr__(addressed_message, "_encoded", data)
+    return addressed_message